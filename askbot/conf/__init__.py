@@ -33,4 +33,8 @@ def should_show_sort_by_relevance():
     """True if configuration support sorting
     questions by search relevance
     """
+    from askbot.search import backends as search_backends
+    search_backend = search_backends.get_backend()
+    if search_backend:
+        return search_backend.supports_relevance
     return ('postgresql_psycopg2' in askbot.get_database_engine_name())
@@ -335,6 +335,21 @@ settings.register(
     )
 )
 
+settings.register(
+    livesettings.BooleanValue(
+        FORUM_DATA_RULES,
+        'QUESTIONS_CURSOR_PAGINATION',
+        default=False,
+        description=_('Paginate question lists with cursors'),
+        help_text=_(
+            'Check to replace page numbers in the question lists '
+            'with the "previous" and "next" links. Deep pages then '
+            'load as fast as the first one, which matters on '
+            'large forums. Does not apply to the sort by relevance.'
+        )
+    )
+)
+
 settings.register(
     livesettings.StringValue(
         FORUM_DATA_RULES,
@@ -20,6 +20,33 @@ CLOSE_REASONS = (
 )
 
 LONG_TIME = 60*60*24*30 #30 days is a lot of time
+LISTING_COUNT_CACHE_TIMEOUT = 60*10 #bounds the drift of approximate counts
+#unfiltered listings of the thread tables with more rows, according to
+#the statistics of the database, show the estimated number of threads
+LISTING_COUNT_ESTIMATE_MIN_ROWS = 10000
+#relevance weights of the thread fields
+SEARCH_FIELD_BOOSTS = {'title': 3.0, 'tagnames': 2.0, 'text': 1.0}
+#ranked thread ids checked against the listing filters in one batch,
+#stays well below the limit of 999 query parameters in SQLite
+SEARCH_RANK_BATCH_SIZE = 300
+TAG_POSTINGS_CACHE_TIMEOUT = 60*60 #bounds the drift of cached tag -> threads lists
+USER_TAG_FILTER_CACHE_TIMEOUT = 60*60 #bounds the drift of compiled user tag filters
+TAG_SUBSCRIPTIONS_CACHE_TIMEOUT = 60*60 #bounds the drift of the index of tag based email subscriptions
+#seconds between the writes of the last_seen timestamp of the user,
+#can be changed with the ASKBOT_LAST_SEEN_UPDATE_INTERVAL setting
+LAST_SEEN_UPDATE_INTERVAL = 60*5
+LAST_SEEN_CACHE_TIMEOUT = 60*60*24*2 #must outlast a day for the consecutive visits
+UNSEEN_QUESTIONS_CACHE_TIMEOUT = 60*60 #bounds the drift of cached unseen activity
+#deferred question views are written to the database in batches of this size
+QUESTION_VIEW_BATCH_SIZE = 200
+QUESTION_PAGE_CACHE_TIMEOUT = 60*60*24 #cached question pages for the anonymous visitors
+#threads with this many views are served from the stale page cache while
+#one request renders the fresh page, if the stale-while-revalidate mode is on
+QUESTION_PAGE_HOT_THREAD_MIN_VIEWS = 1000
+QUESTION_PAGE_REVALIDATE_TIMEOUT = 30 #seconds to render the fresh question page
+#rendered answers on the question page, the timeout bounds
+#staleness of the author reputation and badges shown with the answer
+ANSWER_CARD_CACHE_TIMEOUT = 60*60
 DATETIME_FORMAT = '%I:%M %p, %d %b %Y'
 
 TYPE_REPUTATION = (
@@ -18,13 +18,47 @@ from django.contrib.syndication.views import Feed
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext as _
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Max
+from django.http import Http404, HttpResponse
 
 from askbot.models import Post
 from askbot.conf import settings as askbot_settings
+from askbot.utils.http import get_etag, get_not_modified_response, set_validators
 from django.utils import translation
 from django.contrib.sites.models import Site
 
-class RssIndividualQuestionFeed(Feed):
+class ConditionalFeed(Feed):
+    """feed that answers the conditional requests
+    with 304 Not Modified before generating the feed
+    """
+
+    def get_last_modified(self, obj):
+        """returns date of the newest item of the feed"""
+        raise NotImplementedError()
+
+    def __call__(self, request, *args, **kwargs):
+        try:
+            obj = self.get_object(request, *args, **kwargs)
+        except ObjectDoesNotExist:
+            raise Http404('Feed object does not exist.')
+
+        last_modified = self.get_last_modified(obj)
+        etag = get_etag(
+                    last_modified,
+                    request.get_full_path(),
+                    translation.get_language()
+                )
+        response = get_not_modified_response(request, etag, last_modified)
+        if response is not None:
+            return response
+
+        feedgen = self.get_feed(obj, request)
+        response = HttpResponse(mimetype = feedgen.mime_type)
+        feedgen.write(response, 'utf-8')
+        return set_validators(response, etag, last_modified)
+
+
+class RssIndividualQuestionFeed(ConditionalFeed):
     """rss feed class for particular questions
     """
 
@@ -39,7 +73,12 @@ class RssIndividualQuestionFeed(Feed):
 #        return askbot_settings.APP_DESCRIPTION
 
     def get_object(self, request, question_id):
-        return Post.objects.get_questions().get(id=question_id)
+        return Post.objects.get_questions().select_related(
+                                                'thread'
+                                            ).get(id=question_id)
+
+    def get_last_modified(self, item):
+        return item.thread.last_activity_at
 
     def item_link(self, item):
         """get full url to the item
@@ -93,7 +132,7 @@ class RssIndividualQuestionFeed(Feed):
         return item.text
 
 
-class RssLastestQuestionsFeed(Feed):
+class RssLastestQuestionsFeed(ConditionalFeed):
     """rss feed class for the latest questions
     """
 
@@ -140,16 +179,26 @@ class RssLastestQuestionsFeed(Feed):
         """
         return item.text
 
-    def items(self, item):
-        """get questions for the feed
+    def get_questions(self):
+        """returns all questions, which may be shown in the feed
         """
         #initial filtering
         language_code = translation.get_language()
         site = Site.objects.get_current()
-        qs = Post.objects.get_questions().filter(thread__site=site, 
+        return Post.objects.get_questions().filter(thread__site=site, 
                                                  thread__language_code=language_code, 
                                                  deleted=False)
 
+    def get_last_modified(self, item):
+        questions = self.get_questions()
+        return questions.aggregate(
+                            Max('thread__last_activity_at')
+                        )['thread__last_activity_at__max']
+
+    def items(self, item):
+        """get questions for the feed
+        """
+        qs = self.get_questions()
         return qs.order_by('-thread__last_activity_at')[:30]
 
 
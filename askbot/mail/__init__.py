@@ -100,6 +100,30 @@ def clean_html_email(email_body):
     )
     return '\n\n'.join(phrases)
 
+def build_message(
+            subject_line = None,
+            body_text = None,
+            from_email = django_settings.DEFAULT_FROM_EMAIL,
+            recipient_list = None,
+            headers = None,
+        ):
+    """returns email message with the html ``body_text``
+    and its plain text alternative, subject line is prefixed
+    """
+    body_text = absolutize_urls(body_text)
+    assert(subject_line is not None)
+    subject_line = prefix_the_subject_line(subject_line)
+    msg = mail.EmailMultiAlternatives(
+                    subject_line,
+                    clean_html_email(body_text),
+                    from_email,
+                    recipient_list,
+                    #headers are often reused by the callers for the next message
+                    headers = dict(headers or {})
+                )
+    msg.attach_alternative(body_text, "text/html")
+    return msg
+
 def send_mail(
             subject_line = None,
             body_text = None,
@@ -123,18 +147,14 @@ def send_mail(
 
     if raise_on_failure is True, exceptions.EmailNotSent is raised
     """
-    body_text = absolutize_urls(body_text)
     try:
-        assert(subject_line is not None)
-        subject_line = prefix_the_subject_line(subject_line)
-        msg = mail.EmailMultiAlternatives(
-                        subject_line,
-                        clean_html_email(body_text),
-                        from_email,
-                        recipient_list,
-                        headers = headers
-                    )
-        msg.attach_alternative(body_text, "text/html")
+        msg = build_message(
+                    subject_line = subject_line,
+                    body_text = body_text,
+                    from_email = from_email,
+                    recipient_list = recipient_list,
+                    headers = headers
+                )
         msg.send()
         logging.debug('sent update to %s' % ','.join(recipient_list))
         if related_object is not None:
@@ -144,6 +164,90 @@ def send_mail(
         if raise_on_failure == True:
             raise exceptions.EmailNotSent(unicode(error))
 
+class MessageBatch(object):
+    """collects email messages and sends them
+    over one connection to the mail backend,
+    instead of a connection per message
+
+    failure to send one message does not prevent
+    sending of the others, the failed messages are
+    collected in the ``failed`` list of (message, error) pairs,
+    as well as the sent ones whose ``on_sent`` callback failed
+    """
+    def __init__(self):
+        self.messages = list()
+        self.failed = list()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(
+            self,
+            subject_line = None,
+            body_text = None,
+            from_email = django_settings.DEFAULT_FROM_EMAIL,
+            recipient_list = None,
+            headers = None,
+            on_sent = None
+        ):
+        """adds message to the batch, parameters are the same
+        as in :func:`send_mail`, ``on_sent`` - a callable,
+        called once the message is handed to the mail backend
+        returns the message
+        """
+        msg = build_message(
+                    subject_line = subject_line,
+                    body_text = body_text,
+                    from_email = from_email,
+                    recipient_list = recipient_list,
+                    headers = headers
+                )
+        self.messages.append((msg, on_sent))
+        return msg
+
+    def send(self):
+        """sends the collected messages,
+        returns number of the messages sent
+        """
+        messages = self.messages
+        self.messages = list()
+        if not messages:
+            return 0
+
+        sent_count = 0
+        connection = mail.get_connection()
+        try:
+            for msg, on_sent in messages:
+                msg.connection = connection
+                try:
+                    #open connection stays open after sending, the backend
+                    #would close the connection if it opened one itself
+                    connection.open()
+                    msg.send()
+                except Exception, error:
+                    sys.stderr.write('\n' + unicode(error).encode('utf-8') + '\n')
+                    self.failed.append((msg, error))
+                    #the connection may be broken by the error,
+                    #a new one is opened for the next message
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                    continue
+                logging.debug('sent update to %s' % ','.join(msg.to))
+                sent_count += 1
+                if on_sent:
+                    #the message is out, failure of the callback
+                    #must not stop the rest of the batch
+                    try:
+                        on_sent()
+                    except Exception, error:
+                        sys.stderr.write('\n' + unicode(error).encode('utf-8') + '\n')
+                        self.failed.append((msg, error))
+        finally:
+            connection.close()
+        return sent_count
+
 def mail_moderators(
             subject_line = '',
             body_text = '',
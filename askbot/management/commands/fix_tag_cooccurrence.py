@@ -0,0 +1,19 @@
+"""fix_tag_cooccurrence management command
+recounts threads per pair of tags, used for the related
+tags in the sidebar, to run type (on the command line:)
+
+python manage.py fix_tag_cooccurrence
+"""
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from askbot import models
+
+class Command(NoArgsCommand):
+    """Command class for "fix_tag_cooccurrence"
+    """
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        """function that handles the command job
+        """
+        print 'Counting tags used together'
+        models.TagCooccurrence.objects.recount()
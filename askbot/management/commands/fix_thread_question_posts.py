@@ -0,0 +1,17 @@
+"""fix_thread_question_posts management command
+copies id and the deleted status of the question posts
+onto the threads, to run type (on the command line:)
+
+python manage.py fix_thread_question_posts
+"""
+from django.core.management.base import NoArgsCommand
+from askbot import models
+
+class Command(NoArgsCommand):
+    """Command class for "fix_thread_question_posts"
+    """
+    def handle_noargs(self, **options):
+        """function that handles the command job
+        """
+        print 'Denormalizing question posts on the threads'
+        models.Thread.objects.denormalize_question_posts()
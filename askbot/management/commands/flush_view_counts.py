@@ -0,0 +1,34 @@
+"""flush_view_counts management command
+writes question views counted in the cache to the database,
+together with the records of the views by the users,
+and awards the badges for the question views,
+to be run periodically when ASKBOT_DEFER_VIEW_COUNTS is on,
+the cache must be shared with the web server processes,
+for example memcached, the local memory cache will not work,
+to run type (on the command line:)
+
+python manage.py flush_view_counts
+"""
+from django.core.management.base import NoArgsCommand
+from askbot.models import Post, QuestionView, Thread
+from askbot.models.badges import award_badges_signal
+
+class Command(NoArgsCommand):
+    """Command class for "flush_view_counts"
+    """
+    def handle_noargs(self, **options):
+        QuestionView.objects.flush_pending_views()
+        increments = Thread.objects.flush_pending_views()
+        if not increments:
+            return
+
+        questions = Post.objects.filter(
+                                post_type = 'question',
+                                thread__id__in = increments.keys()
+                            ).select_related('thread')
+        for question in questions:
+            award_badges_signal.send(None,
+                            event = 'view_question',
+                            actor = None,
+                            context_object = question,
+                        )
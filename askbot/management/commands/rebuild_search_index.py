@@ -0,0 +1,22 @@
+"""rebuild_search_index management command
+rebuilds index of the configured search backend,
+to run type (on the command line:)
+
+python manage.py rebuild_search_index
+"""
+from django.core.management.base import NoArgsCommand, CommandError
+from askbot.models import Thread
+from askbot.search import backends as search_backends
+from askbot.utils.console import ProgressBar
+
+class Command(NoArgsCommand):
+    """Command class for "rebuild_search_index"
+    """
+    def handle_noargs(self, **options):
+        search_backend = search_backends.get_backend()
+        if search_backend is None:
+            raise CommandError('ASKBOT_SEARCH_BACKEND setting is not configured')
+        message = 'Rebuilding search index'
+        threads = Thread.objects.all()
+        count = threads.count()
+        search_backend.rebuild(ProgressBar(threads.iterator(), count, message))
@@ -39,6 +39,8 @@ class Command(NoArgsCommand):
         #for all users, excluding blocked
         #for each user, select a tag filtered subset
         #format the email reminder and send it
+        #reminders go over one connection to the mail server
+        batch = mail.MessageBatch()
         for user in models.User.objects.exclude(status = 'b'):
             user_questions = questions.filter(author = user)
 
@@ -78,8 +80,9 @@ class Command(NoArgsCommand):
                 print "User: %s<br>\nSubject:%s<br>\nText: %s<br>\n" % \
                     (user.email, subject_line, body_text)
             else:
-                mail.send_mail(
+                batch.add(
                     subject_line = subject_line,
                     body_text = body_text,
                     recipient_list = (user.email,)
                 )
+        batch.send()
@@ -1,10 +1,16 @@
 import datetime
+import functools
+import multiprocessing
+from collections import defaultdict
+from optparse import make_option
+from django.core import cache
 from django.core.management.base import NoArgsCommand
 from django.core.urlresolvers import reverse
 from django.db import connection
-from django.db.models import Q, F
+from django.db import transaction
 from askbot.models import User, Post, PostRevision, Thread
-from askbot.models import Activity, EmailFeedSetting
+from askbot.models import Activity, ActivityAuditStatus, EmailFeedSetting
+from askbot.models import MarkedTag, QuestionView
 from django.utils.translation import ungettext, ugettext as _
 from django.conf import settings as django_settings
 from askbot.conf import settings as askbot_settings
@@ -12,18 +18,14 @@ from django.utils.datastructures import SortedDict
 from django.contrib.contenttypes.models import ContentType
 from askbot import const
 from askbot import mail
+from askbot.utils.lists import batch_size, batches
 from askbot.utils.slug import slugify
 from userena.utils import get_profile_model
 from django.template.context import Context
 
 DEBUG_THIS_COMMAND = False
-
-def get_all_origin_posts(mentions):
-    origin_posts = set()
-    for mention in mentions:
-        post = mention.content_object
-        origin_posts.add(post.get_origin_post())
-    return list(origin_posts)
+#number of ids in the IN clauses of the digest queries
+QUERY_BATCH_SIZE = 400
 
 #todo: refactor this as class
 def extend_question_list(
@@ -74,251 +76,489 @@ def format_action_count(string, number, output):
     if number > 0:
         output.append(_(string) % {'num':number})
 
-class Command(NoArgsCommand):
-    def handle_noargs(self, **options):
-        if askbot_settings.ENABLE_EMAIL_ALERTS:
-            try:
-                try:
-                    self.send_email_alerts()
-                except Exception, e:
-                    print e
-            finally:
-                connection.close()
+class DigestData(object):
+    """question updates of a group of users,
+    retrieved with a few queries shared by the whole group
+    instead of a set of query sets per user
 
-    def get_updated_questions_for_user(self,user):
+    the digests are built in two passes - first the
+    questions are collected per user, as in the subscriptions,
+    then the news about the collected questions are loaded
+    at once and the questions without news are marked skipped
+    """
+    def __init__(self, profiles):
+        self.profile_list = list(profiles)
+        #feeds and email update records to save
+        #once the digest of the user is sent
+        self.reported_feeds = defaultdict(list)
+        self.reported_updates = defaultdict(list)
+        self.profiles = dict([(p.user_id, p) for p in profiles])
+        self.users = dict([(p.user_id, p.user) for p in profiles])
+        self.user_ids = self.users.keys()
+        self.load_feeds()
+
+        #users due to get the question updates and the time
+        #since which to look for them - the questions not seen
+        #by the user since joining may be reported, including the
+        #ones left out of the previous digests by MAX_ALERTS_PER_EMAIL
+        self.since = dict()
+        for user_id, feeds in self.feeds.items():
+            for feed in feeds:
+                if feed.feed_type != 'm_and_c' and feed.should_send_now():
+                    self.since[user_id] = self.users[user_id].date_joined
+                    break
+
+        self.load_comments()
+        self.load_mentions()
+        self.load_questions()
+        self.load_subscriptions()
+
+    def get_in_batches(self, queryset, lookup, ids):
+        """returns list of the rows of the ``queryset``,
+        filtered by ``lookup`` in the ``ids``
+        in batches of QUERY_BATCH_SIZE
         """
-        retreive relevant question updates for the user
-        according to their subscriptions and recorded question
-        views
+        rows = list()
+        for batch in batch_size(list(ids), QUERY_BATCH_SIZE):
+            rows.extend(queryset.filter(**{lookup: batch}))
+        return rows
+
+    def load_feeds(self):
+        """loads email feed settings of the users, the missing
+        ones are added with the default delivery schedules
         """
-        
-        user_feeds = EmailFeedSetting.objects.filter(subscriber=user).exclude(frequency__in=('n', 'i'))
+        from askbot import forms#need to avoid circular dependency
+        form = forms.EditUserEmailFeedsForm()
+        need_feed_types = set(form.get_db_model_subscription_type_names())
+
+        feeds = EmailFeedSetting.objects.filter(subscriber__in = self.user_ids)
+        feeds = list(feeds)
+        have_feed_types = defaultdict(set)
+        for feed in feeds:
+            have_feed_types[feed.subscriber_id].add(feed.feed_type)
+        missing = False
+        for user_id, profile in self.profiles.items():
+            if need_feed_types - have_feed_types[user_id]:
+                profile.add_missing_askbot_subscriptions()
+                missing = True
+        if missing:
+            feeds = EmailFeedSetting.objects.filter(
+                                        subscriber__in = self.user_ids
+                                    )
 
-        should_proceed = False
-        for feed in user_feeds:
-            if feed.should_send_now() == True:
-                should_proceed = True
-                break
+        self.feeds = defaultdict(list)
+        for feed in feeds:
+            if feed.frequency in ('n', 'i'):
+                continue
+            feed.subscriber = self.users[feed.subscriber_id]
+            self.feeds[feed.subscriber_id].append(feed)
+
+    def get_latest_cutoff_time(self, feed_type):
+        """returns latest previous report cutoff time
+        of the feeds of given type, or None"""
+        cutoff_time = None
+        for feeds in self.feeds.values():
+            for feed in feeds:
+                if feed.feed_type == feed_type:
+                    feed_cutoff_time = feed.get_previous_report_cutoff_time()
+                    if cutoff_time is None or feed_cutoff_time > cutoff_time:
+                        cutoff_time = feed_cutoff_time
+        return cutoff_time
+
+    def load_comments(self):
+        """comments left by others on the posts of the users,
+        per user id - list of (thread id, author id, time)
+        in the order of posting"""
+        self.comments = defaultdict(list)
+        cutoff_time = self.get_latest_cutoff_time('m_and_c')
+        if cutoff_time is None:
+            return
+        comments = Post.objects.get_comments().filter(
+                                            added_at__lt = cutoff_time
+                                        ).values_list(
+                                            'id', 'parent__author',
+                                            'thread', 'author', 'added_at'
+                                        )
+        rows = self.get_in_batches(comments, 'parent__author__in', self.user_ids)
+        rows.sort()
+        for comment_id, user_id, thread_id, author_id, added_at in rows:
+            if thread_id is not None:
+                self.comments[user_id].append((thread_id, author_id, added_at))
+
+    def load_mentions(self):
+        """mentions of the users, per user id -
+        list of (thread id, time)"""
+        self.mentions = defaultdict(list)
+        cutoff_time = self.get_latest_cutoff_time('m_and_c')
+        if cutoff_time is None:
+            return
+        mentions = ActivityAuditStatus.objects.filter(
+                            activity__activity_type = const.TYPE_ACTIVITY_MENTION,
+                            activity__active_at__lt = cutoff_time
+                        ).values_list(
+                            'user', 'activity__object_id', 'activity__active_at'
+                        )
+        rows = self.get_in_batches(mentions, 'user__in', self.user_ids)
+
+        #mentions are recorded on the posts, map them to the threads
+        post_ids = set([post_id for user_id, post_id, mentioned_at in rows])
+        posts = Post.objects.values_list('id', 'thread')
+        post_threads = dict(self.get_in_batches(posts, 'id__in', post_ids))
+        for user_id, post_id, mentioned_at in rows:
+            thread_id = post_threads.get(post_id)
+            if thread_id is not None:
+                self.mentions[user_id].append((thread_id, mentioned_at))
+
+    def load_questions(self):
+        """loads questions of the threads, active since the earliest
+        of the users due to get the question updates has joined, and
+        of the threads with the comments and mentions,
+        ordered by time of the latest activity
+        """
+        questions = Post.objects.get_questions().select_related('thread')
+        if self.since:
+            since = min(self.since.values())
+            questions_by_id = dict([
+                (q.id, q) for q in questions.filter(
+                                        thread__last_activity_at__gte = since
+                                    )
+            ])
+        else:
+            questions_by_id = dict()
+
+        thread_ids = set()
+        for comments in self.comments.values():
+            thread_ids.update([thread_id for thread_id, a, t in comments])
+        for mentions in self.mentions.values():
+            thread_ids.update([thread_id for thread_id, t in mentions])
+        thread_ids -= set([q.thread_id for q in questions_by_id.values()])
+        for q in self.get_in_batches(questions, 'thread__in', thread_ids):
+            questions_by_id[q.id] = q
+
+        self.questions = sorted(questions_by_id.values(), key = lambda q: q.id)
+        self.questions.sort(
+                    key = lambda q: q.thread.last_activity_at,
+                    reverse = True
+                )
+        self.thread_questions = dict([(q.thread_id, q) for q in self.questions])
+
+    def load_subscriptions(self):
+        """loads the question views, followed threads,
+        answers and tag selections of the users and
+        the tags of the threads"""
+        question_ids = [q.id for q in self.questions]
+        thread_ids = self.thread_questions.keys()
+
+        self.views = defaultdict(list)
+        views = QuestionView.objects.filter(
+                                    who__in = self.user_ids
+                                ).values_list('who', 'question', 'when')
+        for user_id, question_id, when in self.get_in_batches(
+                                        views, 'question__in', question_ids
+                                    ):
+            self.views[(user_id, question_id)].append(when)
+
+        self.followed = defaultdict(set)
+        follows = Thread.followed_by.through.objects.filter(
+                                    user__in = self.user_ids
+                                ).values_list('user', 'thread')
+        for user_id, thread_id in self.get_in_batches(
+                                        follows, 'thread__in', thread_ids
+                                    ):
+            self.followed[user_id].add(thread_id)
+
+        #number of answers per user and thread, including deleted ones
+        self.answer_counts = defaultdict(int)
+        answers = Post.objects.get_answers().filter(
+                                    author__in = self.user_ids
+                                ).values_list('author', 'thread')
+        for user_id, thread_id in self.get_in_batches(
+                                        answers, 'thread__in', thread_ids
+                                    ):
+            self.answer_counts[(user_id, thread_id)] += 1
+
+        self.thread_tags = defaultdict(list)
+        tags = Thread.tags.through.objects.values_list(
+                                                'thread', 'tag', 'tag__name'
+                                            )
+        for thread_id, tag_id, tag_name in self.get_in_batches(
+                                        tags, 'thread__in', thread_ids
+                                    ):
+            self.thread_tags[thread_id].append((tag_id, tag_name))
+
+        self.marked_tags = defaultdict(set)
+        marks = MarkedTag.objects.filter(
+                                user__in = self.user_ids
+                            ).values_list('user', 'reason', 'tag')
+        for user_id, reason, tag_id in marks:
+            self.marked_tags[(user_id, reason)].add(tag_id)
+
+    def get_tag_filtered_questions(self, user, questions):
+        """same as ``get_tag_filtered_questions`` of the user profile,
+        works on a list of questions"""
+        profile = self.profiles[user.id]
+        strategy = profile.email_tag_filter_strategy
+        if strategy == const.EXCLUDE_IGNORED:
+            tag_ids = self.marked_tags[(user.id, 'bad')]
+            wildcards = profile.ignored_tags.strip().split()
+        elif strategy == const.INCLUDE_INTERESTING:
+            if askbot_settings.SUBSCRIBED_TAG_SELECTOR_ENABLED:
+                tag_ids = self.marked_tags[(user.id, 'subscribed')]
+                wildcards = profile.subscribed_tags.strip().split()
+            else:
+                tag_ids = self.marked_tags[(user.id, 'good')]
+                wildcards = profile.interesting_tags.strip().split()
+        else:
+            return questions
+
+        prefixes = tuple([wildcard[:-1] for wildcard in wildcards])
+        def is_selected(question):
+            for tag_id, tag_name in self.thread_tags[question.thread_id]:
+                if tag_id in tag_ids:
+                    return True
+                if prefixes and tag_name.startswith(prefixes):
+                    return True
+            return False
+
+        if strategy == const.EXCLUDE_IGNORED:
+            return [q for q in questions if not is_selected(q)]
+        else:
+            return [q for q in questions if is_selected(q)]
+
+    def get_question_sets(self, user):
+        """returns two lists of questions that
+        the user may be notified about - not seen at all
+        and seen before the latest activity in the thread"""
+        not_seen = list()
+        seen_before_last_mod = list()
+        for q in self.questions:
+            thread = q.thread
+            #basic things - not deleted, not closed, not too old
+            #not last edited by the same user
+            if thread.last_activity_by_id == user.id \
+                or thread.last_activity_at < user.date_joined \
+                or q.deleted or thread.closed:
+                continue
+            if askbot_settings.ENABLE_CONTENT_MODERATION and not q.approved:
+                continue
+            views = self.views.get((user.id, q.id))
+            if views is None:
+                not_seen.append(q)
+            elif min(views) < thread.last_activity_at:
+                seen_before_last_mod.append(q)
+        return not_seen, seen_before_last_mod
+
+    def get_updated_questions_for_user(self, user):
+        """
+        collect relevant question updates for the user
+        according to their subscriptions and recorded question
+        views, returns an ordered dictionary question -> meta data
+        """
+        user_feeds = self.feeds.get(user.id, ())
 
         #shortcircuit - if there is no ripe feed to work on for this user
-        if should_proceed == False:
+        if not [feed for feed in user_feeds if feed.should_send_now()]:
             return {}
 
-        #these are placeholders for separate query sets per question group
+        #placeholders for separate lists per question group
         #there are four groups - one for each EmailFeedSetting.feed_type
-        #and each group has subtypes A and B
-        #that's because of the strange thing commented below
-        #see note on Q and F objects marked with todo tag
-        q_sel_A = None
-        q_sel_B = None
-
-        q_ask_A = None
-        q_ask_B = None
-
-        q_ans_A = None
-        q_ans_B = None
-
-        q_all_A = None
-        q_all_B = None
-
-        #base question query set for this user
-        #basic things - not deleted, not closed, not too old
-        #not last edited by the same user
-        base_qs = Post.objects.get_questions().exclude(thread__last_activity_by=user)\
-                                              .exclude(thread__last_activity_at__lt=user.date_joined)\
-                                              .exclude(deleted=True)\
-                                              .exclude(thread__closed=True)\
-                                              .order_by('-thread__last_activity_at')\
-
-        if askbot_settings.ENABLE_CONTENT_MODERATION:
-            base_qs = base_qs.filter(approved = True)
-        #todo: for some reason filter on did not work as expected ~Q(viewed__who=user) | 
-        #      Q(viewed__who=user,viewed__when__lt=F('thread__last_activity_at'))
-        #returns way more questions than you might think it should
-        #so because of that I've created separate query sets Q_set2 and Q_set3
-        #plus two separate queries run faster!
-
-        #build two two queries based
-
-        #questions that are not seen by the user at all
-        not_seen_qs = base_qs.filter(~Q(viewed__who=user))
-        #questions that were seen, but before last modification
-        seen_before_last_mod_qs = base_qs.filter(
-                                    Q(
-                                        viewed__who=user,
-                                        viewed__when__lt=F('thread__last_activity_at')
-                                    )
-                                )
+        #and each group has subtypes A and B - questions not seen
+        #at all and seen before the latest modification
+        q_sel_A = q_sel_B = None
+        q_ask_A = q_ask_B = None
+        q_ans_A = q_ans_B = None
+        q_all_A = q_all_B = None
 
-        #shorten variables for convenience
-        Q_set_A = not_seen_qs
-        Q_set_B = seen_before_last_mod_qs
+        Q_set_A, Q_set_B = self.get_question_sets(user)
 
+        max_alerts = askbot_settings.MAX_ALERTS_PER_EMAIL
+        m_and_c_feed = None
         for feed in user_feeds:
             if feed.feed_type == 'm_and_c':
                 #alerts on mentions and comments are processed separately
                 #because comments to questions do not trigger change of last_updated
-                #this may be changed in the future though, see
-                #http://askbot.org/en/question/96/
+                m_and_c_feed = feed
                 continue
 
-            #each group of updates represented by the corresponding
-            #query set has it's own cutoff time
-            #that cutoff time is computed for each user individually
-            #and stored as a parameter "cutoff_time"
-
             #we won't send email for a given question if an email has been
             #sent after that cutoff_time
             if feed.should_send_now():
-                if DEBUG_THIS_COMMAND == False:
-                    feed.mark_reported_now()
-                cutoff_time = feed.get_previous_report_cutoff_time() 
+                self.reported_feeds[user.id].append(feed)
+                cutoff_time = feed.get_previous_report_cutoff_time()
 
                 if feed.feed_type == 'q_sel':
-                    q_sel_A = Q_set_A.filter(thread__followed_by=user)
-                    q_sel_A.cutoff_time = cutoff_time #store cutoff time per query set
-                    q_sel_B = Q_set_B.filter(thread__followed_by=user)
-                    q_sel_B.cutoff_time = cutoff_time #store cutoff time per query set
+                    followed = self.followed[user.id]
+                    q_sel_A = [q for q in Q_set_A if q.thread_id in followed]
+                    q_sel_B = [q for q in Q_set_B if q.thread_id in followed]
+                    q_sel_cutoff_time = cutoff_time
 
                 elif feed.feed_type == 'q_ask':
-                    q_ask_A = Q_set_A.filter(author=user)
-                    q_ask_A.cutoff_time = cutoff_time
-                    q_ask_B = Q_set_B.filter(author=user)
-                    q_ask_B.cutoff_time = cutoff_time
+                    q_ask_A = [q for q in Q_set_A if q.author_id == user.id]
+                    q_ask_B = [q for q in Q_set_B if q.author_id == user.id]
+                    q_ask_cutoff_time = cutoff_time
 
                 elif feed.feed_type == 'q_ans':
-                    q_ans_A = Q_set_A.filter(thread__posts__author=user, thread__posts__post_type='answer')
-                    q_ans_A = q_ans_A[:askbot_settings.MAX_ALERTS_PER_EMAIL]
-                    q_ans_A.cutoff_time = cutoff_time
-
-                    q_ans_B = Q_set_B.filter(thread__posts__author=user, thread__posts__post_type='answer')
-                    q_ans_B = q_ans_B[:askbot_settings.MAX_ALERTS_PER_EMAIL]
-                    q_ans_B.cutoff_time = cutoff_time
+                    #question is repeated per answer of the user,
+                    #as in the join of the threads with the answers
+                    q_ans_A = list()
+                    for q in Q_set_A:
+                        q_ans_A.extend([q] * self.answer_counts[(user.id, q.thread_id)])
+                    q_ans_A = q_ans_A[:max_alerts]
+                    q_ans_B = list()
+                    for q in Q_set_B:
+                        q_ans_B.extend([q] * self.answer_counts[(user.id, q.thread_id)])
+                    q_ans_B = q_ans_B[:max_alerts]
+                    q_ans_cutoff_time = cutoff_time
 
                 elif feed.feed_type == 'q_all':
-                    q_all_A = user.get_profile().get_tag_filtered_questions(Q_set_A)
-                    q_all_B = user.get_profile().get_tag_filtered_questions(Q_set_B)
-
-                    q_all_A = q_all_A[:askbot_settings.MAX_ALERTS_PER_EMAIL]
-                    q_all_B = q_all_B[:askbot_settings.MAX_ALERTS_PER_EMAIL]
-                    q_all_A.cutoff_time = cutoff_time
-                    q_all_B.cutoff_time = cutoff_time
+                    q_all_A = self.get_tag_filtered_questions(user, Q_set_A)
+                    q_all_B = self.get_tag_filtered_questions(user, Q_set_B)
+                    q_all_A = q_all_A[:max_alerts]
+                    q_all_B = q_all_B[:max_alerts]
+                    q_all_cutoff_time = cutoff_time
 
         #build ordered list questions for the email report
         q_list = SortedDict()
 
-        #todo: refactor q_list into a separate class?
-        extend_question_list(q_sel_A, q_list)
-        extend_question_list(q_sel_B, q_list)
+        if q_sel_A is not None:
+            extend_question_list(q_sel_A, q_list, cutoff_time = q_sel_cutoff_time)
+            extend_question_list(q_sel_B, q_list, cutoff_time = q_sel_cutoff_time)
 
         #build list of comment and mention responses here
         #it is separate because posts are not marked as changed
         #when people add comments
-        #mention responses could be collected in the loop above, but
-        #it is inconvenient, because feed_type m_and_c bundles the two
-        #also we collect metadata for these here
-        try:
-            feed = user_feeds.get(feed_type='m_and_c')
-            if feed.should_send_now():
-                cutoff_time = feed.get_previous_report_cutoff_time()
-                comments = Post.objects.get_comments().filter(
-                                            added_at__lt = cutoff_time,
-                                        ).exclude(
-                                            author = user
-                                        )
-                q_commented = list() 
-                for c in comments:
-                    post = c.parent
-                    if post.author != user:
-                        continue
-
-                    #skip is post was seen by the user after
-                    #the comment posting time
-                    q_commented.append(post.get_origin_post())
-
-                extend_question_list(
-                                q_commented,
-                                q_list,
-                                cutoff_time = cutoff_time,
-                                add_comment = True
-                            )
-
-                mentions = Activity.objects.get_mentions(
-                                                    mentioned_at__lt = cutoff_time,
-                                                    mentioned_whom = user
-                                                )
-
-                #print 'have %d mentions' % len(mentions)
-                #MM = Activity.objects.filter(activity_type = const.TYPE_ACTIVITY_MENTION)
-                #print 'have %d total mentions' % len(MM)
-                #for m in MM:
-                #    print m
-
-                mention_posts = get_all_origin_posts(mentions)
-                q_mentions_id = [q.id for q in mention_posts]
-
-                q_mentions_A = Q_set_A.filter(id__in = q_mentions_id)
-                q_mentions_A.cutoff_time = cutoff_time
-                extend_question_list(q_mentions_A, q_list, add_mention=True)
-
-                q_mentions_B = Q_set_B.filter(id__in = q_mentions_id)
-                q_mentions_B.cutoff_time = cutoff_time
-                extend_question_list(q_mentions_B, q_list, add_mention=True)
-        except EmailFeedSetting.DoesNotExist:
-            pass
+        if m_and_c_feed and m_and_c_feed.should_send_now():
+            cutoff_time = m_and_c_feed.get_previous_report_cutoff_time()
+            q_commented = list()
+            for thread_id, author_id, added_at in self.comments[user.id]:
+                if added_at < cutoff_time and author_id != user.id:
+                    question = self.thread_questions.get(thread_id)
+                    if question is not None:
+                        q_commented.append(question)
+
+            extend_question_list(
+                            q_commented,
+                            q_list,
+                            cutoff_time = cutoff_time,
+                            add_comment = True
+                        )
+
+            mentioned_thread_ids = set()
+            for thread_id, mentioned_at in self.mentions[user.id]:
+                if mentioned_at < cutoff_time:
+                    mentioned_thread_ids.add(thread_id)
+
+            q_mentions_A = [q for q in Q_set_A if q.thread_id in mentioned_thread_ids]
+            extend_question_list(
+                            q_mentions_A, q_list,
+                            cutoff_time = cutoff_time, add_mention = True
+                        )
+            q_mentions_B = [q for q in Q_set_B if q.thread_id in mentioned_thread_ids]
+            extend_question_list(
+                            q_mentions_B, q_list,
+                            cutoff_time = cutoff_time, add_mention = True
+                        )
+
+        strategy = self.profiles[user.id].email_tag_filter_strategy
+        if strategy == const.INCLUDE_INTERESTING and q_all_A is not None:
+            extend_question_list(q_all_A, q_list, cutoff_time = q_all_cutoff_time)
+            extend_question_list(q_all_B, q_list, cutoff_time = q_all_cutoff_time)
+
+        if q_ask_A is not None:
+            extend_question_list(
+                    q_ask_A, q_list, cutoff_time = q_ask_cutoff_time, limit = True
+                )
+            extend_question_list(
+                    q_ask_B, q_list, cutoff_time = q_ask_cutoff_time, limit = True
+                )
 
-        if user.get_profile().email_tag_filter_strategy == const.INCLUDE_INTERESTING:
-            extend_question_list(q_all_A, q_list)
-            extend_question_list(q_all_B, q_list)
+        if q_ans_A is not None:
+            extend_question_list(
+                    q_ans_A, q_list, cutoff_time = q_ans_cutoff_time, limit = True
+                )
+            extend_question_list(
+                    q_ans_B, q_list, cutoff_time = q_ans_cutoff_time, limit = True
+                )
 
-        extend_question_list(q_ask_A, q_list, limit=True)
-        extend_question_list(q_ask_B, q_list, limit=True)
+        if strategy == const.EXCLUDE_IGNORED and q_all_A is not None:
+            extend_question_list(
+                    q_all_A, q_list, cutoff_time = q_all_cutoff_time, limit = True
+                )
+            extend_question_list(
+                    q_all_B, q_list, cutoff_time = q_all_cutoff_time, limit = True
+                )
 
-        extend_question_list(q_ans_A, q_list, limit=True)
-        extend_question_list(q_ans_B, q_list, limit=True)
+        return q_list
 
-        if user.get_profile().email_tag_filter_strategy == const.EXCLUDE_IGNORED:
-            extend_question_list(q_all_A, q_list, limit=True)
-            extend_question_list(q_all_B, q_list, limit=True)
+    def load_news(self, q_lists):
+        """loads the email update records, revisions and answers
+        of the questions collected into ``q_lists`` -
+        a dictionary user id -> question list"""
+        question_ids = set()
+        thread_ids = set()
+        for q_list in q_lists.values():
+            question_ids.update([q.id for q in q_list.keys()])
+            thread_ids.update([q.thread_id for q in q_list.keys()])
 
         ctype = ContentType.objects.get_for_model(Post)
-        EMAIL_UPDATE_ACTIVITY = const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT
-
-        #up to this point we still don't know if emails about
-        #collected questions were sent recently
-        #the next loop examines activity record and decides
-        #for each question, whether it needs to be included or not
-        #into the report
+        self.email_updates = defaultdict(list)
+        updates = Activity.objects.filter(
+                            user__in = self.user_ids,
+                            content_type = ctype,
+                            activity_type = const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT
+                        )
+        for update in self.get_in_batches(updates, 'object_id__in', question_ids):
+            self.email_updates[(update.user_id, update.object_id)].append(update)
+
+        #revisions per thread, question revisions of the same
+        #post go in descending order of the revision number
+        self.revisions = defaultdict(list)
+        revisions = PostRevision.objects.order_by(
+                                '-revision'
+                            ).values_list(
+                                'post', 'post__thread', 'post__deleted',
+                                'revision_type', 'author', 'revised_at'
+                            )
+        for post_id, thread_id, deleted, revision_type, author_id, revised_at \
+            in self.get_in_batches(revisions, 'post__thread__in', thread_ids):
+            self.revisions[thread_id].append(
+                    (post_id, deleted, revision_type, author_id, revised_at)
+                )
 
+        self.answers = defaultdict(list)
+        answers = Post.objects.get_answers().filter(
+                                        deleted = False
+                                    ).values_list('thread', 'author', 'added_at')
+        for thread_id, author_id, added_at in self.get_in_batches(
+                                            answers, 'thread__in', thread_ids
+                                        ):
+            self.answers[thread_id].append((author_id, added_at))
+
+    def mark_news(self, user, q_list):
+        """edits meta_data for each question in the ``q_list``
+        so that user will receive counts on new edits new answers, etc
+        and marks questions that need to be skipped
+        because an email about them was sent recently enough
+
+        also keeps a record of latest email activity per question per user
+        """
         for q, meta_data in q_list.items():
-            #this loop edits meta_data for each question
-            #so that user will receive counts on new edits new answers, etc
-            #and marks questions that need to be skipped
-            #because an email about them was sent recently enough
-
-            #also it keeps a record of latest email activity per question per user
-            try:
-                #todo: is it possible to use content_object here, instead of
-                #content type and object_id pair?
-                update_info = Activity.objects.get(
-                                            user=user,
-                                            content_type=ctype,
-                                            object_id=q.id,
-                                            activity_type=EMAIL_UPDATE_ACTIVITY
-                                        )
-                emailed_at = update_info.active_at
-            except Activity.DoesNotExist:
-                update_info = Activity(
-                                        user=user, 
-                                        content_object=q, 
-                                        activity_type=EMAIL_UPDATE_ACTIVITY
-                                    )
-                emailed_at = datetime.datetime(1970, 1, 1)#long time ago
-            except Activity.MultipleObjectsReturned:
+            updates = self.email_updates.get((user.id, q.id), ())
+            if len(updates) > 1:
                 raise Exception(
                                 'server error - multiple question email activities '
                                 'found per user-question pair'
                                 )
+            elif updates:
+                update_info = updates[0]
+                emailed_at = update_info.active_at
+            else:
+                update_info = Activity(
+                                        user=user,
+                                        content_object=q,
+                                        activity_type=const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT
+                                    )
+                emailed_at = datetime.datetime(1970, 1, 1)#long time ago
 
             cutoff_time = meta_data['cutoff_time']#cutoff time for the question
 
@@ -331,141 +571,235 @@ class Command(NoArgsCommand):
 
             #collect info on all sorts of news that happened after
             #the most recent emailing to the user about this question
-            q_rev = PostRevision.objects.question_revisions().filter(
-                                                post=q,
-                                                revised_at__gt=emailed_at
-                                            )
-
-            q_rev = q_rev.exclude(author=user)
+            q_rev = list()
+            ans_rev = 0
+            for post_id, deleted, revision_type, author_id, revised_at \
+                in self.revisions[q.thread_id]:
+                if revised_at <= emailed_at or author_id == user.id:
+                    continue
+                if revision_type == PostRevision.QUESTION_REVISION:
+                    if post_id == q.id:
+                        q_rev.append(revised_at)
+                elif revision_type == PostRevision.ANSWER_REVISION:
+                    if not deleted:
+                        ans_rev += 1
 
             #now update all sorts of metadata per question
             meta_data['q_rev'] = len(q_rev)
-            if len(q_rev) > 0 and q.added_at == q_rev[0].revised_at:
+            if len(q_rev) > 0 and q.added_at == q_rev[0]:
                 meta_data['q_rev'] = 0
                 meta_data['new_q'] = True
             else:
                 meta_data['new_q'] = False
-                
-            new_ans = Post.objects.get_answers().filter(
-                                            thread=q.thread,
-                                            added_at__gt=emailed_at,
-                                            deleted=False,
-                                        )
-
-            new_ans = new_ans.exclude(author=user)
-            meta_data['new_ans'] = len(new_ans)
-            ans_rev = PostRevision.objects.answer_revisions().filter(
-                                            # answer__question = q
-                                            post__thread=q.thread,
 
-                                            post__deleted = False,
-                                            revised_at__gt = emailed_at
-                                        ).distinct()
-            ans_rev = ans_rev.exclude(author=user)
-            meta_data['ans_rev'] = len(ans_rev)
+            new_ans = 0
+            for author_id, added_at in self.answers[q.thread_id]:
+                if added_at > emailed_at and author_id != user.id:
+                    new_ans += 1
+            meta_data['new_ans'] = new_ans
+            meta_data['ans_rev'] = ans_rev
 
             comments = meta_data.get('comments', 0)
             mentions = meta_data.get('mentions', 0)
 
-            #print meta_data
             #finally skip question if there are no news indeed
-            if len(q_rev) + len(new_ans) + len(ans_rev) + comments + mentions == 0:
+            if len(q_rev) + new_ans + ans_rev + comments + mentions == 0:
                 meta_data['skip'] = True
-                #print 'skipping'
             else:
                 meta_data['skip'] = False
-                #print 'not skipping'
-                update_info.active_at = datetime.datetime.now() 
-                if DEBUG_THIS_COMMAND == False:
-                    update_info.save() #save question email update activity 
-        #q_list is actually an ordered dictionary
-        #print 'user %s gets %d' % (user.username, len(q_list.keys()))
-        #todo: sort question list by update time
-        return q_list 
-
-    def send_email_alerts(self):
-        #does not change the database, only sends the email
-        for profile in get_profile_model().objects.all():
-            profile.add_missing_askbot_subscriptions()
-            #todo: q_list is a dictionary, not a list
-            q_list = self.get_updated_questions_for_user(profile.user)
-            print q_list
-            if len(q_list.keys()) == 0:
-                continue
-            num_q = 0
-            for question, meta_data in q_list.items():
+                update_info.active_at = datetime.datetime.now()
+                self.reported_updates[user.id].append(update_info)
+
+    @transaction.commit_on_success
+    def mark_reported(self, user):
+        """saves the question email update activities and
+        the report times of the feeds of the user, to be called
+        after the digest is handed to the mail backend, so that
+        a run interrupted midway can be repeated without
+        sending the same digests twice
+        """
+        updates = self.reported_updates.pop(user.id, ())
+        feeds = self.reported_feeds.pop(user.id, ())
+        if DEBUG_THIS_COMMAND == True:
+            return
+        for update_info in updates:
+            update_info.save() #save question email update activity
+        for feed in feeds:
+            feed.mark_reported_now()
+
+    def get_digests(self):
+        """returns list of (profile, question list) pairs"""
+        q_lists = dict()
+        for profile in self.profile_list:
+            q_lists[profile.user_id] = self.get_updated_questions_for_user(
+                                                                profile.user
+                                                            )
+        self.load_news(q_lists)
+        digests = list()
+        for profile in self.profile_list:
+            q_list = q_lists[profile.user_id]
+            self.mark_news(profile.user, q_list)
+            digests.append((profile, q_list))
+        return digests
+
+def send_shard(user_ids):
+    """sends the digests to a shard of the users,
+    runs in a worker process"""
+    try:
+        Command().send_shard(user_ids)
+    finally:
+        connection.close()
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', action='store', type='int', dest='workers',
+            default=getattr(django_settings, 'ASKBOT_EMAIL_DIGEST_WORKERS', 1),
+            help='Number of processes sending the digests.'),
+    )
+
+    def handle_noargs(self, **options):
+        if askbot_settings.ENABLE_EMAIL_ALERTS:
+            try:
+                try:
+                    self.send_email_alerts(workers = options.get('workers', 1))
+                except Exception, e:
+                    print e
+            finally:
+                connection.close()
+
+    def send_email_alerts(self, workers = 1):
+        """sends the digests, users are split into shards
+        processed by the pool of ``workers`` processes
+
+        the report times of the feeds are saved per user as the digests
+        are sent and mark the progress of the shards: if a run is interrupted,
+        the next one picks up the users whose digests were not sent yet
+        """
+        user_ids = get_profile_model().objects.order_by(
+                                                    'user'
+                                                ).values_list('user', flat = True)
+        user_ids = list(user_ids)
+        #a single batch of users is not worth starting the processes
+        if workers <= 1 or len(user_ids) <= QUERY_BATCH_SIZE:
+            self.send_shard(user_ids)
+            return
+
+        shards = [shard for shard in batches(user_ids, workers) if shard]
+        #worker processes must open their own connections to the database
+        #and to the cache server, sockets of the parent, that has read
+        #the settings through the cache, must not be shared by the forks
+        connection.close()
+        if hasattr(cache.cache, 'close'):
+            cache.cache.close()
+        pool = multiprocessing.Pool(workers)
+        try:
+            pool.map(send_shard, shards, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def send_shard(self, user_ids):
+        """sends the digests to the users with the given ids"""
+        for batch in batch_size(user_ids, QUERY_BATCH_SIZE):
+            profiles = get_profile_model().objects.filter(
+                                                user__in = batch
+                                            ).select_related(
+                                                'user'
+                                            ).order_by('user')
+            digest_data = DigestData(profiles)
+            #digests of the batch go over one connection to the mail server,
+            #the digests that the backend did not take are not marked reported
+            #and will be tried again by the next run
+            batch = mail.MessageBatch()
+            for profile, q_list in digest_data.get_digests():
+                on_sent = functools.partial(digest_data.mark_reported, profile.user)
+                if self.add_digest(batch, profile, q_list, on_sent) is None:
+                    on_sent()
+            batch.send()
+
+    def add_digest(self, batch, profile, q_list, on_sent = None):
+        """adds the digest of the updated questions for the user
+        to the message ``batch``, returns the message or ``None``
+        if there is nothing to send"""
+        #todo: q_list is a dictionary, not a list
+        if len(q_list.keys()) == 0:
+            return None
+        num_q = 0
+        for question, meta_data in q_list.items():
+            if meta_data['skip']:
+                del q_list[question]
+            else:
+                num_q += 1
+        if num_q > 0:
+            url_prefix = askbot_settings.APP_URL
+
+            threads = [qq.thread for qq in q_list.keys()]
+            tag_summary = Thread.objects.get_tag_summary_from_threads(threads)
+
+            question_count = len(q_list.keys())
+
+            subject_line = ungettext(
+                '%(question_count)d updated question about %(topics)s',
+                '%(question_count)d updated questions about %(topics)s',
+                question_count
+            ) % {
+                'question_count': question_count,
+                'topics': tag_summary
+            }
+
+            context = {
+                'num':num_q,
+                'name':profile.user.username,
+                'sitename': askbot_settings.APP_SHORT_NAME
+            }
+
+            items_added = 0
+            items_unreported = 0
+            context["action_list"] = ""
+            for q, meta_data in q_list.items():
+                act_list = []
                 if meta_data['skip']:
-                    del q_list[question]
+                    continue
+                if items_added >= askbot_settings.MAX_ALERTS_PER_EMAIL:
+                    items_unreported = num_q - items_added #may be inaccurate actually, but it's ok
+                    
                 else:
-                    num_q += 1
-            if num_q > 0:
-                url_prefix = askbot_settings.APP_URL
-
-                threads = Thread.objects.filter(id__in=[qq.thread_id for qq in q_list.keys()])
-                tag_summary = Thread.objects.get_tag_summary_from_threads(threads)
-
-                question_count = len(q_list.keys())
-
-                subject_line = ungettext(
-                    '%(question_count)d updated question about %(topics)s',
-                    '%(question_count)d updated questions about %(topics)s',
-                    question_count
-                ) % {
-                    'question_count': question_count,
-                    'topics': tag_summary
-                }
-
-                context = {
-                    'num':num_q,
-                    'name':profile.user.username,
-                    'sitename': askbot_settings.APP_SHORT_NAME
-                }
-
-                items_added = 0
-                items_unreported = 0
-                context["action_list"] = ""
-                for q, meta_data in q_list.items():
-                    act_list = []
-                    if meta_data['skip']:
-                        continue
-                    if items_added >= askbot_settings.MAX_ALERTS_PER_EMAIL:
-                        items_unreported = num_q - items_added #may be inaccurate actually, but it's ok
-                        
-                    else:
-                        items_added += 1
-                        if meta_data['new_q']:
-                            act_list.append(_('new question'))
-                        format_action_count('%(num)d rev', meta_data['q_rev'],act_list)
-                        format_action_count('%(num)d ans', meta_data['new_ans'],act_list)
-                        format_action_count('%(num)d ans rev',meta_data['ans_rev'],act_list)
-                        act_token = ', '.join(act_list)
-                        context["action_list"] += '<li><a href="%s?sort=latest">%s</a> <font color="#777777">(%s)</font></li>' \
-                                    % (url_prefix + q.get_absolute_url(), q.thread.title, act_token)
-                 
-                link = url_prefix + reverse(
-                                        'user_subscriptions', 
-                                        kwargs = {
-                                            'id': profile.user.id,
-                                            'slug': slugify(profile.user.username)
-                                        }
-                                    )
+                    items_added += 1
+                    if meta_data['new_q']:
+                        act_list.append(_('new question'))
+                    format_action_count('%(num)d rev', meta_data['q_rev'],act_list)
+                    format_action_count('%(num)d ans', meta_data['new_ans'],act_list)
+                    format_action_count('%(num)d ans rev',meta_data['ans_rev'],act_list)
+                    act_token = ', '.join(act_list)
+                    context["action_list"] += '<li><a href="%s?sort=latest">%s</a> <font color="#777777">(%s)</font></li>' \
+                                % (url_prefix + q.get_absolute_url(), q.thread.title, act_token)
+             
+            link = url_prefix + reverse(
+                                    'user_subscriptions', 
+                                    kwargs = {
+                                        'id': profile.user.id,
+                                        'slug': slugify(profile.user.username)
+                                    }
+                                )
 
-                context.update({
-                    'email_settings_link': link,
-                    'admin_email': django_settings.ADMINS[0][1],
-                    'sitename': askbot_settings.APP_SHORT_NAME
-                })
-                
-                if DEBUG_THIS_COMMAND == True:
-                    recipient_email = django_settings.ADMINS[0][1]
-                else:
-                    recipient_email = profile.user.email
-
-                from askbot.skins.loaders import get_template
-                template = get_template('digest_notification.html')
-                
-                mail.send_mail(
-                    subject_line = subject_line,
-                    body_text = template.render(Context(context)),
-                    recipient_list = [recipient_email]
-                )
+            context.update({
+                'email_settings_link': link,
+                'admin_email': django_settings.ADMINS[0][1],
+                'sitename': askbot_settings.APP_SHORT_NAME
+            })
+            
+            if DEBUG_THIS_COMMAND == True:
+                recipient_email = django_settings.ADMINS[0][1]
+            else:
+                recipient_email = profile.user.email
+
+            from askbot.skins.loaders import get_template
+            template = get_template('digest_notification.html')
+            
+            return batch.add(
+                subject_line = subject_line,
+                body_text = template.render(Context(context)),
+                recipient_list = [recipient_email],
+                on_sent = on_sent
+            )
+        return None
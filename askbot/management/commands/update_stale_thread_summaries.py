@@ -0,0 +1,30 @@
+"""update_stale_thread_summaries management command
+renders summaries of the threads, which were marked stale
+or are otherwise missing in the cache, so that the listings
+do not have to render them, can be run periodically,
+to run type (on the command line:)
+
+python manage.py update_stale_thread_summaries
+"""
+from django.core.management.base import NoArgsCommand
+from askbot.models import Thread
+from askbot.utils.console import ProgressBar
+
+BATCH_SIZE = 100
+
+class Command(NoArgsCommand):
+    """Command class for "update_stale_thread_summaries"
+    """
+    def handle_noargs(self, **options):
+        threads = Thread.objects.filter(deleted = False)
+        threads = threads.order_by('-last_activity_at')
+        count = threads.count()
+        message = 'Rendering stale thread summaries'
+        batch = list()
+        for thread in ProgressBar(threads.iterator(), count, message):
+            batch.append(thread)
+            if len(batch) == BATCH_SIZE:
+                Thread.objects.precache_summary_html(threads = batch)
+                batch = list()
+        if batch:
+            Thread.objects.precache_summary_html(threads = batch)
@@ -1,5 +1,6 @@
 #import collections
 import datetime
+import functools
 import uuid
 import logging
 import urllib
@@ -27,7 +28,9 @@ from askbot.models.question import Thread
 #from askbot.skins import utils as skin_utils
 from askbot.models.question import QuestionView, AnonymousQuestion
 from askbot.models.question import FavoriteQuestion
-from askbot.models.tag import Tag, MarkedTag
+from askbot.models.tag import Tag, MarkedTag, TagCooccurrence
+from askbot.models.tag import invalidate_wildcard_tag_filters
+from askbot.models.tag import invalidate_tag_subscriptions
 from askbot.models.user import EmailFeedSetting, ActivityAuditStatus, Activity
 from askbot.models.user import GroupMembership, GroupProfile
 from askbot.models.post import Post, PostRevision, PostFlagReason, AnonymousAnswer
@@ -41,6 +44,8 @@ from askbot.utils.slug import slugify
 from askbot.utils.html import sanitize_html
 from askbot.utils.diff import textDiff as htmldiff
 from askbot.utils.url_utils import strip_path
+from askbot.search import backends as search_backends
+from askbot.search import tag_postings
 from askbot import mail
 from django.contrib import messages
 from userena.utils import get_profile_model
@@ -288,6 +293,7 @@ def send_instant_notifications_about_activity_in_post(
         log_id = None
 
 
+    batch = mail.MessageBatch()
     for user in recipients:
         reply_address, alt_reply_address = get_reply_to_addresses(user, post)
 
@@ -302,22 +308,22 @@ def send_instant_notifications_about_activity_in_post(
                         )
       
         headers['Reply-To'] = reply_address
-        try:
-            mail.send_mail(
-                subject_line=subject_line,
-                body_text=body_text,
-                recipient_list=[user.email],
-                related_object=origin_post,
-                activity_type=const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT,
-                headers=headers,
-                raise_on_failure=True
-            )
-        except askbot_exceptions.EmailNotSent, error:
-            logger.debug(
-                '%s, error=%s, logId=%s' % (user.email, error, log_id)
+        batch.add(
+            subject_line=subject_line,
+            body_text=body_text,
+            recipient_list=[user.email],
+            headers=headers,
+            on_sent=functools.partial(
+                logger.debug, 'success %s, logId=%s' % (user.email, log_id)
             )
-        else:
-            logger.debug('success %s, logId=%s' % (user.email, log_id))
+        )
+
+    #all notifications go over one connection to the mail server
+    batch.send()
+    for message, error in batch.failed:
+        logger.debug(
+            '%s, error=%s, logId=%s' % (','.join(message.to), error, log_id)
+        )
 
 def notify_author_of_published_revision(
     revision = None, was_approved = None, **kwargs
@@ -450,25 +456,57 @@ def record_answer_accepted(instance, created, **kwargs):
                                 )
         activity.add_recipients(recipients)
 
+def get_last_seen_cache_key(user_id):
+    return 'user-last-seen-%d' % user_id
+
 def record_user_visit(user, timestamp, **kwargs):
     """
     when user visits any pages, we update the last_seen and
     consecutive_days_visit_count
+
+    the last visit is kept in the cache and the last_seen
+    column is written at most once per ASKBOT_LAST_SEEN_UPDATE_INTERVAL
+    seconds, or when the visit continues the run of consecutive days
     """
     profile = user.get_profile()
-    
-    prev_last_seen = profile.last_seen or datetime.datetime.now()
+    cache_key = get_last_seen_cache_key(user.id)
+    visit = cache.cache.get(cache_key)
+    if visit is None:
+        #the database copy is behind by less than the update interval
+        prev_last_seen = profile.last_seen or datetime.datetime.now()
+        saved_at = None
+    else:
+        prev_last_seen, saved_at = visit
+
     profile.last_seen = timestamp
-    if (profile.last_seen - prev_last_seen).days == 1:
+    updates = {}
+    if (timestamp - prev_last_seen).days == 1:
         profile.consecutive_days_visit_count += 1
+        updates['consecutive_days_visit_count'] = \
+                        models.F('consecutive_days_visit_count') + 1
+
+    update_interval = getattr(
+                        django_settings,
+                        'ASKBOT_LAST_SEEN_UPDATE_INTERVAL',
+                        const.LAST_SEEN_UPDATE_INTERVAL
+                    )
+    if updates or saved_at is None or \
+        timestamp - saved_at >= datetime.timedelta(seconds = update_interval):
+        updates['last_seen'] = timestamp
+        type(profile).objects.filter(id = profile.id).update(**updates)
+        saved_at = timestamp
+
+    cache.cache.set(
+        cache_key, (timestamp, saved_at), const.LAST_SEEN_CACHE_TIMEOUT
+    )
+
+    if 'consecutive_days_visit_count' in updates:
         award_badges_signal.send(None,
                                  event = 'site_visit',
                                  actor = user,
                                  context_object = user,
                                  timestamp = timestamp)
 
-    profile.save()
-
 
 def record_vote(instance, created, **kwargs):
     """
@@ -681,6 +719,67 @@ def complete_pending_tag_subscriptions(sender, request, *args, **kwargs):
                 )
         messages.info(request, _('Your tag subscription was saved, thanks!'))
 
+def invalidate_thread_listing_counts(instance, **kwargs):
+    """deleted thread leaves the listings"""
+    Thread.objects.invalidate_listing_counts()
+
+def update_search_index(thread):
+    """reindexes the thread, if the search backend is enabled"""
+    if search_backends.get_backend():
+        from askbot import tasks
+        tasks.index_thread_celery_task.delay(thread.id)
+
+def update_search_index_on_post_update(post, **kwargs):
+    """called upon signal askbot.models.signals.post_updated"""
+    if post.post_type in ('question', 'answer') and post.thread_id:
+        update_search_index(post.thread)
+
+def update_search_index_on_delete(instance, **kwargs):
+    """takes text of the deleted answer out of the index"""
+    update_search_index(instance.thread)
+
+def update_search_index_on_retag(thread, **kwargs):
+    update_search_index(thread)
+
+def remove_thread_from_search_index(instance, **kwargs):
+    if search_backends.get_backend():
+        from askbot import tasks
+        tasks.remove_thread_from_search_index_celery_task.delay(instance.id)
+
+def update_tag_postings(instance, action, reverse, pk_set, **kwargs):
+    """keeps cached tag postings in sync with the thread - tag relation,
+    ``pk_set`` holds tag ids, or thread ids when the change comes
+    from the tag side of the relation"""
+    if action == 'pre_clear':
+        #cleared ids are not passed to the post_clear handlers
+        if reverse:
+            thread_ids = instance.threads.values_list('id', flat=True)
+            tag_postings.remove_threads(instance.id, list(thread_ids))
+        else:
+            tag_ids = instance.tags.values_list('id', flat=True)
+            tag_postings.remove_thread(list(tag_ids), instance.id)
+    elif action in ('post_add', 'post_remove'):
+        if reverse:
+            if action == 'post_add':
+                tag_postings.add_threads(instance.id, pk_set)
+            else:
+                tag_postings.remove_threads(instance.id, pk_set)
+        else:
+            if action == 'post_add':
+                tag_postings.add_thread(pk_set, instance.id)
+            else:
+                tag_postings.remove_thread(pk_set, instance.id)
+
+def invalidate_tag_subscriptions_on_feed_deletion(instance, **kwargs):
+    """whole forum feeds are in the index of tag based subscriptions"""
+    if instance.feed_type == 'q_all':
+        invalidate_tag_subscriptions(instance.subscriber_id)
+
+def invalidate_tag_filters_on_tag_creation(instance, created, **kwargs):
+    """new tags may match wildcards of the users"""
+    if created:
+        invalidate_wildcard_tag_filters()
+
 def post_anonymous_askbot_content(
                                 sender,
                                 request,
@@ -700,19 +799,28 @@ django_signals.post_save.connect(notify_award_message, sender=Award)
 django_signals.post_save.connect(record_answer_accepted, sender=Post)
 django_signals.post_save.connect(record_vote, sender=Vote)
 django_signals.post_save.connect(record_favorite_question, sender=FavoriteQuestion)
+django_signals.post_save.connect(invalidate_tag_filters_on_tag_creation, sender=Tag)
 
 django_signals.post_delete.connect(record_cancel_vote, sender=Vote)
+django_signals.post_delete.connect(invalidate_thread_listing_counts, sender=Thread)
+django_signals.post_delete.connect(remove_thread_from_search_index, sender=Thread)
+django_signals.post_delete.connect(invalidate_tag_subscriptions_on_feed_deletion, sender=EmailFeedSetting)
+
+django_signals.m2m_changed.connect(update_tag_postings, sender=Thread.tags.through)
 
 #change this to real m2m_changed with Django1.2
 signals.delete_question_or_answer.connect(record_delete_question, sender=Post)
 signals.flag_offensive.connect(record_flag_offensive, sender=Post)
 signals.remove_flag_offensive.connect(remove_flag_offensive, sender=Post)
 signals.tags_updated.connect(record_update_tags)
+signals.tags_updated.connect(update_search_index_on_retag)
+signals.delete_question_or_answer.connect(update_search_index_on_delete, sender=Post)
 signals.user_registered.connect(greet_new_user)
 signals.user_updated.connect(record_user_full_updated, sender=User)
 signals.user_logged_in.connect(complete_pending_tag_subscriptions)#todo: add this to fake onlogin middleware
 signals.user_logged_in.connect(post_anonymous_askbot_content)
 signals.post_updated.connect(record_post_update_activity)
+signals.post_updated.connect(update_search_index_on_post_update)
 
 #probably we cannot use post-save here the point of this is
 #to tell when the revision becomes publicly visible, not when it is saved
@@ -741,6 +849,7 @@ __all__ = [
         'Vote',
         'PostFlagReason',
         'MarkedTag',
+        'TagCooccurrence',
 
         'BadgeData',
         'Award',
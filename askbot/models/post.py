@@ -24,7 +24,7 @@ import askbot
 from askbot.utils.slug import slugify
 from askbot import const
 from askbot.models.user import EmailFeedSetting
-from askbot.models.tag import Tag, MarkedTag, tags_match_some_wildcard
+from askbot.models.tag import Tag, get_tag_subscribers
 from askbot.conf import settings as askbot_settings
 from askbot import exceptions
 from askbot.utils import markup
@@ -34,7 +34,6 @@ from askbot.models.base import BaseQuerySetManager, DraftContent
 #todo: maybe merge askbot.utils.markup and forum.utils.html
 from askbot.utils.diff import textDiff as htmldiff
 from askbot.utils import mysql
-from userena.utils import get_profile_model
 
 class PostQuerySet(models.query.QuerySet):
     """
@@ -233,6 +232,8 @@ class PostManager(BaseQuerySetManager):
         #todo: this totally belongs to some `Thread` class method
         thread.answer_count += 1
         thread.save()
+        from askbot.models.question import Thread
+        Thread.objects.invalidate_listing_counts()
         thread.set_last_activity(last_activity_at=added_at, last_activity_by=author) # this should be here because it regenerates cached thread summary html
         return answer
 
@@ -469,6 +470,7 @@ class Post(models.Model):
         #this save must precede saving the mention activity
         #because generic relation needs primary key of the related object
         super(self.__class__, self).save(**kwargs)
+        self.denormalize_into_thread()
         if last_revision:
             diff = htmldiff(
                         sanitize_html(last_revision),
@@ -599,13 +601,34 @@ class Post(models.Model):
         raise NotImplementedError
 
     def save(self, *args, **kwargs):
+        if getattr(self, '_is_from_cached_row', False):
+            raise ValueError('Post restored from the cache cannot be saved')
         if self.is_answer() and self.is_anonymous:
             raise ValueError('Answer cannot be anonymous!')
         super(Post, self).save(*args, **kwargs)
+        self.denormalize_into_thread()
         if self.is_answer() and 'postgres' in askbot.get_database_engine_name():
             #hit the database to trigger update of full text search vector
             self.thread._question_post().save()
 
+    def denormalize_into_thread(self):
+        """copies id and the deleted status of the question
+        onto its thread, other post types are ignored"""
+        if not self.is_question() or self.thread_id is None:
+            return
+        thread = self.thread
+        if thread.question_post_id == self.id and thread.deleted == self.deleted:
+            return
+        thread.question_post_id = self.id
+        thread.deleted = self.deleted
+        #update() so that the stale copy of the thread
+        #does not overwrite other fields
+        from askbot.models.question import Thread
+        Thread.objects.filter(id = self.thread_id).update(
+                                            question_post = self.id,
+                                            deleted = self.deleted
+                                        )
+
     def _get_slug(self):
         if not self.is_question():
             raise NotImplementedError
@@ -734,101 +757,51 @@ class Post(models.Model):
     def get_global_tag_based_subscribers(
             self,
             tag_mark_reason = None,
-            subscription_records = None
+            frequency = 'i'
     ):
-        """returns a list of users who either follow or "do not ignore"
-        the given set of tags, depending on the tag_mark_reason
-
-        ``subscription_records`` - query set of ``~askbot.models.EmailFeedSetting``
-        this argument is used to reduce number of database queries
+        """returns a set of users who either follow or "do not ignore"
+        the tags of the thread, depending on the tag_mark_reason,
+        among the whole forum subscribers with the given ``frequency``
+        of the notifications
         """
         if tag_mark_reason == 'good':
             email_tag_filter_strategy = const.INCLUDE_INTERESTING
-            user_set_getter = get_profile_model().objects.filter
         elif tag_mark_reason == 'bad':
             email_tag_filter_strategy = const.EXCLUDE_IGNORED
-            user_set_getter = get_profile_model().objects.exclude
         else:
             raise ValueError('Uknown value of tag mark reason %s' % tag_mark_reason)
 
-        #part 1 - find users who follow or not ignore the set of tags
-        tag_names = self.get_tag_names()
-        tag_selections = MarkedTag.objects.filter(tag__name__in=tag_names, reason=tag_mark_reason)
-        subscribers = user_set_getter(user__tag_selections__in=tag_selections)
-        subscribers = subscribers.filter(user__notification_subscriptions__in=subscription_records)
-        subscribers = subscribers.filter(email_tag_filter_strategy=email_tag_filter_strategy)
-        subscribers = User.objects.filter(id__in=subscribers.values_list('user_id', flat=True))
-
-        #part 2 - find users who follow or not ignore tags via wildcard selections
-        #inside there is a potentially time consuming loop
-        if askbot_settings.USE_WILDCARD_TAGS:
-            #todo: fix this
-            #this branch will not scale well
-            #because we have to loop through the list of users
-            #in python
-            if tag_mark_reason == 'good':
-                empty_wildcard_filter = {'interesting_tags__exact': ''}
-                wildcard_tags_attribute = 'interesting_tags'
-                update_subscribers = lambda the_set, item: the_set.add(item)
-            elif tag_mark_reason == 'bad':
-                empty_wildcard_filter = {'ignored_tags__exact': ''}
-                wildcard_tags_attribute = 'ignored_tags'
-                update_subscribers = lambda the_set, item: the_set.discard(item)
-
-            potential_wildcard_subscribers = get_profile_model().filter(user__notification_subscriptions__in=subscription_records)\
-                                                         .filter(email_tag_filter_strategy=email_tag_filter_strategy)\
-                                                         .exclude(**empty_wildcard_filter) #need this to limit size of the loop
-            
-                                                         
-            for potential_subscriber in potential_wildcard_subscribers:
-                wildcard_tags = getattr(potential_subscriber, wildcard_tags_attribute).split(' ')
-                
-                if tags_match_some_wildcard(tag_names, wildcard_tags):
-                    potential_wildcard_subscribers = User.objects.filter(id__in=potential_wildcard_subscribers.values_list('user_id', flat=True))
-                    update_subscribers(subscribers, potential_subscriber)
-
-        return subscribers
+        subscriber_ids = get_tag_subscribers(
+                            tag_ids = self.thread.tags.values_list('id', flat = True),
+                            tag_names = self.get_tag_names(),
+                            frequency = frequency,
+                            strategy = email_tag_filter_strategy,
+                            use_wildcards = askbot_settings.USE_WILDCARD_TAGS
+                        )
+        return set(User.objects.filter(id__in = subscriber_ids))
 
     def get_global_instant_notification_subscribers(self):
         """returns a set of subscribers to post according to tag filters
         both - subscribers who ignore tags or who follow only
-        specific tags
-
-        this method in turn calls several more specialized
-        subscriber retrieval functions
-        todo: retrieval of wildcard tag followers ignorers
-              won't scale at all
+        specific tags, the subscribers are looked up in the
+        index of the tag based subscriptions
         """
-        subscriber_set = set()
-
-        global_subscriptions = EmailFeedSetting.objects.filter(
-            feed_type = 'q_all',
-            frequency = 'i'
-        )
-
-        #segment of users who have tag filter turned off
-        global_subscribers = get_profile_model().objects.filter(email_tag_filter_strategy=const.INCLUDE_ALL)
-        global_subscribers = User.objects.filter(id__in=global_subscribers.values_list('user_id', flat=True))
-        
-        subscriber_set.update(global_subscribers)
-
-        #segment of users who want emails on selected questions only
-        subscriber_set.update(
-            self.get_global_tag_based_subscribers(
-                subscription_records = global_subscriptions,
-                tag_mark_reason = 'good'
-            )
-        )
-
-        #segment of users who want to exclude ignored tags
-        subscriber_set.update(
-            self.get_global_tag_based_subscribers(
-                subscription_records = global_subscriptions,
-                tag_mark_reason = 'bad'
+        tag_ids = list(self.thread.tags.values_list('id', flat = True))
+        tag_names = self.get_tag_names()
+        subscriber_ids = set()
+        for strategy in (
+            const.INCLUDE_ALL, const.INCLUDE_INTERESTING, const.EXCLUDE_IGNORED
+        ):
+            subscriber_ids.update(
+                get_tag_subscribers(
+                    tag_ids = tag_ids,
+                    tag_names = tag_names,
+                    frequency = 'i',
+                    strategy = strategy,
+                    use_wildcards = askbot_settings.USE_WILDCARD_TAGS
+                )
             )
-        )
-        return subscriber_set
-
+        return set(User.objects.filter(id__in = subscriber_ids))
 
     def _qa__get_instant_notification_subscribers(
             self,
@@ -1591,11 +1564,12 @@ class Post(models.Model):
             return self.thread.accepted_answer_id == self.id
         raise NotImplementedError
 
-    def get_page_number(self, answer_posts):
+    def get_page_number(self, sort_method = 'votes'):
         """When question has many answers, answers are
         paginated. This function returns number of the page
-        on which the answer will be shown, using the default
-        sort order. The result may depend on the visitor."""
+        on which the answer will be shown, using the given
+        sort order. The position of the answer is counted
+        in the database, without loading the other answers."""
         if not self.is_answer() and not self.is_comment():
             raise NotImplementedError
 
@@ -1604,11 +1578,10 @@ class Post(models.Model):
         else:
             post = self
 
-        order_number = 0
-        for answer_post in answer_posts:
-            if post == answer_post:
-                break
-            order_number += 1
+        if post.is_question():
+            return 1
+
+        order_number = post.thread.get_answer_position(post, sort_method)
         return int(order_number/const.ANSWERS_PAGE_SIZE) + 1
 
     def get_order_number(self):
@@ -1750,6 +1723,8 @@ class PostRevision(models.Model):
             if self.post.is_question():
                 self.post.thread.approved = False
                 self.post.thread.save()
+                from askbot.models.question import Thread
+                Thread.objects.invalidate_listing_counts()
             #above changes will hide post from the public display
             if self.by_email:
                 #todo: move this to the askbot.mail module
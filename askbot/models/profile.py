@@ -20,10 +20,15 @@ from askbot import const
 from askbot import exceptions as askbot_exceptions
 from askbot.conf import settings as askbot_settings
 from askbot.const.message_keys import get_i18n_message
-from askbot.models.question import QuestionView, AnonymousQuestion
+from askbot.models.question import AnonymousQuestion
+from askbot.models.question import QuestionView
 from askbot.models.question import FavoriteQuestion
-from askbot.models.tag import Tag, MarkedTag
+from askbot.models.tag import Tag, MarkedTag, TagCooccurrence
+from askbot.models.tag import invalidate_user_tag_filter
+from askbot.models.tag import invalidate_tag_subscriptions
+from askbot.models.tag import invalidate_tag_subscribers
 from askbot.models.user import EmailFeedSetting, ActivityAuditStatus, Activity
+from askbot.models.user import get_unseen_question_ids, invalidate_unseen_question_ids
 from askbot.models.user import GroupMembership
 from askbot.models.post import Post, PostFlagReason, AnonymousAnswer
 from askbot.models.question import Thread
@@ -98,13 +103,12 @@ def _process_vote(profile, post, timestamp=None, cancel=False, vote_type=None):
         else:
             auth.onDownVoted(vote, post, profile.user, timestamp)
             
-    post.thread.invalidate_cached_data()
-
     if post.post_type == 'question':
         #denormalize the question post score on the thread
         post.thread.score = post.score
         post.thread.save()
-        post.thread.update_summary_html()
+
+    post.thread.invalidate_cached_data()
 
     if cancel:
         return None
@@ -216,6 +220,19 @@ class AskbotBaseProfile(models.Model):
     consecutive_days_visit_count = models.IntegerField(default=0)
     is_fake = models.BooleanField(default=False)
 
+    def __init__(self, *args, **kwargs):
+        super(AskbotBaseProfile, self).__init__(*args, **kwargs)
+        #deferred field is not loaded here
+        self._saved_email_tag_filter_strategy = \
+            self.__dict__.get('email_tag_filter_strategy')
+
+    def save(self, *args, **kwargs):
+        super(AskbotBaseProfile, self).save(*args, **kwargs)
+        strategy = self.__dict__.get('email_tag_filter_strategy')
+        if strategy != self._saved_email_tag_filter_strategy:
+            self._saved_email_tag_filter_strategy = strategy
+            invalidate_tag_subscriptions(self.user_id)
+
     @property
     def tag_selections(self):
         """
@@ -1158,6 +1175,13 @@ class AskbotBaseProfile(models.Model):
                     marked_ts.update(reason=reason)
                 cleaned_tagnames = tagnames
     
+        invalidate_user_tag_filter(self.user.id)
+        if reason in ('good', 'bad') and tagnames:
+            invalidate_tag_subscribers(
+                Tag.objects.filter(
+                    name__in = tagnames
+                ).values_list('id', flat = True)
+            )
         return cleaned_tagnames, cleaned_wildcards
     
     @auto_now_timestamp
@@ -1281,7 +1305,11 @@ class AskbotBaseProfile(models.Model):
         question.deleted_by = self.user
         question.deleted_at = timestamp
         question.save()
+        Thread.objects.invalidate_listing_counts()
     
+        tag_ids = list(question.thread.tags.values_list('id', flat = True))
+        TagCooccurrence.objects.remove_tags(tag_ids, tag_ids)
+
         for tag in list(question.thread.tags.all()):
             if tag.used_count == 1:
                 tag.deleted = True
@@ -1365,6 +1393,9 @@ class AskbotBaseProfile(models.Model):
             if post.post_type == 'answer':
                 post.thread.update_answer_count()
             else:
+                Thread.objects.invalidate_listing_counts()
+                tag_ids = list(post.thread.tags.values_list('id', flat = True))
+                TagCooccurrence.objects.add_tags(tag_ids, tag_ids)
                 #todo: make sure that these tags actually exist
                 #some may have since been deleted for good
                 #or merged into others
@@ -1696,19 +1727,12 @@ class AskbotBaseProfile(models.Model):
         if timestamp is None:
             timestamp = datetime.datetime.now()
     
-        try:
-            QuestionView.objects.filter(
-                who=self, question=question
-            ).update(
-                when = timestamp
-            )
-        except QuestionView.DoesNotExist:
-            QuestionView(
-                who=self,
-                question=question,
-                when = timestamp
-            ).save()
-    
+        QuestionView.objects.record_view(self.user.id, question.id, timestamp)
+
+        #the inbox is cleared only if there is new activity in the question
+        if question.id not in get_unseen_question_ids(self.user.id):
+            return
+
         #filter memo objects on response activities directed to the qurrent user
         #that refer to the children of the currently
         #viewed question and clear them for the current user
@@ -1716,7 +1740,7 @@ class AskbotBaseProfile(models.Model):
         ACTIVITY_TYPES += (const.TYPE_ACTIVITY_MENTION,)
     
         audit_records = ActivityAuditStatus.objects.filter(
-                            user = self,
+                            user = self.user,
                             status = ActivityAuditStatus.STATUS_NEW,
                             activity__question = question
                         )
@@ -1737,6 +1761,8 @@ class AskbotBaseProfile(models.Model):
             ).update(
                 status=ActivityAuditStatus.STATUS_SEEN
             )
+
+        invalidate_unseen_question_ids([self.user.id])
             
     def has_interesting_wildcard_tags(self):
         """True in wildcard tags aro on and
@@ -1894,7 +1920,7 @@ class AskbotBaseProfile(models.Model):
         if 'b' in (new_status, self.status) and new_status != self.status:
             threads = Thread.objects.get_for_user(self)
             for thread in threads:
-                thread.invalidate_cached_post_data()
+                thread.invalidate_cached_data()
     
         self.status = new_status
         self.save()
@@ -2216,6 +2242,7 @@ class AskbotBaseProfile(models.Model):
             thread = post.thread
             thread.approved = True
             thread.save()
+            Thread.objects.invalidate_listing_counts()
         post.thread.invalidate_cached_data()
     
         #send the signal of published revision
@@ -2347,6 +2374,8 @@ class AskbotBaseProfile(models.Model):
         self.ignored_tags = ' '.join(ignored)
         self.subscribed_tags = ' '.join(subscribed)
         self.save()
+        invalidate_user_tag_filter(self.user.id)
+        invalidate_tag_subscriptions(self.user.id)
         return new_tags
     
     
@@ -1,9 +1,10 @@
 import datetime
 import operator
 import re
+import time
 
 from django.conf import settings
-from django.db import models
+from django.db import connection, models, transaction
 from django.contrib.auth.models import User
 from django.core import cache
 from django.core.urlresolvers import reverse
@@ -13,21 +14,51 @@ from django.utils.translation import ungettext
 
 import askbot
 import askbot.conf
-from askbot.models.tag import Tag
+from askbot.models.tag import Tag, TagCooccurrence, get_user_tag_filter
 from askbot.models.base import DraftContent
 from askbot.models.post import Post, PostRevision
 from askbot.models import signals
 from askbot import const
-from askbot.utils.lists import LazyList
+from askbot.utils.cache_queue import CacheQueue
+from askbot.utils.lists import LazyList, batch_size
 from askbot.utils import mysql
 from askbot.utils.slug import slugify
 from askbot.skins.loaders import get_template #jinja2 template loading enviroment
 from askbot.search.state_manager import DummySearchState
+from askbot.search import backends as search_backends
+from askbot.search import tag_postings
 from userena.utils import get_profile_model
 from django.contrib.sites.models import Site
 from django.utils import translation
 
 
+#bumped whenever the number of listed threads may change,
+#cached listing counts go stale with it
+LISTING_COUNT_GENERATION_KEY = 'thread-listing-count-generation'
+#bumped whenever the last activity of any thread changes,
+#cached last modification times of the listings go stale with it
+LISTING_ACTIVITY_GENERATION_KEY = 'thread-listing-activity-generation'
+#views counted in the cache, when ASKBOT_DEFER_VIEW_COUNTS is on
+PENDING_VIEWS_KEY_TPL = 'thread-pending-views-%d'
+#threads with pending views
+pending_thread_views = CacheQueue('thread-pending-views')
+#views of the questions by the users, when ASKBOT_DEFER_VIEW_COUNTS is on
+pending_question_views = CacheQueue('question-views')
+#orderings of the answers on the question page, the last
+#field breaks the ties, so that positions of the answers are stable
+ANSWER_ORDERINGS = {
+    'latest': ('-added_at', '-id'),
+    'oldest': ('added_at', 'id'),
+    'votes': ('-score', 'id'),
+}
+#position of the markdown source in the cached rows of the posts
+POST_TEXT_FIELD_INDEX = [field.attname for field in Post._meta.fields].index('text')
+#goes into the keys of the cached rows of the posts,
+#so that the rows are not read after the fields of Post change
+POST_ROW_SCHEMA = md5_constructor(
+    ' '.join([field.attname for field in Post._meta.fields])
+).hexdigest()[:8]
+
 class ThreadManager(models.Manager):
     def get_tag_summary_from_threads(self, threads):
         """returns a humanized string containing up to
@@ -62,6 +93,40 @@ class ThreadManager(models.Manager):
 
         return '"' + '", "'.join(tag_list) + last_topic
 
+    def denormalize_question_posts(self):
+        """copies id and the deleted status of the question posts
+        onto all threads, with one UPDATE of the thread table"""
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        post_opts = Post._meta
+        params = {
+            'thread': qn(opts.db_table),
+            'thread_pk': qn(opts.pk.column),
+            'question_post': qn(opts.get_field('question_post').column),
+            'deleted': qn(opts.get_field('deleted').column),
+            'post': qn(post_opts.db_table),
+            'post_pk': qn(post_opts.pk.column),
+            'post_thread': qn(post_opts.get_field('thread').column),
+            'post_type': qn(post_opts.get_field('post_type').column),
+            'post_deleted': qn(post_opts.get_field('deleted').column),
+        }
+        #correlated subqueries, because UPDATE ... FROM
+        #and UPDATE ... JOIN are not portable
+        question_sql = (
+            'FROM %(post)s p WHERE p.%(post_thread)s = '
+            '%(thread)s.%(thread_pk)s AND p.%(post_type)s = %%s'
+        ) % params
+        params['question_sql'] = question_sql
+        cursor = connection.cursor()
+        cursor.execute(
+            'UPDATE %(thread)s SET '
+            '%(question_post)s = (SELECT p.%(post_pk)s %(question_sql)s), '
+            '%(deleted)s = (SELECT p.%(post_deleted)s %(question_sql)s) '
+            'WHERE EXISTS (SELECT 1 %(question_sql)s)' % params,
+            ['question'] * 3
+        )
+        transaction.commit_unless_managed()
+
     def create(self, *args, **kwargs):
         raise NotImplementedError
 
@@ -130,14 +195,34 @@ class ThreadManager(models.Manager):
         # INFO: Question has to be saved before update_tags() is called
         thread.update_tags(tagnames = tagnames, user = author, timestamp = added_at)
 
+        self.invalidate_listing_counts()
+
         return thread
 
+    def filter_ids(self, qs, thread_ids):
+        """returns query set ``qs`` restricted to the ``thread_ids``,
+        which may be longer than the limit of the query parameters,
+        e.g. 999 in SQLite - the ids are put into the SQL as numbers
+        """
+        if not thread_ids:
+            return qs.none()
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        return qs.extra(where = ['%s.%s IN (%s)' % (
+                                qn(opts.db_table),
+                                qn(opts.pk.column),
+                                ','.join([str(int(thread_id)) for thread_id in thread_ids])
+                            )])
+
     def get_for_query(self, search_query, qs=None):
         """returns a query set of questions,
         matching the full text query
         """
         if not qs:
             qs = self.all()
+        search_backend = search_backends.get_backend()
+        if search_backend:
+            return self.filter_ids(qs, search_backend.search(search_query))
 #        if getattr(settings, 'USE_SPHINX_SEARCH', False):
 #            matching_questions = Question.sphinx_search.query(search_query)
 #            question_ids = [q.id for q in matching_questions]
@@ -181,10 +266,9 @@ class ThreadManager(models.Manager):
         qs = self.filter(
                 language_code=language_code,
                 site=site,
-                posts__post_type='question', 
-                posts__deleted=False,
+                deleted=False,
                 is_specific=is_specific
-            ) # (***) brings `askbot_post` into the SQL query, see the ordering section below
+            )
 
         if thread_ids != None:
             qs = qs.filter(id__in=thread_ids)
@@ -192,41 +276,64 @@ class ThreadManager(models.Manager):
         if askbot_settings.ENABLE_CONTENT_MODERATION:
             qs = qs.filter(approved = True)
 
-        meta_data = {}
+        #true when results depend on who is looking at them
+        meta_data = {'is_personalized': False}
+        #true when filters join tables, where a thread may
+        #match more than one row, e.g. the posts
+        needs_distinct = False
 
+        search_backend = search_backends.get_backend()
+        #true when the 'relevance' column is available
+        is_ranked = False
         if search_state.stripped_query:
             qs = self.get_for_query(search_query=search_state.stripped_query, qs=qs)
+            if search_backend is None:
+                #the text is matched by joining the posts
+                needs_distinct = True
+            else:
+                is_ranked = search_backend.supports_relevance
         if search_state.query_title:
             qs = qs.filter(title__icontains = search_state.query_title)
         if search_state.query_users:
             query_users = User.objects.filter(username__in=search_state.query_users)
             if query_users:
-                qs = qs.filter(posts__post_type='question', posts__author__in=query_users) # TODO: unify with search_state.author ?
+                qs = qs.filter(question_post__author__in=query_users) # TODO: unify with search_state.author ?
 
         tags = search_state.unified_tags()
         if len(tags) > 0:
 
+            #tag name -> tag id
+            existing_tags = dict(
+                Tag.objects.filter(
+                    name__in = tags
+                ).values_list(
+                    'name',
+                    'id'
+                )
+            )
+
             if askbot_settings.TAG_SEARCH_INPUT_ENABLED:
                 #todo: this may be gone or disabled per option
                 #"tag_search_box_enabled"
-                existing_tags = set(
-                    Tag.objects.filter(
-                        name__in = tags
-                    ).values_list(
-                        'name',
-                        flat = True
-                    )
-                )
-
-                non_existing_tags = set(tags) - existing_tags
+                non_existing_tags = set(tags) - set(existing_tags)
                 meta_data['non_existing_tags'] = list(non_existing_tags)
-                tags = existing_tags
+                tags = existing_tags.keys()
             else:
                 meta_data['non_existing_tags'] = list()
 
+            meta_data['selected_tag_ids'] = [
+                existing_tags[tag] for tag in tags if tag in existing_tags
+            ]
+
             #construct filter for the tag search
-            for tag in tags:
-                qs = qs.filter(tags__name=tag) # Tags or AND-ed here, not OR-ed (i.e. we fetch only threads with all tags)
+            # Tags or AND-ed here, not OR-ed (i.e. we fetch only threads with all tags)
+            if set(tags) - set(existing_tags):
+                qs = qs.none()
+            elif tags:
+                tagged_thread_ids = tag_postings.get_thread_ids(
+                                        [existing_tags[tag] for tag in tags]
+                                    )
+                qs = self.filter_ids(qs, tagged_thread_ids)
         else:
             meta_data['non_existing_tags'] = list()
 
@@ -247,6 +354,8 @@ class ThreadManager(models.Manager):
                 followed_users = request_user.get_followed_users()
                 favorite_filter |= models.Q(posts__post_type__in=('question', 'answer'), posts__author__in=followed_users)
             qs = qs.filter(favorite_filter)
+            meta_data['is_personalized'] = True
+            needs_distinct = True
 
         #user contributed questions & answers
         if search_state.author:
@@ -258,46 +367,34 @@ class ThreadManager(models.Manager):
             else:
                 qs = qs.filter(posts__post_type__in=('question', 'answer'), posts__author=u, posts__deleted=False)
                 meta_data['author_name'] = u.username
+                needs_distinct = True
 
         #get users tag filters
         if request_user and request_user.is_authenticated():
             profile = request_user.get_profile()
-            #mark questions tagged with interesting tags
-            #a kind of fancy annotation, would be nice to avoid it
-            interesting_tags = Tag.objects.filter(
-                user_selections__user = request_user,
-                user_selections__reason = 'good'
-            )
-            ignored_tags = Tag.objects.filter(
-                user_selections__user = request_user,
-                user_selections__reason = 'bad'
-            )
+            #tag ids are resolved once per change of the tag selections
+            tag_filter = get_user_tag_filter(
+                                request_user,
+                                use_wildcards = askbot_settings.USE_WILDCARD_TAGS
+                            )
+            interesting_tag_ids = tag_filter['interesting_tag_ids']
+            ignored_tag_ids = tag_filter['ignored_tag_ids']
             if askbot_settings.SUBSCRIBED_TAG_SELECTOR_ENABLED:
-                meta_data['subscribed_tag_names'] = Tag.objects.filter(
-                    user_selections__user = request_user,
-                    user_selections__reason = 'subscribed'
-                ).values_list('name', flat = True)
+                meta_data['subscribed_tag_names'] = tag_filter['subscribed_tag_names']
 
-            meta_data['interesting_tag_names'] = [tag.name for tag in interesting_tags]
-            meta_data['ignored_tag_names'] = [tag.name for tag in ignored_tags]
+            meta_data['interesting_tag_names'] = list(tag_filter['interesting_tag_names'])
+            meta_data['ignored_tag_names'] = list(tag_filter['ignored_tag_names'])
 
-            if profile.display_tag_filter_strategy == const.INCLUDE_INTERESTING and (interesting_tags or profile.has_interesting_wildcard_tags()):
+            if profile.display_tag_filter_strategy == const.INCLUDE_INTERESTING and (interesting_tag_ids or profile.has_interesting_wildcard_tags()):
                 #filter by interesting tags only
-                interesting_tag_filter = models.Q(tags__in=interesting_tags)
-                if profile.has_interesting_wildcard_tags():
-                    interesting_wildcards = profile.interesting_tags.split()
-                    extra_interesting_tags = Tag.objects.get_by_wildcards(interesting_wildcards)
-                    interesting_tag_filter |= models.Q(tags__in=extra_interesting_tags)
-                qs = qs.filter(interesting_tag_filter)
-
-            # get the list of interesting and ignored tags (interesting_tag_names, ignored_tag_names) = (None, None)
-            if profile.display_tag_filter_strategy == const.EXCLUDE_IGNORED and (ignored_tags or profile.has_ignored_wildcard_tags()):
+                qs = qs.filter(tags__id__in = interesting_tag_ids)
+                meta_data['is_personalized'] = True
+                needs_distinct = True
+
+            if profile.display_tag_filter_strategy == const.EXCLUDE_IGNORED and (ignored_tag_ids or profile.has_ignored_wildcard_tags()):
                 #exclude ignored tags if the user wants to
-                qs = qs.exclude(tags__in=ignored_tags)
-                if profile.has_ignored_wildcard_tags():
-                    ignored_wildcards = profile.ignored_tags.split()
-                    extra_ignored_tags = Tag.objects.get_by_wildcards(ignored_wildcards)
-                    qs = qs.exclude(tags__in = extra_ignored_tags)
+                qs = qs.exclude(tags__id__in = ignored_tag_ids)
+                meta_data['is_personalized'] = True
 
             if askbot_settings.USE_WILDCARD_TAGS:
                 meta_data['interesting_tag_names'].extend(profile.interesting_tags.split())
@@ -313,9 +410,26 @@ class ThreadManager(models.Manager):
             'votes-desc': '-score',
             'votes-asc': 'score',
 
-            'relevance-desc': '-relevance', # special Postgresql-specific ordering, 'relevance' quaso-column is added by get_for_query()
+            'relevance-desc': '-relevance', # 'relevance' quasi-column is added below when the search backend ranks results
         }
-        if search_state.sort != 'relevance-desc': #FIXME:  temporary disable relevance
+        if search_state.sort == 'relevance-desc' and is_ranked:
+            #only the threads up to the current page are ranked
+            rank_limit = search_state.page * int(askbot_settings.DEFAULT_QUESTIONS_PAGE_SIZE)
+            #the ranking is read from the top and checked against
+            #the filters in batches, candidates are not loaded
+            ranked_ids = search_backend.rank(
+                                        search_state.stripped_query,
+                                        rank_limit,
+                                        lambda ids: qs.filter(
+                                            id__in=ids
+                                        ).values_list('id', flat=True)
+                                    )
+            relevance_sql = search_backends.get_relevance_sql(
+                                        ranked_ids,
+                                        self.model._meta.db_table
+                                    )
+            qs = qs.extra(select={'relevance': relevance_sql})
+        if search_state.sort != 'relevance-desc' or is_ranked:
             orderby = QUESTION_ORDER_BY_MAP[search_state.sort]
             qs = qs.extra(order_by=[orderby])
 
@@ -326,34 +440,323 @@ class ThreadManager(models.Manager):
         # qs = qs.extra(select={'ordering_key': orderby.lstrip('-')}, order_by=['-ordering_key' if orderby.startswith('-') else 'ordering_key'])
         # qs = qs.distinct()
         #qs = qs.only('id', 'title', 'view_count', 'answer_count', 'last_activity_at', 'last_activity_by', 'closed', 'tagnames', 'accepted_answer')
-        
-        return qs.distinct(), meta_data
+
+        if needs_distinct:
+            qs = qs.distinct()
+        return qs, meta_data
+
+    def invalidate_listing_counts(self):
+        """makes all cached listing counts stale,
+        to be called when threads are added, deleted,
+        restored or change the approval status, the tags,
+        the number of answers or the accepted answer"""
+        try:
+            cache.cache.incr(LISTING_COUNT_GENERATION_KEY)
+        except ValueError:
+            #no generation yet or it was evicted
+            cache.cache.set(
+                LISTING_COUNT_GENERATION_KEY,
+                int(time.time()),
+                const.LONG_TIME
+            )
+
+    def get_estimated_count(self):
+        """returns number of rows in the thread table
+        estimated by the database statistics, or ``None``
+        when the database does not keep the estimate"""
+        engine = askbot.get_database_engine_name()
+        if 'postgresql' in engine:
+            sql = 'SELECT reltuples FROM pg_class WHERE relname = %s'
+        elif 'mysql' in engine:
+            sql = 'SELECT table_rows FROM information_schema.tables ' + \
+                'WHERE table_schema = DATABASE() AND table_name = %s'
+        else:
+            return None
+        cursor = connection.cursor()
+        cursor.execute(sql, [self.model._meta.db_table])
+        row = cursor.fetchone()
+        if row is None or row[0] is None:
+            return None
+        return int(row[0])
+
+    def get_listing_count_generation(self):
+        """returns generation of the cached listing counts,
+        it changes when threads are added or removed from the listings"""
+        return cache.cache.get(LISTING_COUNT_GENERATION_KEY, 0)
+
+    def invalidate_listing_activity(self):
+        """makes all cached last modification times
+        of the listings stale, to be called when the
+        last activity of a thread changes"""
+        try:
+            cache.cache.incr(LISTING_ACTIVITY_GENERATION_KEY)
+        except ValueError:
+            cache.cache.set(
+                LISTING_ACTIVITY_GENERATION_KEY,
+                int(time.time()),
+                const.LONG_TIME
+            )
+
+    def get_listing_last_modified(
+                                self,
+                                qs,
+                                search_state,
+                                language_code,
+                                site,
+                                thread_ids = None,
+                                is_specific = False
+                            ):
+        """returns the latest activity time of the threads in ``qs``,
+        which must not be personalized, the value is cached until
+        threads enter or leave the listings or any thread has
+        new activity, so that the listings are not aggregated
+        on every conditional request
+        """
+        count_key = self.get_listing_count_cache_key(
+                                    search_state,
+                                    language_code,
+                                    site,
+                                    thread_ids = thread_ids,
+                                    is_specific = is_specific
+                                )
+        key = 'thread-listing-last-modified-%s-%s' % (
+                    cache.cache.get(LISTING_ACTIVITY_GENERATION_KEY, 0),
+                    count_key
+                )
+        entry = cache.cache.get(key)
+        if entry is None:
+            #in a tuple, because empty listings have no time
+            entry = (qs.aggregate(
+                        models.Max('last_activity_at')
+                    )['last_activity_at__max'],)
+            cache.cache.set(key, entry, const.LISTING_COUNT_CACHE_TIMEOUT)
+        return entry[0]
+
+    def get_listing_count_cache_key(
+                                self,
+                                search_state,
+                                language_code,
+                                site,
+                                user_id = None,
+                                thread_ids = None,
+                                is_specific = False
+                            ):
+        """returns cache key for the number of threads
+        matching the search state, sort order and page are ignored,
+        ``user_id`` must be given for the personalized listings
+        """
+        generation = self.get_listing_count_generation()
+        if thread_ids is not None:
+            thread_ids = sorted(thread_ids)
+        query = search_state.query or ''
+        key_bits = (
+            search_state.scope,
+            ','.join(sorted(search_state.unified_tags())),
+            ' '.join(query.lower().split()),
+            search_state.author,
+            language_code,
+            site.id,
+            user_id,
+            thread_ids,
+            is_specific,
+        )
+        digest = md5_constructor(repr(key_bits)).hexdigest()
+        return 'thread-listing-count-%s-%s' % (generation, digest)
+
+    def get_listing_count(
+                        self,
+                        qs,
+                        search_state,
+                        meta_data,
+                        language_code,
+                        site,
+                        request_user = None,
+                        thread_ids = None,
+                        is_specific = False
+                    ):
+        """returns number of threads in the query set ``qs``,
+        as returned by :meth:`run_advanced_search`
+
+        The value is cached per normalized search state.
+        Unfiltered listings of the large forums show the number
+        of rows in the thread table, estimated by the database,
+        smaller ones are counted on the thread table alone,
+        without the joins and the ``DISTINCT``.
+        """
+        if meta_data.get('is_personalized', False):
+            user_id = request_user.id
+        else:
+            user_id = None
+
+        key = self.get_listing_count_cache_key(
+                                    search_state,
+                                    language_code,
+                                    site,
+                                    user_id = user_id,
+                                    thread_ids = thread_ids,
+                                    is_specific = is_specific
+                                )
+        count = cache.cache.get(key)
+        if count is not None:
+            return count
+
+        is_unfiltered = search_state.scope == 'all' \
+                    and not search_state.query \
+                    and not search_state.unified_tags() \
+                    and not search_state.author \
+                    and user_id is None \
+                    and thread_ids is None
+
+        if is_unfiltered:
+            count = self.get_estimated_count()
+            if count is not None \
+                and count >= const.LISTING_COUNT_ESTIMATE_MIN_ROWS:
+                cache.cache.set(key, count, const.LISTING_COUNT_CACHE_TIMEOUT)
+                return count
+
+            from askbot.conf import settings as askbot_settings # Avoid circular import
+            estimate_qs = self.filter(
+                                language_code=language_code,
+                                site=site,
+                                deleted=False,
+                                is_specific=is_specific
+                            )
+            if askbot_settings.ENABLE_CONTENT_MODERATION:
+                estimate_qs = estimate_qs.filter(approved=True)
+            count = estimate_qs.count()
+        else:
+            count = qs.count()
+
+        cache.cache.set(key, count, const.LISTING_COUNT_CACHE_TIMEOUT)
+        return count
+
+    def add_pending_views(self, thread_id, increment=1):
+        """counts views of the thread in the cache, they are
+        written to the database by :meth:`flush_pending_views`
+
+        the cache must be shared by the web server processes and
+        the flush command (e.g. memcached), with the per process
+        ``LocMemCache`` the flush does not see the counted views
+        """
+        key = PENDING_VIEWS_KEY_TPL % thread_id
+        try:
+            count = cache.cache.incr(key, increment)
+        except ValueError:
+            if cache.cache.add(key, increment, const.LONG_TIME):
+                count = increment
+            else:
+                count = cache.cache.incr(key, increment)
+        if count == increment:
+            #first views since the last flush
+            pending_thread_views.put(thread_id)
+
+    def flush_pending_views(self):
+        """adds the views counted in the cache to the
+        view counts of the threads, with one update per thread,
+        and returns dictionary thread id -> number of the added views
+        """
+        thread_ids = set(pending_thread_views.take())
+        view_keys = dict(
+            (PENDING_VIEWS_KEY_TPL % thread_id, thread_id) for thread_id in thread_ids
+        )
+        increments = dict()
+        for key, count in cache.cache.get_many(view_keys.keys()).items():
+            if count <= 0:
+                continue
+            thread_id = view_keys[key]
+            try:
+                #views added after the read are left for the next flush
+                if cache.cache.decr(key, count) > 0:
+                    pending_thread_views.put(thread_id)
+            except ValueError:
+                pass
+            increments[thread_id] = count
+
+        for thread_id, count in increments.items():
+            self.filter(id=thread_id).update(
+                view_count=models.F('view_count') + count
+            )
+        generations = self.get_cache_generations(increments.keys())
+        cache.cache.delete_many([
+            Thread.make_cache_key(thread_id, generation, 'question-summary')
+            for thread_id, generation in generations.items()
+        ])
+        return increments
+
+    def get_cache_generations(self, thread_ids):
+        """returns dictionary thread id -> cache generation of the thread,
+        reads all generations with one cache request and
+        starts new generations for the threads that have none
+        """
+        keys = dict(
+            (Thread.GENERATION_KEY_TPL % thread_id, thread_id)
+            for thread_id in thread_ids
+        )
+        cached = cache.cache.get_many(keys.keys())
+        generations = dict(
+            (keys[key], generation) for key, generation in cached.items()
+        )
+        missing_keys = set(keys) - set(cached)
+        if missing_keys:
+            generation = int(time.time())
+            cache.cache.set_many(
+                dict((key, generation) for key in missing_keys),
+                timeout=const.LONG_TIME
+            )
+            for key in missing_keys:
+                generations[keys[key]] = generation
+        return generations
 
     def precache_view_data_hack(self, threads):
-        # TODO: Re-enable this when we have a good test cases to verify that it works properly.
-        #
-        #       E.g.: - make sure that not precaching give threads never increase # of db queries for the main page
-        #             - make sure that it really works, i.e. stuff for non-cached threads is fetched properly
-        # Precache data only for non-cached threads - only those will be rendered
-        #threads = [thread for thread in threads if not thread.summary_html_cached()]
-
-        page_questions = Post.objects.filter(post_type='question', thread__in=[obj.id for obj in threads])\
+        """fetches question posts and last active users
+        of the threads with two queries for all threads"""
+        page_questions = Post.objects.filter(id__in=[obj.question_post_id for obj in threads])\
                             .only('id', 'thread', 'score', 'is_anonymous', 'summary', 'post_type', 'deleted') # pick only the used fields
         page_question_map = {}
         for pq in page_questions:
             page_question_map[pq.thread_id] = pq
         for thread in threads:
-            thread._question_cache = page_question_map[thread.id]
+            if thread.id in page_question_map:
+                thread._question_cache = page_question_map[thread.id]
 
-        last_activity_by_users = get_profile_model().objects.filter(user__id__in=[obj.last_activity_by_id for obj in threads])
-        last_activity_by_users = last_activity_by_users.only('user__id', 'user__username')#, 'country', 'show_country')
-        
+        last_activity_by_users = User.objects.filter(id__in=[obj.last_activity_by_id for obj in threads])
         user_map = {}
         for la_user in last_activity_by_users:
             user_map[la_user.id] = la_user
         for thread in threads:
             thread._last_activity_by_cache = user_map[thread.last_activity_by_id]
 
+    def precache_summary_html(self, threads):
+        """reads summaries of the threads from the cache
+        with one request, renders the missing ones with
+        prefetched question posts and caches them with another
+
+        summaries are stored in the thread objects, so that
+        :meth:`Thread.get_summary_html` does not hit the cache again
+        """
+        generations = self.get_cache_generations([thread.id for thread in threads])
+        threads_by_key = dict(
+            (
+                Thread.make_cache_key(
+                    thread.id, generations[thread.id], 'question-summary'
+                ),
+                thread
+            ) for thread in threads
+        )
+        summaries = cache.cache.get_many(threads_by_key.keys())
+
+        missing_keys = set(threads_by_key) - set(summaries)
+        if missing_keys:
+            missing_threads = [threads_by_key[key] for key in missing_keys]
+            self.precache_view_data_hack(threads=missing_threads)
+            rendered = dict()
+            for key in missing_keys:
+                rendered[key] = threads_by_key[key].render_summary_html()
+            cache.cache.set_many(rendered, timeout=const.LONG_TIME)
+            summaries.update(rendered)
+
+        for key, thread in threads_by_key.items():
+            thread._summary_html_cache = summaries[key]
 
     #todo: this function is similar to get_response_receivers - profile this function against the other one
     def get_thread_contributors(self, thread_list):
@@ -386,8 +789,64 @@ class ThreadManager(models.Manager):
         return self.filter(id__in = thread_ids)
 
 
+def get_post_row(post):
+    """returns tuple of the field values of the post,
+    in the order of the model fields, the markdown source
+    is needed only for the comments"""
+    row = [getattr(post, field.attname) for field in Post._meta.fields]
+    if post.post_type != 'comment':
+        row[POST_TEXT_FIELD_INDEX] = None
+    return tuple(row)
+
+def get_post_from_row(row):
+    """returns post made of the cached row, such posts are
+    for display only and cannot be saved, because the markdown
+    source of the questions and the answers is not in the rows"""
+    post = Post(*row)
+    post._state.adding = False
+    post._is_from_cached_row = True
+    return post
+
+def pack_post_data(question_post, answers):
+    """returns compact form of the post data, which can be
+    cached instead of the pickled posts - rows of the field
+    values of the question, the answers and of their comments
+    grouped by the parent post id"""
+    posts = list(answers)
+    if question_post is not None:
+        posts.append(question_post)
+    comments = dict()
+    for post in posts:
+        post_comments = post.get_cached_comments()
+        if post_comments:
+            comments[post.id] = [get_post_row(comment) for comment in post_comments]
+    return {
+        'question': question_post and get_post_row(question_post),
+        'answers': [get_post_row(answer) for answer in answers],
+        'comments': comments,
+    }
+
+def unpack_post_data(entry):
+    """returns question post, answers and the post id -> author id
+    dictionary made of the compact post data"""
+    question_post = None
+    if entry['question']:
+        question_post = get_post_from_row(entry['question'])
+    answers = [get_post_from_row(row) for row in entry['answers']]
+    post_to_author = dict()
+    for post in filter(None, [question_post] + answers):
+        post_to_author[post.id] = post.author_id
+        comments = [
+            get_post_from_row(row) for row in entry['comments'].get(post.id, ())
+        ]
+        for comment in comments:
+            post_to_author[comment.id] = comment.author_id
+        post.set_cached_comments(comments)
+    return question_post, answers, post_to_author
+
+
 class Thread(models.Model):
-    SUMMARY_CACHE_KEY_TPL = 'thread-question-summary-%d'
+    GENERATION_KEY_TPL = 'thread-generation-%d'
     ANSWER_LIST_KEY_TPL = 'thread-answer-list-%d'
 
     language_code = models.CharField(_('language'), max_length=6, choices=settings.LANGUAGES)
@@ -422,6 +881,12 @@ class Thread(models.Model):
     #approvals - by whom and when
     approved = models.BooleanField(default=True, db_index=True)
 
+    #denormalized data: the question post and its deleted status,
+    #copied from the post in Post.denormalize_into_thread(),
+    #lets the thread listings do without joining the posts table
+    question_post = models.ForeignKey(Post, null=True, blank=True, related_name='+')
+    deleted = models.BooleanField(default=False, db_index=True)
+
     accepted_answer = models.ForeignKey(Post, null=True, blank=True, related_name='+')
     answer_accepted_at = models.DateTimeField(null=True, blank=True)
     added_at = models.DateTimeField(default = datetime.datetime.now)
@@ -444,7 +909,10 @@ class Thread(models.Model):
         post = getattr(self, '_question_cache', None)
         if post:
             return post
-        self._question_cache = Post.objects.get(post_type='question', thread=self)
+        if self.question_post_id:
+            self._question_cache = Post.objects.get(id=self.question_post_id)
+        else:
+            self._question_cache = Post.objects.get(post_type='question', thread=self)
         return self._question_cache
 
     @property
@@ -463,14 +931,18 @@ class Thread(models.Model):
     def update_answer_count(self):
         self.answer_count = self.get_answers().count()
         self.save()
+        Thread.objects.invalidate_listing_counts()
 
     def increase_view_count(self, increment=1):
+        if getattr(settings, 'ASKBOT_DEFER_VIEW_COUNTS', False):
+            #the count is written by the flush_view_counts command
+            Thread.objects.add_pending_views(self.id, increment)
+            self.view_count += increment
+            return
         qset = Thread.objects.filter(id=self.id)
         qset.update(view_count=models.F('view_count') + increment)
         self.view_count = qset.values('view_count')[0]['view_count'] # get the new view_count back because other pieces of code relies on such behaviour
-        ####################################################################
-        self.update_summary_html() # regenerate question/thread summary html
-        ####################################################################
+        self.invalidate_cached_thread_content_fragment()
 
     def set_closed_status(self, closed, closed_by, closed_at, close_reason):
         self.closed = closed
@@ -486,14 +958,15 @@ class Thread(models.Model):
         self.accepted_answer = answer
         self.answer_accepted_at = timestamp
         self.save()
+        self.invalidate_cached_thread_content_fragment()
+        Thread.objects.invalidate_listing_counts()
 
     def set_last_activity(self, last_activity_at, last_activity_by):
         self.last_activity_at = last_activity_at
         self.last_activity_by = last_activity_by
         self.save()
-        ####################################################################
-        self.update_summary_html() # regenerate question/thread summary html
-        ####################################################################
+        self.invalidate_cached_thread_content_fragment()
+        Thread.objects.invalidate_listing_activity()
 
     def get_tag_names(self):
         "Creates a list of Tag names from the ``tagnames`` attribute."
@@ -561,34 +1034,175 @@ class Thread(models.Model):
                             )
 
     def invalidate_cached_thread_content_fragment(self):
-        cache.cache.delete(self.SUMMARY_CACHE_KEY_TPL % self.id)
+        """marks the summary of the thread stale by dropping it
+        from the cache, it is rendered again when it is read next time,
+        so any number of marks costs at most one rendering
+        """
+        if hasattr(self, '_summary_html_cache'):
+            delattr(self, '_summary_html_cache')
+        cache.cache.delete(self.get_summary_cache_key())
+
+    @classmethod
+    def get_cache_generation(cls, thread_id):
+        """returns generation of the cached data of the thread,
+        the data cached in other generations is stale"""
+        return cls.objects.get_cache_generations([thread_id])[thread_id]
+
+    @classmethod
+    def make_cache_key(cls, thread_id, generation, name, *bits):
+        """returns key of the thread-scoped cache ``name``,
+        all such keys must include the cache generation of the thread"""
+        key_bits = ('thread', name, thread_id, generation) + bits
+        return '-'.join([unicode(bit) for bit in key_bits])
+
+    def get_cache_key(self, name, *bits):
+        generation = self.get_cache_generation(self.id)
+        return self.make_cache_key(self.id, generation, name, *bits)
+
+    def get_summary_cache_key(self):
+        return self.get_cache_key('question-summary')
 
     def get_post_data_cache_key(self, sort_method = None):
-        return 'thread-data-%s-%s' % (self.id, sort_method)
-
-    def invalidate_cached_post_data(self):
-        """needs to be called when anything notable 
-        changes in the post data - on votes, adding,
-        deleting, editing content"""
-        #we can call delete_many() here if using Django > 1.2
-        for sort_method in const.ANSWER_SORT_METHODS:
-            cache.cache.delete(self.get_post_data_cache_key(sort_method))
+        return self.get_cache_key('data', sort_method, POST_ROW_SCHEMA)
 
     def invalidate_cached_data(self):
-        self.invalidate_cached_post_data()
-        #self.invalidate_cached_thread_content_fragment()
-        self.update_summary_html()
+        """needs to be called when anything notable
+        changes in the thread - on votes, adding,
+        deleting, editing content, retagging
+
+        all thread-scoped caches: post data, summary,
+        similar threads and the question pages are made
+        stale at once by starting the next cache generation
+        """
+        key = self.GENERATION_KEY_TPL % self.id
+        try:
+            cache.cache.incr(key)
+        except ValueError:
+            #no generation yet or it was evicted
+            cache.cache.set(key, int(time.time()), const.LONG_TIME)
+        if hasattr(self, '_summary_html_cache'):
+            delattr(self, '_summary_html_cache')
 
     def get_cached_post_data(self, sort_method = 'votes'):
         """returns cached post data, as calculated by
-        the method get_post_data()"""
+        the method get_post_data()
+
+        the data is cached as rows of the post field values,
+        see :func:`pack_post_data`
+        """
         key = self.get_post_data_cache_key(sort_method)
-        post_data = cache.cache.get(key)
-        if not post_data:
-            post_data = self.get_post_data(sort_method)
-            cache.cache.set(key, post_data, const.LONG_TIME)
+        entry = cache.cache.get(key)
+        if entry is not None:
+            return unpack_post_data(entry)
+        post_data = self.get_post_data(sort_method)
+        question_post, answers, post_to_author = post_data
+        cache.cache.set(key, pack_post_data(question_post, answers), const.LONG_TIME)
         return post_data
 
+    def get_shown_answers(self):
+        """returns query set of the answers
+        shown on the question page"""
+        from askbot.conf import settings as askbot_settings # Avoid circular import
+        answers = self.posts.get_answers().filter(deleted = False)
+        if askbot_settings.ENABLE_CONTENT_MODERATION:
+            answers = answers.filter(approved = True)
+        return answers
+
+    def get_shown_accepted_answer_id(self):
+        """returns id of the accepted answer if it is shown
+        on top of the other answers, None otherwise"""
+        if self.accepted_answer_id is None:
+            return None
+        shown_answers = self.get_shown_answers()
+        if shown_answers.filter(id = self.accepted_answer_id).exists():
+            return self.accepted_answer_id
+        return None
+
+    def get_answer_position(self, answer, sort_method = 'votes'):
+        """returns zero based position of the answer on the question
+        page, the preceding answers are counted with one query"""
+        accepted_answer_id = self.get_shown_accepted_answer_id()
+        if answer.id == accepted_answer_id:
+            return 0
+
+        preceding = None
+        equal_values = dict()
+        for field in ANSWER_ORDERINGS[sort_method]:
+            name = field.lstrip('-')
+            lookup = '%s__%s' % (name, field.startswith('-') and 'gt' or 'lt')
+            filters = dict(equal_values)
+            filters[lookup] = getattr(answer, name)
+            condition = models.Q(**filters)
+            preceding = condition if preceding is None else preceding | condition
+            equal_values[name] = getattr(answer, name)
+
+        answers = self.get_shown_answers().filter(preceding)
+        if accepted_answer_id:
+            return answers.exclude(id = accepted_answer_id).count() + 1
+        return answers.count()
+
+    def get_answer_page(self, sort_method = 'votes', page = 1):
+        """returns question, answers on the page of the question page,
+        total number of the shown answers and post id -> author id
+        dictionary for the question, the answers and their comments
+
+        only the answers on the page and their comments are fetched,
+        the accepted answer goes in front of the others
+        """
+        page_size = const.ANSWERS_PAGE_SIZE
+        start, end = (page - 1)*page_size, page*page_size
+
+        answers = self.get_shown_answers()
+        answers = answers.order_by(*ANSWER_ORDERINGS[sort_method])
+        accepted_answer_id = self.get_shown_accepted_answer_id()
+        if accepted_answer_id:
+            answers = answers.exclude(id = accepted_answer_id)
+        answer_count = answers.count()
+
+        page_answers = list()
+        if accepted_answer_id:
+            answer_count += 1
+            if start == 0:
+                page_answers.append(self.posts.get(id = accepted_answer_id))
+            start, end = max(start - 1, 0), end - 1
+        page_answers.extend(answers[start:end])
+
+        question_post = self._question_post()
+        posts = [question_post] + page_answers
+        post_map = dict((post.id, post) for post in posts)
+        for post in posts:
+            post.set_cached_comments(list())
+
+        comments = Post.objects.get_comments().filter(
+                                        parent__in = post_map.keys(),
+                                        deleted = False
+                                    ).order_by('added_at')
+        post_to_author = dict()
+        for comment in comments:
+            if comment.is_approved() is False:
+                continue
+            post_map[comment.parent_id].get_cached_comments().append(comment)
+            post_to_author[comment.id] = comment.author_id
+        for post in posts:
+            post_to_author[post.id] = post.author_id
+
+        return question_post, page_answers, answer_count, post_to_author
+
+    def get_cached_answer_page(self, sort_method = 'votes', page = 1):
+        """cached version of the :meth:`get_answer_page`"""
+        key = self.get_cache_key('answer-page', sort_method, page, POST_ROW_SCHEMA)
+        entry = cache.cache.get(key)
+        if entry is not None:
+            question_post, answers, post_to_author = unpack_post_data(entry)
+            return question_post, answers, entry['answer_count'], post_to_author
+
+        answer_page = self.get_answer_page(sort_method, page)
+        question_post, answers, answer_count, post_to_author = answer_page
+        entry = pack_post_data(question_post, answers)
+        entry['answer_count'] = answer_count
+        cache.cache.set(key, entry, const.LONG_TIME)
+        return answer_page
+
     def get_post_data(self, sort_method = 'votes'):
         """returns question, answers as list and a list of post ids
         for the given thread
@@ -674,8 +1288,6 @@ class Thread(models.Model):
         """
 
         def get_data():
-            # todo: code in this function would be simpler if
-            # we had question post id denormalized on the thread
             tags_list = self.get_tag_names()
             language_code = translation.get_language()
             
@@ -684,11 +1296,9 @@ class Thread(models.Model):
                                         tags__name__in=tags_list,
                                         language_code=language_code,
                                         site=site,
+                                        deleted=False
                                     ).exclude(
                                         id = self.id
-                                    ).exclude(
-                                        posts__post_type='question',
-                                        posts__deleted = True
                                     ).distinct()[:100]
             similar_threads = list(similar_threads)
 
@@ -699,10 +1309,10 @@ class Thread(models.Model):
             similar_threads = similar_threads[:10]
 
             # Denormalize questions to speed up template rendering
-            # todo: just denormalize question_post_id on the thread!
             thread_map = dict([(thread.id, thread) for thread in similar_threads])
-            questions = Post.objects.get_questions()
-            questions = questions.select_related('thread').filter(thread__in=similar_threads)
+            questions = Post.objects.select_related('thread').filter(
+                            id__in=[thread.question_post_id for thread in similar_threads]
+                        )
             for q in questions:
                 thread_map[q.thread_id].question_denorm = q
 
@@ -726,7 +1336,7 @@ class Thread(models.Model):
             """similar thread data will expire
             with the default expiration delay
             """
-            key = 'similar-threads-%s' % self.id
+            key = self.get_cache_key('similar-threads')
             data = cache.cache.get(key)
             if data is None:
                 data = get_data()
@@ -786,6 +1396,12 @@ class Thread(models.Model):
         if removed_tagnames:
             removed_tags = [tag for tag in previous_tags if tag.name in removed_tagnames]
             self.tags.remove(*removed_tags)
+            removed_tag_ids = [tag.id for tag in removed_tags]
+            if not self.deleted:
+                TagCooccurrence.objects.remove_tags(
+                                    removed_tag_ids,
+                                    [tag.id for tag in previous_tags]
+                                )
 
             #if any of the removed tags reached use count == 1 that means they must be deleted
             for tag in removed_tags:
@@ -826,14 +1442,23 @@ class Thread(models.Model):
 
             #finally add tags to the relation and extend the modified list
             self.tags.add(*added_tags)
+            added_tag_ids = [tag.id for tag in added_tags]
+            if not self.deleted:
+                kept_tag_ids = [
+                    tag.id for tag in previous_tags
+                    if tag.name not in removed_tagnames
+                ]
+                TagCooccurrence.objects.add_tags(
+                                    added_tag_ids,
+                                    kept_tag_ids + added_tag_ids
+                                )
             modified_tags.extend(added_tags)
 
-        ####################################################################
-        self.update_summary_html() # regenerate question/thread summary html
-        ####################################################################
+        self.invalidate_cached_thread_content_fragment()
 
         #if there are any modified tags, update their use counts
         if modified_tags:
+            Thread.objects.invalidate_listing_counts()
             Tag.objects.update_use_counts(modified_tags)
             signals.tags_updated.send(None,
                                 thread = self,
@@ -877,6 +1502,7 @@ class Thread(models.Model):
             summary    = const.POST_STATUS['retagged'],
             text       = latest_revision.text
         )
+        self.invalidate_cached_data()
 
     def has_favorite_by_user(self, user):
         if not user.is_authenticated():
@@ -898,7 +1524,9 @@ class Thread(models.Model):
         return last_updated_at, last_updated_by
 
     def get_summary_html(self, search_state):
-        html = self.update_summary_html()
+        html = self.get_cached_summary_html()
+        if html is None:
+            html = self.update_summary_html()
 
         # use `<<<` and `>>>` because they cannot be confused with user input
         # - if user accidentialy types <<<tag-name>>> into question title or body,
@@ -919,36 +1547,130 @@ class Thread(models.Model):
 
         return html
 
-    def update_summary_html(self):
+    def get_cached_summary_html(self):
+        html = getattr(self, '_summary_html_cache', None)
+        if html is None:
+            html = cache.cache.get(self.get_summary_cache_key())
+        return html
+
+    def render_summary_html(self):
         context = {
             'thread': self,
-            'question': self._question_post(refresh=True),  # fetch new question post to make sure we're up-to-date
+            'question': self._question_post(),
             'search_state': DummySearchState(),
         }
-        html = get_template('widgets/question_summary.html').render(context)
+        return get_template('widgets/question_summary.html').render(context)
+
+    def update_summary_html(self):
+        self._question_post(refresh=True) # fetch new question post to make sure we're up-to-date
+        if hasattr(self, '_summary_html_cache'):
+            delattr(self, '_summary_html_cache')
+        html = self.render_summary_html()
         # INFO: Timeout is set to 30 days:
         # * timeout=0/None is not a reliable cross-backend way to set infinite timeout
         # * We probably don't need to pollute the cache with threads older than 30 days
         # * Additionally, Memcached treats timeouts > 30day as dates (https://code.djangoproject.com/browser/django/tags/releases/1.3/django/core/cache/backends/memcached.py#L36),
         #   which probably doesn't break anything but if we can stick to 30 days then let's stick to it
         cache.cache.set(
-            self.SUMMARY_CACHE_KEY_TPL % self.id,
+            self.get_summary_cache_key(),
             html,
             timeout=const.LONG_TIME
         )
         return html
 
     def summary_html_cached(self):
-        return cache.cache.has_key(self.SUMMARY_CACHE_KEY_TPL % self.id)
+        return cache.cache.has_key(self.get_summary_cache_key())
+
+class QuestionViewManager(models.Manager):
+
+    def record_view(self, user_id, question_id, timestamp):
+        """writes the view of the question by the user, or queues
+        it in the cache for the ``flush_view_counts`` command,
+        when ASKBOT_DEFER_VIEW_COUNTS is on"""
+        if getattr(settings, 'ASKBOT_DEFER_VIEW_COUNTS', False):
+            pending_question_views.put((user_id, question_id, timestamp))
+        else:
+            self.record_views({(user_id, question_id): timestamp})
+
+    def flush_pending_views(self):
+        """writes the views queued by :meth:`record_view`,
+        repeated views of a question by the same user are written once,
+        returns the number of the written records"""
+        views = dict()
+        for user_id, question_id, timestamp in pending_question_views.take():
+            views[(user_id, question_id)] = timestamp
+        for batch in batch_size(views.items(), const.QUESTION_VIEW_BATCH_SIZE):
+            transaction.commit_on_success(self.record_views)(dict(batch))
+        return len(views)
+
+    def record_views(self, views):
+        """creates or updates the view records, ``views``
+        is a dictionary (user id, question id) -> time of the view,
+        with one select, one update and one insert
+        """
+        if not views:
+            return
+        pairs = [
+            models.Q(who = user_id, question = question_id)
+            for user_id, question_id in views
+        ]
+        existing = self.filter(
+                        reduce(operator.or_, pairs)
+                    ).values_list('id', 'who', 'question')
+
+        updates = list()
+        new_views = dict(views)
+        for view_id, user_id, question_id in existing:
+            updates.append((view_id, views[(user_id, question_id)]))
+            new_views.pop((user_id, question_id), None)
+
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        cursor = connection.cursor()
+        if updates:
+            params = list()
+            for view_id, timestamp in updates:
+                params.extend((view_id, timestamp))
+            params.extend([view_id for view_id, timestamp in updates])
+            cursor.execute(
+                'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                    qn(opts.db_table),
+                    qn(opts.get_field('when').column),
+                    qn(opts.pk.column),
+                    ' '.join(['WHEN %s THEN %s'] * len(updates)),
+                    qn(opts.pk.column),
+                    ', '.join(['%s'] * len(updates))
+                ),
+                params
+            )
+        if new_views:
+            #there is no bulk_create in Django 1.3
+            cursor.executemany(
+                'INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)' % (
+                    qn(opts.db_table),
+                    qn(opts.get_field('who').column),
+                    qn(opts.get_field('question').column),
+                    qn(opts.get_field('when').column)
+                ),
+                [
+                    (user_id, question_id, timestamp)
+                    for (user_id, question_id), timestamp in new_views.items()
+                ]
+            )
+        transaction.commit_unless_managed()
+
 
 class QuestionView(models.Model):
     question = models.ForeignKey(Post, related_name='viewed')
     who = models.ForeignKey(User, related_name='question_views')
     when = models.DateTimeField()
 
+    objects = QuestionViewManager()
+
     class Meta:
         app_label = 'askbot'
 
+
 class FavoriteQuestion(models.Model):
     """A favorite Question of a User."""
     thread        = models.ForeignKey(Thread)
@@ -1,5 +1,8 @@
 import re
-from django.db import models
+import time
+from django.core import cache
+from django.db import connection, models, transaction
+from django.db.utils import IntegrityError
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext as _
 from askbot.models.base import BaseQuerySetManager
@@ -27,6 +30,287 @@ def get_mandatory_tags():
         split_re = re.compile(const.TAG_SPLIT_REGEX)
         return split_re.split(raw_mandatory_tags)
 
+USER_TAG_FILTER_VERSION_KEY = 'user-tag-filter-version-%d'
+WILDCARD_TAGS_GENERATION_KEY = 'wildcard-tags-generation'
+#parts of the index of the tag based whole forum email subscriptions,
+#by the frequency of the feeds
+TAG_SUBSCRIPTIONS_KEY_TPL = 'tag-subscriptions-%s-%s'
+#users who marked the tag, by the frequency, the reason and the tag id
+TAG_SUBSCRIBERS_KEY_TPL = 'tag-subscribers-%s-%s-%d'
+TAG_SUBSCRIPTIONS_PARTS = ('all', 'ignoring', 'good-wildcards', 'bad-wildcards')
+
+def _increment_cache_version(key):
+    try:
+        cache.cache.incr(key)
+    except ValueError:
+        #no version yet or it was evicted
+        cache.cache.set(key, int(time.time()), const.LONG_TIME)
+
+def invalidate_user_tag_filter(user_id):
+    """makes the compiled tag filter of the user stale,
+    to be called when the user marks tags or wildcards"""
+    _increment_cache_version(USER_TAG_FILTER_VERSION_KEY % user_id)
+
+def invalidate_wildcard_tag_filters():
+    """makes the compiled tag filters of the users with
+    wildcard selections stale, to be called when new tags
+    are created, because they may match the wildcards"""
+    _increment_cache_version(WILDCARD_TAGS_GENERATION_KEY)
+
+def get_subscription_frequencies():
+    return [frequency for frequency, label in const.NOTIFICATION_DELIVERY_SCHEDULE_CHOICES]
+
+def invalidate_tag_subscriptions(user_id):
+    """makes the parts of the index of the tag based whole forum
+    email subscriptions that depend on the user stale, to be called
+    when the user changes the email tag filter strategy, the wildcards
+    or the whole forum feed"""
+    keys = list()
+    for frequency in get_subscription_frequencies():
+        keys.extend([
+            TAG_SUBSCRIPTIONS_KEY_TPL % (frequency, part)
+            for part in TAG_SUBSCRIPTIONS_PARTS
+        ])
+    cache.cache.delete_many(keys)
+    tag_ids = MarkedTag.objects.filter(
+                            user = user_id, reason__in = ('good', 'bad')
+                        ).values_list('tag', flat = True)
+    invalidate_tag_subscribers(tag_ids)
+
+def invalidate_tag_subscribers(tag_ids):
+    """makes the cached subscribers of the tags stale,
+    to be called when users mark or unmark the tags"""
+    tag_ids = list(tag_ids)
+    keys = list()
+    for frequency in get_subscription_frequencies():
+        for reason in ('good', 'bad'):
+            keys.extend([
+                TAG_SUBSCRIBERS_KEY_TPL % (frequency, reason, tag_id)
+                for tag_id in tag_ids
+            ])
+    cache.cache.delete_many(keys)
+
+def compile_user_tag_filter(user_id, interesting_wildcards, ignored_wildcards):
+    """returns dictionary with ids of the interesting and ignored tags
+    of the user, including the tags matching the wildcards,
+    and names of the marked tags"""
+    tag_filter = {
+        'interesting_tag_ids': set(),
+        'ignored_tag_ids': set(),
+        'interesting_tag_names': list(),
+        'ignored_tag_names': list(),
+        'subscribed_tag_names': list(),
+    }
+    marks = MarkedTag.objects.filter(user = user_id)
+    marks = marks.values_list('reason', 'tag__id', 'tag__name')
+    for reason, tag_id, tag_name in marks:
+        if reason == 'good':
+            tag_filter['interesting_tag_ids'].add(tag_id)
+            tag_filter['interesting_tag_names'].append(tag_name)
+        elif reason == 'bad':
+            tag_filter['ignored_tag_ids'].add(tag_id)
+            tag_filter['ignored_tag_names'].append(tag_name)
+        elif reason == 'subscribed':
+            tag_filter['subscribed_tag_names'].append(tag_name)
+
+    if interesting_wildcards:
+        tags = Tag.objects.get_by_wildcards(interesting_wildcards)
+        tag_filter['interesting_tag_ids'].update(tags.values_list('id', flat = True))
+    if ignored_wildcards:
+        tags = Tag.objects.get_by_wildcards(ignored_wildcards)
+        tag_filter['ignored_tag_ids'].update(tags.values_list('id', flat = True))
+    return tag_filter
+
+def get_user_tag_filter(user, use_wildcards = False):
+    """returns compiled tag filter of the user
+    (see :func:`compile_user_tag_filter`) from the cache,
+    the filter is recompiled when the user changes the tag
+    selections and, if the user has wildcards, when tags are added
+    """
+    profile = user.get_profile()
+    if use_wildcards:
+        interesting_wildcards = profile.interesting_tags.split()
+        ignored_wildcards = profile.ignored_tags.split()
+    else:
+        interesting_wildcards = ignored_wildcards = list()
+
+    version_key = USER_TAG_FILTER_VERSION_KEY % user.id
+    version_keys = [version_key]
+    if interesting_wildcards or ignored_wildcards:
+        version_keys.append(WILDCARD_TAGS_GENERATION_KEY)
+    versions = cache.cache.get_many(version_keys)
+    for key in version_keys:
+        if key not in versions:
+            versions[key] = int(time.time())
+            cache.cache.set(key, versions[key], const.LONG_TIME)
+
+    cache_key = 'user-tag-filter-%d-%s' % (
+        user.id,
+        '-'.join([str(versions[key]) for key in version_keys])
+    )
+    tag_filter = cache.cache.get(cache_key)
+    if tag_filter is None:
+        tag_filter = compile_user_tag_filter(
+                                user.id,
+                                interesting_wildcards,
+                                ignored_wildcards
+                            )
+        cache.cache.set(
+            cache_key, tag_filter, const.USER_TAG_FILTER_CACHE_TIMEOUT
+        )
+    return tag_filter
+
+def add_wildcard_to_trie(trie, wildcard, user_id):
+    """adds user id to the node of the prefix ``trie``
+    reached by the prefix of the ``wildcard``,
+    nodes keep the user ids under the ``None`` key"""
+    node = trie
+    for char in wildcard[:-1]:
+        node = node.setdefault(char, dict())
+    node.setdefault(None, set()).add(user_id)
+
+def get_trie_matches(trie, tag_name):
+    """returns set of ids of the users in the prefix ``trie``
+    whose wildcards match the tag name"""
+    user_ids = set(trie.get(None, ()))
+    node = trie
+    for char in tag_name:
+        node = node.get(char)
+        if node is None:
+            break
+        user_ids.update(node.get(None, ()))
+    return user_ids
+
+def get_subscribed_profiles(frequency, strategy):
+    """returns query set of the profiles of the users with the whole
+    forum feed of the given ``frequency`` and the email tag filter
+    ``strategy``"""
+    from askbot.models.user import EmailFeedSetting
+    from userena.utils import get_profile_model
+    feeds = EmailFeedSetting.objects.filter(
+                                feed_type = 'q_all', frequency = frequency
+                            )
+    return get_profile_model().objects.filter(
+                                user__in = feeds.values('subscriber'),
+                                email_tag_filter_strategy = strategy
+                            )
+
+def compile_tag_subscriptions_part(frequency, part):
+    """returns part of the index of the tag based subscriptions,
+    for the feeds with the given ``frequency``:
+
+    * 'all' - ids of the users who do not filter by tags
+    * 'ignoring' - ids of the users who exclude ignored tags
+    * 'good-wildcards', 'bad-wildcards' - prefix tries of
+      the interesting and of the ignored wildcards of the users
+    """
+    if part == 'all':
+        profiles = get_subscribed_profiles(frequency, const.INCLUDE_ALL)
+        return set(profiles.values_list('user', flat = True))
+    elif part == 'ignoring':
+        profiles = get_subscribed_profiles(frequency, const.EXCLUDE_IGNORED)
+        return set(profiles.values_list('user', flat = True))
+    elif part == 'good-wildcards':
+        profiles = get_subscribed_profiles(frequency, const.INCLUDE_INTERESTING)
+        wildcards = profiles.exclude(
+                        interesting_tags = ''
+                    ).values_list('user', 'interesting_tags')
+    elif part == 'bad-wildcards':
+        profiles = get_subscribed_profiles(frequency, const.EXCLUDE_IGNORED)
+        wildcards = profiles.exclude(
+                        ignored_tags = ''
+                    ).values_list('user', 'ignored_tags')
+    else:
+        raise ValueError('Unknown part of tag subscriptions %s' % part)
+    trie = dict()
+    for user_id, user_wildcards in wildcards:
+        for wildcard in user_wildcards.split():
+            add_wildcard_to_trie(trie, wildcard, user_id)
+    return trie
+
+def get_tag_subscriptions_part(frequency, part):
+    """returns part of the index of the tag based subscriptions
+    (see :func:`compile_tag_subscriptions_part`) from the cache"""
+    cache_key = TAG_SUBSCRIPTIONS_KEY_TPL % (frequency, part)
+    value = cache.cache.get(cache_key)
+    if value is None:
+        value = compile_tag_subscriptions_part(frequency, part)
+        cache.cache.set(cache_key, value, const.TAG_SUBSCRIPTIONS_CACHE_TIMEOUT)
+    return value
+
+def get_marked_tag_subscribers(tag_ids, frequency, reason):
+    """returns set of ids of the users subscribed to the whole
+    forum with the given ``frequency``, who marked any of the tags
+    for the ``reason`` - 'good' for the users following only the
+    interesting tags, 'bad' - for the users excluding the ignored ones
+
+    subscribers of each tag are cached under a key of their own,
+    the missing ones are loaded with one query
+    """
+    keys = dict(
+        (TAG_SUBSCRIBERS_KEY_TPL % (frequency, reason, tag_id), tag_id)
+        for tag_id in tag_ids
+    )
+    cached = cache.cache.get_many(keys.keys())
+    user_ids = set()
+    for subscribers in cached.values():
+        user_ids.update(subscribers)
+
+    missing_tag_ids = [keys[key] for key in keys if key not in cached]
+    if missing_tag_ids:
+        if reason == 'good':
+            strategy = const.INCLUDE_INTERESTING
+        else:
+            strategy = const.EXCLUDE_IGNORED
+        profiles = get_subscribed_profiles(frequency, strategy)
+        marks = MarkedTag.objects.filter(
+                                tag__in = missing_tag_ids,
+                                reason = reason,
+                                user__in = profiles.values('user')
+                            ).values_list('tag', 'user')
+        subscribers = dict((tag_id, set()) for tag_id in missing_tag_ids)
+        for tag_id, user_id in marks:
+            subscribers[tag_id].add(user_id)
+            user_ids.add(user_id)
+        cache.cache.set_many(
+            dict(
+                (TAG_SUBSCRIBERS_KEY_TPL % (frequency, reason, tag_id), tag_user_ids)
+                for tag_id, tag_user_ids in subscribers.items()
+            ),
+            const.TAG_SUBSCRIPTIONS_CACHE_TIMEOUT
+        )
+    return user_ids
+
+def get_tag_subscribers(
+                    tag_ids = None,
+                    tag_names = None,
+                    frequency = 'i',
+                    strategy = None,
+                    use_wildcards = False
+                ):
+    """returns set of ids of the users, subscribed to the whole
+    forum with the given ``frequency`` and the email tag filter
+    ``strategy``, whose tag filters let through questions
+    with the given tags"""
+    if strategy == const.INCLUDE_ALL:
+        return set(get_tag_subscriptions_part(frequency, 'all'))
+    elif strategy == const.INCLUDE_INTERESTING:
+        reason = 'good'
+    elif strategy == const.EXCLUDE_IGNORED:
+        reason = 'bad'
+    else:
+        raise ValueError('Unknown email tag filter strategy %s' % strategy)
+
+    user_ids = get_marked_tag_subscribers(tag_ids or (), frequency, reason)
+    if use_wildcards:
+        trie = get_tag_subscriptions_part(frequency, reason + '-wildcards')
+        for tag_name in tag_names or ():
+            user_ids.update(get_trie_matches(trie, tag_name))
+
+    if strategy == const.EXCLUDE_IGNORED:
+        return get_tag_subscriptions_part(frequency, 'ignoring') - user_ids
+    return user_ids
+
 class TagQuerySet(models.query.QuerySet):
     def get_valid_tags(self, page_size):
         tags = self.all().filter(deleted=False).exclude(used_count=0).order_by("-id")[:page_size]
@@ -74,6 +358,45 @@ class TagQuerySet(models.query.QuerySet):
         tags = tags.exclude(deleted = True)
         return list(tags[:50])
 
+    def get_related_to_tags(self, tag_ids, ignored_tag_names, limit = 50):
+        """Returns tags used together with each of the given tags
+        in the whole forum, according to :class:`TagCooccurrence`,
+        ``local_used_count`` of the tags is the smallest number of
+        threads shared with one of the given tags
+
+        With several given tags the count is an upper bound
+        of the threads tagged with all of them - the pairs
+        do not tell how many threads have all the tags.
+        """
+        tag_ids = set(tag_ids)
+        counts = TagCooccurrence.objects.filter(
+                                    tag__in = tag_ids,
+                                    thread_count__gt = 0
+                                ).exclude(
+                                    other_tag__in = tag_ids
+                                ).exclude(
+                                    other_tag__deleted = True
+                                )
+        if ignored_tag_names:
+            counts = counts.exclude(other_tag__name__in = ignored_tag_names)
+        counts = counts.values(
+                            'other_tag'
+                        ).annotate(
+                            local_used_count = models.Min('thread_count'),
+                            selected_tag_count = models.Count('tag')
+                        ).filter(
+                            selected_tag_count = len(tag_ids)
+                        ).order_by('-local_used_count')[:limit]
+        counts = dict([
+                    (item['other_tag'], item['local_used_count'])
+                    for item in counts
+                ])
+        tags = list(self.filter(id__in = counts.keys()))
+        for tag in tags:
+            tag.local_used_count = counts[tag.id]
+        tags.sort(key = lambda tag: (-tag.local_used_count, tag.name))
+        return tags
+
 
 class TagManager(BaseQuerySetManager):
     """chainable custom filter query set manager
@@ -168,3 +491,114 @@ class MarkedTag(models.Model):
 
     class Meta:
         app_label = 'askbot'
+
+
+class TagCooccurrenceManager(models.Manager):
+
+    def _change_counts(self, changed_tag_ids, tag_ids, delta):
+        """adds ``delta`` to the counts of all pairs of the tags,
+        where at least one tag is among the changed ones"""
+        changed_tag_ids = set(changed_tag_ids)
+        tag_ids = set(tag_ids) | changed_tag_ids
+        for tag_id in tag_ids:
+            if tag_id in changed_tag_ids:
+                other_tag_ids = tag_ids - set([tag_id])
+            else:
+                other_tag_ids = changed_tag_ids
+            if not other_tag_ids:
+                continue
+            pairs = self.filter(tag = tag_id, other_tag__in = other_tag_ids)
+            if delta < 0:
+                pairs = pairs.filter(thread_count__gt = 0)
+                pairs.update(thread_count = models.F('thread_count') + delta)
+                continue
+            existing_ids = set(pairs.values_list('other_tag', flat = True))
+            pairs.update(thread_count = models.F('thread_count') + delta)
+            for other_tag_id in other_tag_ids - existing_ids:
+                self._create_or_increment(tag_id, other_tag_id, delta)
+
+    def _create_or_increment(self, tag_id, other_tag_id, delta):
+        """creates the pair, or adds ``delta`` to its count
+        if a concurrent request has created it in the meantime"""
+        #the savepoint keeps the transaction usable
+        #after the failed insert on postgresql
+        savepoint = transaction.savepoint()
+        try:
+            self.create(
+                    tag_id = tag_id,
+                    other_tag_id = other_tag_id,
+                    thread_count = delta
+                )
+        except IntegrityError:
+            transaction.savepoint_rollback(savepoint)
+            self.filter(
+                tag = tag_id,
+                other_tag = other_tag_id
+            ).update(thread_count = models.F('thread_count') + delta)
+        else:
+            transaction.savepoint_commit(savepoint)
+
+    def add_tags(self, added_tag_ids, tag_ids):
+        """counts the thread, tagged with ``tag_ids``
+        for the pairs with the newly added tags"""
+        self._change_counts(added_tag_ids, tag_ids, 1)
+
+    def remove_tags(self, removed_tag_ids, tag_ids):
+        """discounts the thread, which was tagged with ``tag_ids``,
+        for the pairs with the removed tags"""
+        self._change_counts(removed_tag_ids, tag_ids, -1)
+
+    def recount(self):
+        """deletes all pairs and counts them again
+        over the threads that are not deleted,
+        with one grouped self-join of the thread - tag table"""
+        from askbot.models.question import Thread
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        tags_field = Thread._meta.get_field('tags')
+        thread_tag_table = qn(tags_field.m2m_db_table())
+        thread_column = qn(tags_field.m2m_column_name())
+        tag_column = qn(tags_field.m2m_reverse_name())
+
+        self.all().delete()
+        cursor = connection.cursor()
+        cursor.execute(
+            'INSERT INTO %(table)s (%(tag)s, %(other_tag)s, %(count)s) '
+            'SELECT t1.%(tag_id)s, t2.%(tag_id)s, COUNT(*) '
+            'FROM %(thread_tag)s t1 '
+            'INNER JOIN %(thread_tag)s t2 '
+            'ON t2.%(thread_id)s = t1.%(thread_id)s '
+            'AND t2.%(tag_id)s <> t1.%(tag_id)s '
+            'INNER JOIN %(thread)s th ON th.%(pk)s = t1.%(thread_id)s '
+            'WHERE th.%(deleted)s = %%s '
+            'GROUP BY t1.%(tag_id)s, t2.%(tag_id)s' % {
+                'table': qn(opts.db_table),
+                'tag': qn(opts.get_field('tag').column),
+                'other_tag': qn(opts.get_field('other_tag').column),
+                'count': qn(opts.get_field('thread_count').column),
+                'thread_tag': thread_tag_table,
+                'thread_id': thread_column,
+                'tag_id': tag_column,
+                'thread': qn(Thread._meta.db_table),
+                'pk': qn(Thread._meta.pk.column),
+                'deleted': qn(Thread._meta.get_field('deleted').column),
+            },
+            [False]
+        )
+        transaction.commit_unless_managed()
+
+
+class TagCooccurrence(models.Model):
+    """number of threads tagged with both tags,
+    each pair is stored in both orders, so that
+    related tags are looked up by the ``tag`` alone
+    """
+    tag = models.ForeignKey('Tag', related_name = '+')
+    other_tag = models.ForeignKey('Tag', related_name = '+')
+    thread_count = models.PositiveIntegerField(default = 0)
+
+    objects = TagCooccurrenceManager()
+
+    class Meta:
+        app_label = 'askbot'
+        unique_together = ('tag', 'other_tag')
@@ -6,6 +6,7 @@ from django.db.backends.dummy.base import IntegrityError
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.contrib.auth.models import User
+from django.core import cache
 from django.core import exceptions
 from django.forms import EmailField, URLField
 from django.utils.translation import ugettext as _
@@ -13,6 +14,7 @@ from django.utils.html import strip_tags
 from askbot import const
 from askbot.utils import functions
 from askbot.models.tag import Tag
+from askbot.models.tag import invalidate_tag_subscriptions
 #from askbot.forms import DomainNameField
 from askbot.utils.forms import email_is_allowed
 
@@ -85,7 +87,6 @@ class ActivityManager(models.Manager):
         if mentioned_whom:
             assert(isinstance(mentioned_whom, User))
             mention_activity.add_recipients([mentioned_whom])
-            mentioned_whom.get_profile().update_response_counts()
 
         return mention_activity
 
@@ -138,6 +139,32 @@ class ActivityManager(models.Manager):
         return self.filter(**kwargs)
 
 
+def get_unseen_question_ids_cache_key(user_id):
+    return 'user-unseen-questions-%d' % user_id
+
+def get_unseen_question_ids(user_id):
+    """returns set of ids of the questions, to which refer
+    new (unseen) activity records of the user"""
+    key = get_unseen_question_ids_cache_key(user_id)
+    question_ids = cache.cache.get(key)
+    if question_ids is None:
+        question_ids = ActivityAuditStatus.objects.filter(
+                                user = user_id,
+                                status = ActivityAuditStatus.STATUS_NEW,
+                                activity__question__isnull = False
+                            ).values_list('activity__question', flat = True)
+        question_ids = set(question_ids)
+        cache.cache.set(key, question_ids, const.UNSEEN_QUESTIONS_CACHE_TIMEOUT)
+    return question_ids
+
+def invalidate_unseen_question_ids(user_ids):
+    """to be called when activity records of the users
+    are added or change the status"""
+    cache.cache.delete_many(
+        [get_unseen_question_ids_cache_key(user_id) for user_id in user_ids]
+    )
+
+
 class ActivityAuditStatus(models.Model):
     """bridge "through" relation between activity and users"""
     STATUS_NEW = 0
@@ -192,11 +219,42 @@ class Activity(models.Model):
     def add_recipients(self, recipients):
         """have to use a special method, because django does not allow
         auto-adding to M2M with "through" model
+
+        the audit records are inserted at once and, for the response
+        activities, the counts of the new responses of the recipients
+        are incremented with one update
         """
-        for recipient in recipients:
-            #todo: may optimize for bulk addition
-            aas = ActivityAuditStatus(user = recipient, activity = self)
-            aas.save()
+        recipients = list(recipients)
+        if len(recipients) == 0:
+            return
+        audit_records = [
+            ActivityAuditStatus(user = recipient, activity = self)
+            for recipient in recipients
+        ]
+        if hasattr(ActivityAuditStatus.objects, 'bulk_create'):
+            ActivityAuditStatus.objects.bulk_create(audit_records)
+        else:
+            #django < 1.4
+            for audit_record in audit_records:
+                audit_record.save()
+
+        recipient_ids = [recipient.id for recipient in recipients]
+        response_types = const.RESPONSE_ACTIVITY_TYPES_FOR_DISPLAY
+        response_types += (const.TYPE_ACTIVITY_MENTION,)
+        if self.activity_type in response_types:
+            from userena.utils import get_profile_model
+            get_profile_model().objects.filter(
+                user__in = recipient_ids
+            ).update(
+                new_response_count = models.F('new_response_count') + 1
+            )
+            #keep the loaded profiles in step with the database
+            for recipient in recipients:
+                profile = getattr(recipient, '_profile_cache', None)
+                if profile is not None:
+                    profile.new_response_count += 1
+
+        invalidate_unseen_question_ids(recipient_ids)
 
     def get_mentioned_user(self):
         assert(self.activity_type == const.TYPE_ACTIVITY_MENTION)
@@ -314,6 +372,10 @@ class EmailFeedSetting(models.Model):
                                                      reported_at
                                                  )
 
+    def __init__(self, *args, **kwargs):
+        super(EmailFeedSetting, self).__init__(*args, **kwargs)
+        self._saved_frequency = self.__dict__.get('frequency')
+
     def save(self,*args,**kwargs):
         type = self.feed_type
         subscriber = self.subscriber
@@ -323,7 +385,13 @@ class EmailFeedSetting(models.Model):
                                         ).exclude(pk=self.id)
         if len(similar) > 0:
             raise IntegrityError('email feed setting already exists')
+        is_new = self.pk is None
         super(EmailFeedSetting,self).save(*args,**kwargs)
+        #whole forum feeds are in the index of tag based subscriptions
+        if self.feed_type == 'q_all':
+            if is_new or self.frequency != self._saved_frequency:
+                invalidate_tag_subscriptions(self.subscriber_id)
+        self._saved_frequency = self.frequency
 
     def get_previous_report_cutoff_time(self):
         now = datetime.datetime.now()
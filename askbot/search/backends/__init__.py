@@ -0,0 +1,143 @@
+"""pluggable full text search backends
+
+A backend is selected with the ``ASKBOT_SEARCH_BACKEND``
+setting - a python path to the backend class, for example::
+
+    ASKBOT_SEARCH_BACKEND = 'askbot.search.backends.inverted_index.InvertedIndexBackend'
+
+available backends:
+
+* :class:`inverted_index.InvertedIndexBackend` - pure python
+* :class:`sqlite_fts.SqliteFtsBackend` - SQLite FTS5
+
+Without the setting the questions are searched with the
+``icontains`` lookups, see ``ThreadManager.get_for_query``.
+
+Backends index whole threads - title, tags and the text
+of the question and the answers, the index is kept up to
+date by the celery tasks, which are started by the signal
+handlers in :mod:`askbot.models`.
+"""
+import re
+from itertools import islice
+from django.conf import settings as django_settings
+from askbot import const
+from askbot.utils.loading import load_module
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+#backend instances by the class path
+_BACKENDS = {}
+
+def tokenize(text):
+    """returns list of lowercased words in the text"""
+    if not text:
+        return []
+    return WORD_RE.findall(text.lower())
+
+def get_thread_fields(thread):
+    """returns dictionary with the indexed text of the thread:
+    'title', 'tagnames' and 'text' - text of the question and
+    of the answers, that are not deleted
+    """
+    from askbot.models import Post
+    texts = Post.objects.filter(
+                        thread = thread,
+                        post_type__in = ('question', 'answer'),
+                        deleted = False
+                    ).values_list('text', flat = True)
+    return {
+        'title': thread.title,
+        'tagnames': thread.tagnames,
+        'text': u'\n'.join(texts)
+    }
+
+def get_relevance_sql(ranked_ids, table_name):
+    """returns SQL expression for the 'relevance' column of
+    the threads, ``ranked_ids`` - are ordered by relevance,
+    threads not in the list get relevance 0
+    """
+    if not ranked_ids:
+        return '0'
+    count = len(ranked_ids)
+    cases = ' '.join([
+                    'WHEN %d THEN %d' % (int(thread_id), count - position)
+                    for position, thread_id in enumerate(ranked_ids)
+                ])
+    return 'CASE %s.id %s ELSE 0 END' % (table_name, cases)
+
+def filter_ranked_ids(ranked_ids, limit, filter_ids = None):
+    """returns at most ``limit`` of the ``ranked_ids`` - iterable
+    of the thread ids, the most relevant first
+
+    ``filter_ids`` - optional function taking a list of ids and
+    returning those that may be ranked, it is called on the batches
+    of the ids from the top of the ranking until the limit is reached
+    """
+    if filter_ids is None:
+        return list(islice(ranked_ids, limit))
+    result = list()
+    ranked_ids = iter(ranked_ids)
+    while len(result) < limit:
+        batch = list(islice(ranked_ids, const.SEARCH_RANK_BATCH_SIZE))
+        if not batch:
+            break
+        accepted = set(filter_ids(batch))
+        for thread_id in batch:
+            if thread_id in accepted:
+                result.append(thread_id)
+                if len(result) == limit:
+                    break
+    return result
+
+
+class SearchBackend(object):
+    """base class of the search backends"""
+
+    #True if the backend implements method rank()
+    supports_relevance = False
+
+    def search(self, query, limit = None):
+        """returns list of ids of threads matching
+        all words in the query, at most ``limit`` of them"""
+        raise NotImplementedError()
+
+    def rank(self, query, limit, filter_ids = None):
+        """returns at most ``limit`` ids of the threads matching
+        the query, the most relevant first, the threads are scored
+        with BM25, see :mod:`askbot.search.bm25`
+
+        ``filter_ids`` - restricts the ranked threads,
+        see :func:`filter_ranked_ids`
+        """
+        raise NotImplementedError()
+
+    def index_thread(self, thread):
+        """adds thread to the index or updates it"""
+        raise NotImplementedError()
+
+    def remove_thread(self, thread_id):
+        """removes thread from the index"""
+        raise NotImplementedError()
+
+    def clear(self):
+        """removes everything from the index"""
+        raise NotImplementedError()
+
+    def rebuild(self, threads):
+        """replaces the index with the given threads"""
+        self.clear()
+        for thread in threads:
+            self.index_thread(thread)
+
+
+def get_backend():
+    """returns instance of the configured search backend
+    or ``None``, if the backend is not configured"""
+    backend_path = getattr(django_settings, 'ASKBOT_SEARCH_BACKEND', None)
+    if not backend_path:
+        return None
+    if backend_path not in _BACKENDS:
+        backend_class = load_module(backend_path)
+        _BACKENDS[backend_path] = backend_class()
+    return _BACKENDS[backend_path]
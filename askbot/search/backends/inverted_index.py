@@ -0,0 +1,226 @@
+"""pure python inverted index of the threads
+
+The index lives in a ``shelve`` file in the directory given
+by the ``ASKBOT_SEARCH_INDEX_DIR`` setting and holds these records:
+
+* ``term:<word>`` - sorted list of numbers of the posting blocks
+  of the word and the number of threads containing the word
+* ``block:<word>:<number>`` - posting block, dictionary thread id ->
+  normalized frequency of the word in the thread, for the threads
+  with ids from ``number * POSTING_BLOCK_SIZE`` up to the next block,
+  the frequencies are used to score the threads with BM25
+* ``thread:<id>`` - words of the thread and its length, used to take
+  the thread out of the postings when it is updated or removed
+* ``stats`` - number of the threads and their total length
+
+Postings are split into the blocks, so that indexing a thread
+rewrites one block per word, not the postings of the whole corpus.
+
+Frequencies are normalized with the average thread length
+at the time of indexing, the ``rebuild_search_index``
+command brings them in line with the current average.
+
+Writers take an exclusive lock on a file next to the index,
+readers - a shared one, so that the index can be used
+from several processes on the same host. The threads are
+indexed by a celery task, outside of the web requests.
+"""
+import fcntl
+import os
+import shelve
+from contextlib import contextmanager
+from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
+from askbot.search import bm25
+from askbot.search.backends import SearchBackend
+from askbot.search.backends import filter_ranked_ids
+from askbot.search.backends import get_thread_fields, tokenize
+
+INDEX_FILE_NAME = 'threads.index'
+STATS_KEY = 'stats'
+#range of the thread ids in one posting block
+POSTING_BLOCK_SIZE = 1024
+
+def get_term_key(term):
+    return 'term:' + term.encode('utf-8')
+
+def get_block_key(term, block_number):
+    return 'block:%s:%d' % (term.encode('utf-8'), block_number)
+
+def get_thread_key(thread_id):
+    return 'thread:%d' % thread_id
+
+
+class InvertedIndexBackend(SearchBackend):
+
+    supports_relevance = True
+
+    def __init__(self):
+        index_dir = getattr(django_settings, 'ASKBOT_SEARCH_INDEX_DIR', None)
+        if not index_dir:
+            raise ImproperlyConfigured(
+                'ASKBOT_SEARCH_INDEX_DIR setting is required '
+                'by the inverted index search backend'
+            )
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        self.index_path = os.path.join(index_dir, INDEX_FILE_NAME)
+        self.lock_path = self.index_path + '.lock'
+
+    @contextmanager
+    def open_index(self, write = False):
+        """opens the index shelf under the file lock"""
+        lock_file = open(self.lock_path, 'a')
+        try:
+            if write:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            else:
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+            index = shelve.open(self.index_path, flag = 'c', protocol = 2)
+            try:
+                yield index
+            finally:
+                index.close()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def _add_posting(self, index, term, thread_id, frequency):
+        term_key = get_term_key(term)
+        term_record = index.get(term_key, {'blocks': [], 'count': 0})
+        block_number = thread_id // POSTING_BLOCK_SIZE
+        block_key = get_block_key(term, block_number)
+        block = index.get(block_key, {})
+        if thread_id not in block:
+            term_record['count'] += 1
+            if not block:
+                term_record['blocks'].append(block_number)
+                term_record['blocks'].sort()
+            index[term_key] = term_record
+        block[thread_id] = frequency
+        index[block_key] = block
+
+    def _remove_posting(self, index, term, thread_id):
+        term_key = get_term_key(term)
+        term_record = index.get(term_key)
+        block_number = thread_id // POSTING_BLOCK_SIZE
+        block_key = get_block_key(term, block_number)
+        block = index.get(block_key, {})
+        if term_record is None or thread_id not in block:
+            return
+        del block[thread_id]
+        if block:
+            index[block_key] = block
+        else:
+            del index[block_key]
+            term_record['blocks'].remove(block_number)
+        term_record['count'] -= 1
+        if term_record['count']:
+            index[term_key] = term_record
+        else:
+            del index[term_key]
+
+    def _iter_blocks(self, index, terms):
+        """yields lists of posting blocks of the ``terms``, one list
+        per block number used by all of the terms, in the order
+        of the block numbers, all words are required, so the
+        other blocks can not hold any matching threads"""
+        term_records = [index.get(get_term_key(term)) for term in terms]
+        if None in term_records:
+            return
+        block_numbers = set(term_records[0]['blocks'])
+        for term_record in term_records[1:]:
+            block_numbers &= set(term_record['blocks'])
+        for block_number in sorted(block_numbers):
+            yield [
+                index[get_block_key(term, block_number)] for term in terms
+            ]
+
+    def _update_thread(self, index, thread_id, frequencies, length):
+        """replaces postings of the thread,
+        ``frequencies`` - dictionary term -> weighted frequency
+        """
+        thread_key = get_thread_key(thread_id)
+        old_record = index.get(thread_key, {'terms': [], 'length': 0})
+        old_terms = set(old_record['terms'])
+
+        stats = index.get(STATS_KEY, {'count': 0, 'length': 0.0})
+        if old_terms:
+            stats['count'] -= 1
+            stats['length'] -= old_record['length']
+        if frequencies:
+            stats['count'] += 1
+            stats['length'] += length
+        index[STATS_KEY] = stats
+
+        for term in old_terms - set(frequencies):
+            self._remove_posting(index, term, thread_id)
+
+        if stats['count']:
+            average_length = stats['length'] / stats['count']
+        else:
+            average_length = 0
+        for term, frequency in frequencies.items():
+            normalized = bm25.normalize_frequency(frequency, length, average_length)
+            self._add_posting(index, term, thread_id, normalized)
+
+        if frequencies:
+            index[thread_key] = {'terms': list(frequencies), 'length': length}
+        elif thread_key in index:
+            del index[thread_key]
+
+    def index_thread(self, thread):
+        fields = get_thread_fields(thread)
+        frequencies, length = bm25.get_term_frequencies(fields, tokenize)
+        with self.open_index(write = True) as index:
+            self._update_thread(index, thread.id, frequencies, length)
+
+    def remove_thread(self, thread_id):
+        with self.open_index(write = True) as index:
+            self._update_thread(index, thread_id, {}, 0)
+
+    def clear(self):
+        with self.open_index(write = True) as index:
+            index.clear()
+
+    def search(self, query, limit = None):
+        terms = list(set(tokenize(query)))
+        if not terms or limit == 0:
+            return []
+        thread_ids = list()
+        with self.open_index() as index:
+            for blocks in self._iter_blocks(index, terms):
+                blocks.sort(key = len)
+                block_ids = set(blocks[0])
+                for block in blocks[1:]:
+                    block_ids.intersection_update(block)
+                thread_ids.extend(sorted(block_ids))
+                if limit is not None and len(thread_ids) >= limit:
+                    break
+        return thread_ids[:limit]
+
+    def rank(self, query, limit, filter_ids = None):
+        terms = list(set(tokenize(query)))
+        if not terms or limit <= 0:
+            return []
+        scores = dict()
+        with self.open_index() as index:
+            thread_count = index.get(STATS_KEY, {'count': 0})['count']
+            idfs = list()
+            for term in terms:
+                term_record = index.get(get_term_key(term), {'count': 0})
+                idfs.append(bm25.get_idf(thread_count, term_record['count']))
+
+            for blocks in self._iter_blocks(index, terms):
+                #only the threads in the shortest block are scored
+                shortest = min(blocks, key = len)
+                for thread_id in shortest:
+                    score = 0.0
+                    for block, idf in zip(blocks, idfs):
+                        frequency = block.get(thread_id)
+                        if not frequency:
+                            break
+                        score += bm25.get_term_score(frequency, idf)
+                    else:
+                        scores[thread_id] = score
+        return filter_ranked_ids(bm25.iter_top_ids(scores), limit, filter_ids)
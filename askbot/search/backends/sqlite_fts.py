@@ -0,0 +1,166 @@
+"""full text search with the FTS5 extension of SQLite
+
+The threads are indexed in a virtual table in a separate
+SQLite database file in the ``ASKBOT_SEARCH_INDEX_DIR``
+directory, so the backend works with any main database
+and does not need a search server. Rowid of the table
+is the thread id.
+
+Relevance is the FTS5 ``bm25()`` with the field weights
+from ``const.SEARCH_FIELD_BOOSTS``, the scoring and sorting
+is done by SQLite.
+"""
+import os
+import sqlite3
+from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
+from askbot import const
+from askbot.search.backends import SearchBackend
+from askbot.search.backends import filter_ranked_ids
+from askbot.search.backends import get_thread_fields, tokenize
+
+INDEX_FILE_NAME = 'threads.fts.sqlite3'
+TABLE_NAME = 'thread_search'
+#seconds to wait for the lock held by the other writers
+LOCK_TIMEOUT = 10
+
+def get_match_expression(query):
+    """returns FTS5 query, where all words of the query
+    are required, or ``None`` if there are no words
+
+    words are quoted, so that the FTS5 operators
+    typed by the users are taken literally
+    """
+    words = tokenize(query)
+    if not words:
+        return None
+    return u' '.join([u'"%s"' % word for word in words])
+
+
+class SqliteFtsBackend(SearchBackend):
+
+    supports_relevance = True
+
+    def __init__(self):
+        index_dir = getattr(django_settings, 'ASKBOT_SEARCH_INDEX_DIR', None)
+        if not index_dir:
+            raise ImproperlyConfigured(
+                'ASKBOT_SEARCH_INDEX_DIR setting is required '
+                'by the SQLite search backend'
+            )
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        self.index_path = os.path.join(index_dir, INDEX_FILE_NAME)
+        connection = self.get_connection()
+        try:
+            connection.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS %s '
+                'USING fts5(title, tagnames, text, tokenize=\'unicode61\')' \
+                % TABLE_NAME
+            )
+        except sqlite3.OperationalError, e:
+            raise ImproperlyConfigured(
+                'SQLite search backend requires FTS5 extension: %s' % e
+            )
+        finally:
+            connection.close()
+
+    def get_connection(self):
+        return sqlite3.connect(self.index_path, timeout = LOCK_TIMEOUT)
+
+    def _delete_thread(self, connection, thread_id):
+        connection.execute(
+            'DELETE FROM %s WHERE rowid = ?' % TABLE_NAME, (thread_id,)
+        )
+
+    def _insert_thread(self, connection, thread):
+        fields = get_thread_fields(thread)
+        connection.execute(
+            'INSERT INTO %s (rowid, title, tagnames, text) '
+            'VALUES (?, ?, ?, ?)' % TABLE_NAME,
+            (thread.id, fields['title'], fields['tagnames'], fields['text'])
+        )
+
+    def index_thread(self, thread):
+        connection = self.get_connection()
+        try:
+            with connection:
+                self._delete_thread(connection, thread.id)
+                self._insert_thread(connection, thread)
+        finally:
+            connection.close()
+
+    def remove_thread(self, thread_id):
+        connection = self.get_connection()
+        try:
+            with connection:
+                self._delete_thread(connection, thread_id)
+        finally:
+            connection.close()
+
+    def clear(self):
+        connection = self.get_connection()
+        try:
+            with connection:
+                connection.execute('DELETE FROM %s' % TABLE_NAME)
+        finally:
+            connection.close()
+
+    def rebuild(self, threads):
+        """rebuilds the index in one transaction,
+        the searches see the old index until it is done"""
+        connection = self.get_connection()
+        try:
+            with connection:
+                connection.execute('DELETE FROM %s' % TABLE_NAME)
+                for thread in threads:
+                    self._insert_thread(connection, thread)
+            with connection:
+                connection.execute(
+                    'INSERT INTO %s (%s) VALUES (\'optimize\')' \
+                    % (TABLE_NAME, TABLE_NAME)
+                )
+        finally:
+            connection.close()
+
+    def search(self, query, limit = None):
+        match_expression = get_match_expression(query)
+        if match_expression is None:
+            return []
+        if limit is None:
+            limit = -1 #no limit in SQLite
+        connection = self.get_connection()
+        try:
+            cursor = connection.execute(
+                'SELECT rowid FROM %s WHERE %s MATCH ? LIMIT ?' \
+                % (TABLE_NAME, TABLE_NAME),
+                (match_expression, limit)
+            )
+            return [row[0] for row in cursor]
+        finally:
+            connection.close()
+
+    def rank(self, query, limit, filter_ids = None):
+        match_expression = get_match_expression(query)
+        if match_expression is None or limit <= 0:
+            return []
+        boosts = const.SEARCH_FIELD_BOOSTS
+        #bm25() is lower for the better matches
+        rank_sql = 'bm25(%s, %f, %f, %f)' % (
+                                TABLE_NAME,
+                                boosts['title'],
+                                boosts['tagnames'],
+                                boosts['text']
+                            )
+        connection = self.get_connection()
+        try:
+            cursor = connection.execute(
+                'SELECT rowid FROM %s WHERE %s MATCH ? ORDER BY %s' \
+                % (TABLE_NAME, TABLE_NAME, rank_sql),
+                (match_expression,)
+            )
+            #rows are read only until the page is filled
+            ranked_ids = (row[0] for row in cursor)
+            return filter_ranked_ids(ranked_ids, limit, filter_ids)
+        finally:
+            connection.close()
@@ -0,0 +1,54 @@
+"""Okapi BM25 relevance of the threads
+
+Fields of the thread are merged into one bag of words,
+the words of the title and of the tags counted with
+the weights from ``const.SEARCH_FIELD_BOOSTS``
+(a simplified BM25F).
+"""
+import heapq
+import math
+from askbot import const
+
+K1 = 1.2
+B = 0.75
+
+def get_term_frequencies(fields, tokenize):
+    """returns tuple (weighted term frequencies, weighted length)
+    of the thread, ``fields`` - dictionary of field texts,
+    as returned by ``backends.get_thread_fields()``
+    """
+    frequencies = {}
+    length = 0.0
+    for field_name, text in fields.items():
+        weight = const.SEARCH_FIELD_BOOSTS.get(field_name, 1.0)
+        for term in tokenize(text):
+            frequencies[term] = frequencies.get(term, 0.0) + weight
+            length += weight
+    return frequencies, length
+
+def normalize_frequency(frequency, length, average_length):
+    """returns term frequency normalized by the thread length,
+    to be stored in the index, so that the query time
+    score does not need the thread lengths"""
+    if average_length <= 0:
+        return frequency
+    return frequency / (1 - B + B * length / average_length)
+
+def get_idf(thread_count, document_frequency):
+    """inverse document frequency of the term,
+    never negative, unlike in the classic BM25"""
+    return math.log(
+        1 + (thread_count - document_frequency + 0.5) / (document_frequency + 0.5)
+    )
+
+def get_term_score(normalized_frequency, idf):
+    return idf * normalized_frequency * (K1 + 1) / (normalized_frequency + K1)
+
+def iter_top_ids(scores):
+    """yields ids from the dictionary id -> score, the best first,
+    ids are taken off a heap, so that reading only the top
+    of the ranking does not sort all of them"""
+    heap = [(-score, thread_id) for thread_id, score in scores.iteritems()]
+    heapq.heapify(heap)
+    while heap:
+        yield heapq.heappop(heap)[1]
@@ -0,0 +1,183 @@
+"""keyset (a.k.a. "cursor") pagination of the thread listings
+
+Instead of ``OFFSET n`` the next page is selected with a
+``WHERE (sort_column, id) < (last_value, last_id)`` clause,
+which is a range of the composite ``(sort_column, id)`` index
+of the thread table, so that the deep pages cost the same as
+the first one. The indexes are added by migration 0138.
+
+The position in the listing is passed around as an opaque
+url-safe token - the cursor, see :func:`encode_cursor`.
+"""
+import base64
+import datetime
+import re
+
+from django.db import connection, models
+import askbot
+
+#sort method -> (thread field, is descending)
+#relevance sort is not supported, because relevance
+#is not a column that could be compared against
+SORT_KEYS = {
+    'age-desc': ('added_at', True),
+    'age-asc': ('added_at', False),
+    'activity-desc': ('last_activity_at', True),
+    'activity-asc': ('last_activity_at', False),
+    'answers-desc': ('answer_count', True),
+    'answers-asc': ('answer_count', False),
+    'votes-desc': ('score', True),
+    'votes-asc': ('score', False),
+}
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+CURSOR_RE = re.compile(r'^[\w\-]+$')
+
+def supports_sort(sort_method):
+    """True if listing sorted by ``sort_method``
+    can be paginated with the cursors"""
+    return sort_method in SORT_KEYS
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return 'd' + value.strftime(DATETIME_FORMAT)
+    return 'i' + str(int(value))
+
+def _decode_value(value):
+    if value.startswith('d'):
+        return datetime.datetime.strptime(value[1:], DATETIME_FORMAT)
+    elif value.startswith('i'):
+        return int(value[1:])
+    raise ValueError('unknown cursor value type')
+
+def encode_cursor(sort_method, direction, thread):
+    """returns opaque url-safe cursor pointing at the ``thread``
+
+    ``direction`` is either 'next' - to select threads
+    following the ``thread`` or 'prev' - the preceding ones
+    """
+    assert(direction in ('next', 'prev'))
+    field = SORT_KEYS[sort_method][0]
+    raw_cursor = '|'.join((
+                        sort_method,
+                        direction,
+                        _encode_value(getattr(thread, field)),
+                        str(thread.id)
+                    ))
+    return base64.urlsafe_b64encode(raw_cursor).rstrip('=')
+
+def decode_cursor(cursor, sort_method):
+    """returns tuple (direction, value, thread id)
+    or ``None`` if cursor is malformed or was made
+    for a different sort method
+    """
+    if not cursor or not CURSOR_RE.match(cursor):
+        return None
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        raw_cursor = base64.urlsafe_b64decode(str(cursor) + padding)
+        cursor_sort, direction, value, thread_id = raw_cursor.split('|')
+        if cursor_sort != sort_method or direction not in ('next', 'prev'):
+            return None
+        return direction, _decode_value(value), int(thread_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class KeysetPage(object):
+    """a page of threads, quacks like the page
+    of the django paginator, where templates care"""
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def _filter_after(qs, field, value, thread_id, descending):
+    """returns query set ``qs`` with the threads that follow
+    the (``value``, ``thread_id``) position in the order
+    by the ``field`` and id"""
+    if 'postgresql' in askbot.get_database_engine_name():
+        #row values are compared along the composite index
+        qn = connection.ops.quote_name
+        opts = qs.model._meta
+        table = qn(opts.db_table)
+        return qs.extra(
+            where = ['(%s.%s, %s.%s) %s (%%s, %%s)' % (
+                    table, qn(opts.get_field(field).column),
+                    table, qn(opts.pk.column),
+                    descending and '<' or '>'
+                )],
+            params = [value, thread_id]
+        )
+    #the row value comparisons are not used with the indexes
+    #by the other databases, the inclusive bound on the sort field
+    #alone keeps the lookup an index range
+    if descending:
+        bound, tie_lookup = 'lte', 'gte'
+    else:
+        bound, tie_lookup = 'gte', 'lte'
+    return qs.filter(
+        models.Q(**{'%s__%s' % (field, bound): value})
+    ).exclude(
+        models.Q(**{field: value, 'id__%s' % tie_lookup: thread_id})
+    )
+
+
+def get_page(qs, sort_method, cursor = None, page_size = 30):
+    """returns :class:`KeysetPage` of threads from the query set ``qs``,
+    which are positioned after (or before) the ``cursor``
+
+    Ordering of the query set is replaced with the
+    (sort field, id) pair, the id is a tie breaker
+    that makes the position of every thread unique.
+    """
+    field, descending = SORT_KEYS[sort_method]
+
+    position = decode_cursor(cursor, sort_method)
+    if position:
+        direction, value, thread_id = position
+    else:
+        direction = 'next'
+
+    backwards = (direction == 'prev')
+    #walk in the reverse order when going to the previous page
+    walk_descending = (descending != backwards)
+
+    if position:
+        qs = _filter_after(qs, field, value, thread_id, walk_descending)
+
+    prefix = walk_descending and '-' or ''
+    qs = qs.order_by(prefix + field, prefix + 'id')
+
+    #one extra item tells whether there is anything beyond this page
+    threads = list(qs[:page_size + 1])
+    has_more = len(threads) > page_size
+    threads = threads[:page_size]
+
+    if backwards:
+        threads.reverse()
+        has_next = True
+        has_previous = has_more
+    else:
+        has_next = has_more
+        has_previous = position is not None
+
+    next_cursor = None
+    previous_cursor = None
+    if threads:
+        if has_next:
+            next_cursor = encode_cursor(sort_method, 'next', threads[-1])
+        if has_previous:
+            previous_cursor = encode_cursor(sort_method, 'prev', threads[0])
+
+    return KeysetPage(threads, next_cursor, previous_cursor)
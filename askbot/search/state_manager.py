@@ -10,6 +10,7 @@ from django.utils.encoding import smart_str
 import askbot
 import askbot.conf
 from askbot import const
+from askbot.search import keyset
 from askbot.utils.functions import strip_plus
 
 
@@ -87,7 +88,7 @@ class SearchState(object):
     def get_empty(cls):
         return cls(scope=None, sort=None, query=None, tags=None, author=None, page=None, user_logged_in=None)
 
-    def __init__(self, scope, sort, query, tags, author, page, user_logged_in, questions_url=None, ask_url=None):
+    def __init__(self, scope, sort, query, tags, author, page, user_logged_in, questions_url=None, ask_url=None, cursor=None):
         # INFO: zip(*[('a', 1), ('b', 2)])[0] == ('a', 'b')
 
         if (scope not in zip(*const.POST_SCOPE_LIST)[0]) or (scope == 'favorite' and not user_logged_in):
@@ -129,6 +130,13 @@ class SearchState(object):
         if self.page == 0:  # in case someone likes jokes :)
             self.page = 1
 
+        #opaque position in the listing, used instead of
+        #the page number by the keyset pagination
+        if cursor and keyset.CURSOR_RE.match(cursor):
+            self.cursor = cursor
+        else:
+            self.cursor = None
+
         self._questions_url = questions_url or urlresolvers.reverse('questions')
         self._ask_url = ask_url or urlresolvers.reverse('ask')
 
@@ -177,7 +185,9 @@ class SearchState(object):
             lst.append('tags:' + urllib.quote(smart_str(const.TAG_SEP.join(self.tags)), safe=self.SAFE_CHARS))
         if self.author:
             lst.append('author:' + str(self.author))
-        if self.page:
+        if self.cursor:
+            lst.append('cursor:' + self.cursor)
+        elif self.page:
             lst.append('page:' + str(self.page))
         return '/'.join(lst) + '/'
 
@@ -209,12 +219,14 @@ class SearchState(object):
         if tag not in ss.tags:
             ss.tags.append(tag)
             ss.page = 1 # state change causes page reset
+            ss.cursor = None
         return ss
 
     def remove_author(self):
         ss = self.deepcopy()
         ss.author = None
         ss.page = 1
+        ss.cursor = None
         return ss
 
     def remove_tags(self, tags = None):
@@ -226,23 +238,32 @@ class SearchState(object):
         else:
             ss.tags = []
         ss.page = 1
+        ss.cursor = None
         return ss
 
     def change_scope(self, new_scope):
         ss = self.deepcopy()
         ss.scope = new_scope
         ss.page = 1
+        ss.cursor = None
         return ss
 
     def change_sort(self, new_sort):
         ss = self.deepcopy()
         ss.sort = new_sort
         ss.page = 1
+        ss.cursor = None
         return ss
 
     def change_page(self, new_page):
         ss = self.deepcopy()
         ss.page = new_page
+        ss.cursor = None
+        return ss
+
+    def change_cursor(self, new_cursor):
+        ss = self.deepcopy()
+        ss.cursor = new_cursor
         return ss
 
 
@@ -0,0 +1,85 @@
+"""posting lists of the tags: tag id -> sorted list of thread ids
+
+The lists are kept in the django cache. Missing lists are loaded
+from the thread - tag relation, cached lists are updated in place
+whenever the relation changes (``m2m_changed`` on ``Thread.tags``,
+see ``askbot.models.update_tag_postings``). Lists expire after
+``const.TAG_POSTINGS_CACHE_TIMEOUT``, which bounds the drift when
+concurrent updates of the same list overwrite each other.
+
+Filtering by several tags intersects the lists, instead of
+joining the thread - tag relation once per tag.
+"""
+import bisect
+from django.core import cache
+from askbot import const
+from askbot.utils.lists import intersect_sorted
+
+def get_cache_key(tag_id):
+    return 'tag-threads-%d' % tag_id
+
+def load_posting(tag_id):
+    """returns sorted ids of threads having the tag, from the database"""
+    from askbot.models import Thread
+    through_model = Thread.tags.through
+    return list(
+        through_model.objects.filter(
+                                tag = tag_id
+                            ).order_by(
+                                'thread'
+                            ).values_list(
+                                'thread', flat = True
+                            )
+    )
+
+def get_postings(tag_ids):
+    """returns dictionary tag id -> sorted list of thread ids"""
+    keys = dict([(get_cache_key(tag_id), tag_id) for tag_id in tag_ids])
+    cached = cache.cache.get_many(keys.keys())
+    postings = dict([(keys[key], posting) for key, posting in cached.items()])
+    missing = dict()
+    for tag_id in tag_ids:
+        if tag_id not in postings:
+            postings[tag_id] = load_posting(tag_id)
+            missing[get_cache_key(tag_id)] = postings[tag_id]
+    if missing:
+        cache.cache.set_many(missing, const.TAG_POSTINGS_CACHE_TIMEOUT)
+    return postings
+
+def get_thread_ids(tag_ids):
+    """returns sorted ids of threads having all the tags"""
+    return intersect_sorted(get_postings(tag_ids).values())
+
+def add_thread(tag_ids, thread_id):
+    """adds thread to the cached postings of the tags"""
+    for tag_id in tag_ids:
+        key = get_cache_key(tag_id)
+        posting = cache.cache.get(key)
+        if posting is None:
+            continue #will be loaded when needed
+        position = bisect.bisect_left(posting, thread_id)
+        if position == len(posting) or posting[position] != thread_id:
+            posting.insert(position, thread_id)
+            cache.cache.set(key, posting, const.TAG_POSTINGS_CACHE_TIMEOUT)
+
+def remove_thread(tag_ids, thread_id):
+    """removes thread from the cached postings of the tags"""
+    for tag_id in tag_ids:
+        key = get_cache_key(tag_id)
+        posting = cache.cache.get(key)
+        if posting is None:
+            continue
+        position = bisect.bisect_left(posting, thread_id)
+        if position < len(posting) and posting[position] == thread_id:
+            del posting[position]
+            cache.cache.set(key, posting, const.TAG_POSTINGS_CACHE_TIMEOUT)
+
+def add_threads(tag_id, thread_ids):
+    """adds threads to the cached posting of one tag"""
+    for thread_id in thread_ids:
+        add_thread([tag_id], thread_id)
+
+def remove_threads(tag_id, thread_ids):
+    """removes threads from the cached posting of one tag"""
+    for thread_id in thread_ids:
+        remove_thread([tag_id], thread_id)
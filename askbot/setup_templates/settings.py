@@ -154,6 +154,15 @@ DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
 
 #TEMPLATE_DIRS = (,) #template have no effect in askbot, use the variable below
 #ASKBOT_EXTRA_SKINS_DIR = #path to your private skin collection
+#full text search backend, by default questions are searched with LIKE queries
+#ASKBOT_SEARCH_BACKEND = 'askbot.search.backends.inverted_index.InvertedIndexBackend'
+#ASKBOT_SEARCH_BACKEND = 'askbot.search.backends.sqlite_fts.SqliteFtsBackend' #needs SQLite with FTS5
+#ASKBOT_SEARCH_INDEX_DIR = #directory for the search index files, writable by the server and the celery workers
+#ASKBOT_DEFER_VIEW_COUNTS = True #count question views in the cache shared by the processes (not LocMemCache), run flush_view_counts periodically
+#ASKBOT_LAST_SEEN_UPDATE_INTERVAL = 300 #seconds between the writes of the last visit time of a user
+#ASKBOT_CACHE_QUESTION_PAGES = True #cache question pages for the anonymous visitors
+#ASKBOT_QUESTION_PAGE_STALE_WHILE_REVALIDATE = True #serve stale pages of the hot threads while they are rendered
+#ASKBOT_EMAIL_DIGEST_WORKERS = 1 #processes sending the email digests
 #take a look here http://askbot.org/en/question/207/
 
 TEMPLATE_CONTEXT_PROCESSORS = (
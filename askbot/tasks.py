@@ -20,6 +20,7 @@ That is the reason for having two types of methods here:
 import sys
 import traceback
 
+from django.conf import settings as django_settings
 from django.contrib.contenttypes.models import ContentType
 from django.template import Context
 from django.utils.translation import ugettext as _
@@ -30,6 +31,7 @@ from askbot import mail
 from askbot.models import Activity, Post, Thread, User, ReplyAddress
 from askbot.models import send_instant_notifications_about_activity_in_post
 from askbot.models.badges import award_badges_signal
+from askbot.search import backends as search_backends
 
 # TODO: Make exceptions raised inside record_post_update_celery_task() ...
 #       ... propagate upwards to test runner, if only CELERY_ALWAYS_EAGER = True
@@ -190,9 +192,6 @@ def record_post_update(
 
     assert(updated_by not in recipients)
 
-    for user in (set(recipients) | set(newly_mentioned_users)):
-        user.get_profile().update_response_counts()
-
     #shortcircuit if the email alerts are disabled
     if askbot_settings.ENABLE_EMAIL_ALERTS == False:
         return
@@ -245,9 +244,32 @@ def record_question_visit(
         user.get_profile().visit_question(question_post)
 
     #3) send award badges signal for any badges
-    #that are awarded for question views
+    #that are awarded for question views,
+    #deferred view counts are checked when they are flushed
+    if getattr(django_settings, 'ASKBOT_DEFER_VIEW_COUNTS', False):
+        return
     award_badges_signal.send(None,
                     event = 'view_question',
                     actor = user,
                     context_object = question_post,
                 )
+
+@task(ignore_result = True)
+def index_thread_celery_task(thread_id):
+    """updates the thread in the index of the search backend,
+    the indexing is kept out of the web requests, because the
+    backend index may be locked by the other writers"""
+    search_backend = search_backends.get_backend()
+    if search_backend is None:
+        return
+    try:
+        thread = Thread.objects.get(id = thread_id)
+    except Thread.DoesNotExist:
+        return
+    search_backend.index_thread(thread)
+
+@task(ignore_result = True)
+def remove_thread_from_search_index_celery_task(thread_id):
+    search_backend = search_backends.get_backend()
+    if search_backend:
+        search_backend.remove_thread(thread_id)
@@ -4,12 +4,14 @@ import re
 import time
 import urllib
 from coffin import template as coffin_template
+from django.core import cache
 from django.core import exceptions as django_exceptions
 from django.utils.translation import ugettext as _
 from django.contrib.humanize.templatetags import humanize
 from django.template import defaultfilters
 from django.core.urlresolvers import reverse, resolve
 from django.http import Http404
+from askbot import const
 from askbot import exceptions as askbot_exceptions
 from askbot.conf import settings as askbot_settings
 from django.conf import settings as django_settings
@@ -47,6 +49,14 @@ TIMEZONE_STR = pytz.timezone(
 def add_tz_offset(datetime_object):
     return str(datetime_object) + ' ' + TIMEZONE_STR
 
+@register.filter
+def cache_fragment(html, cache_key = None):
+    """stores the rendered fragment in the cache
+    under the key, if given, and passes it through"""
+    if cache_key:
+        cache.cache.set(cache_key, html, const.ANSWER_CARD_CACHE_TIMEOUT)
+    return html
+
 @register.filter
 def safe_urlquote(text, quote_plus = False):
     if quote_plus:
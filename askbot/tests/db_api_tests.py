@@ -3,7 +3,8 @@ functions that happen on behalf of users
 
 e.g. ``some_user.do_something(...)``
 """
-from django.core import exceptions
+from django.core import cache, exceptions
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.urlresolvers import reverse
 from django.test.client import Client
 from django.conf import settings
@@ -284,13 +285,9 @@ class GlobalTagSubscriberGetterTests(AskbotTestCase):
     def assert_subscribers_are(self, expected_subscribers = None, reason = None):
         """a special assertion that compares the subscribers
         on the question with the given set"""
-        subscriptions = models.EmailFeedSetting.objects.filter(
-                                                    feed_type = 'q_all',
-                                                    frequency = 'i'
-                                                )
         actual_subscribers = self.question.get_global_tag_based_subscribers(
             tag_mark_reason = reason,
-            subscription_records = subscriptions
+            frequency = 'i'
         )
         self.assertEquals(actual_subscribers, expected_subscribers)
 
@@ -367,6 +364,93 @@ class GlobalTagSubscriberGetterTests(AskbotTestCase):
             reason = 'bad'
         )
 
+class TagSubscriptionIndexTests(AskbotTestCase):
+    """tests for the index of the tag based whole forum subscriptions"""
+    def setUp(self):
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('', {})
+        self.u1 = self.create_user(
+                        username = 'user1',
+                        notification_schedule = {'q_all': 'i'}
+                    )
+        self.u2 = self.create_user(
+                        username = 'user2',
+                        notification_schedule = {'q_all': 'd'}
+                    )
+
+    def tearDown(self):
+        cache.cache = self.old_cache
+
+    def test_wildcard_trie_matches_prefixes(self):
+        trie = dict()
+        models.tag.add_wildcard_to_trie(trie, 'da*', 1)
+        models.tag.add_wildcard_to_trie(trie, 'day*', 2)
+        models.tag.add_wildcard_to_trie(trie, 'ni*', 3)
+        self.assertEqual(models.tag.get_trie_matches(trie, 'days'), set([1, 2]))
+        self.assertEqual(models.tag.get_trie_matches(trie, 'dark'), set([1]))
+        self.assertEqual(models.tag.get_trie_matches(trie, 'd'), set())
+
+    def test_subscribers_are_split_by_frequency(self):
+        instant = models.tag.get_tag_subscribers(
+                            tag_ids = [], frequency = 'i',
+                            strategy = const.EXCLUDE_IGNORED
+                        )
+        daily = models.tag.get_tag_subscribers(
+                            tag_ids = [], frequency = 'd',
+                            strategy = const.EXCLUDE_IGNORED
+                        )
+        self.assertEqual(instant, set([self.u1.id]))
+        self.assertEqual(daily, set([self.u2.id]))
+
+    def test_index_follows_feed_changes(self):
+        feed = models.EmailFeedSetting.objects.get(
+                                    subscriber = self.u2, feed_type = 'q_all'
+                                )
+        feed.frequency = 'i'
+        feed.save()
+        instant = models.tag.get_tag_subscribers(
+                            tag_ids = [], frequency = 'i',
+                            strategy = const.EXCLUDE_IGNORED
+                        )
+        self.assertEqual(instant, set([self.u1.id, self.u2.id]))
+
+    def test_index_follows_tag_marks(self):
+        self.post_question(user = self.u2, tags = 'good day')
+        tag = models.Tag.objects.get(name = 'day')
+        self.u1.mark_tags(tagnames = ('day',), reason = 'bad', action = 'add')
+        instant = models.tag.get_tag_subscribers(
+                            tag_ids = [tag.id], frequency = 'i',
+                            strategy = const.EXCLUDE_IGNORED
+                        )
+        self.assertEqual(instant, set())
+
+    def test_tag_marks_drop_only_subscribers_of_the_tag(self):
+        self.post_question(user = self.u2, tags = 'good day')
+        good = models.Tag.objects.get(name = 'good')
+        day = models.Tag.objects.get(name = 'day')
+        models.tag.get_tag_subscribers(
+                            tag_ids = [good.id, day.id], frequency = 'i',
+                            strategy = const.EXCLUDE_IGNORED
+                        )
+        self.u1.mark_tags(tagnames = ('day',), reason = 'bad', action = 'add')
+
+        def is_cached(key):
+            return cache.cache.get(key) is not None
+        key_tpl = models.tag.TAG_SUBSCRIBERS_KEY_TPL
+        self.assertTrue(is_cached(key_tpl % ('i', 'bad', good.id)))
+        self.assertFalse(is_cached(key_tpl % ('i', 'bad', day.id)))
+        self.assertTrue(
+            is_cached(models.tag.TAG_SUBSCRIPTIONS_KEY_TPL % ('i', 'ignoring'))
+        )
+
+    def test_index_follows_wildcards(self):
+        self.u1.mark_tags(wildcards = ('da*',), reason = 'bad', action = 'add')
+        instant = models.tag.get_tag_subscribers(
+                            tag_ids = [], tag_names = ['day'], frequency = 'i',
+                            strategy = const.EXCLUDE_IGNORED, use_wildcards = True
+                        )
+        self.assertEqual(instant, set())
+
 class CommentTests(AskbotTestCase):
     """unfortunately, not very useful tests,
     as assertions of type "user can" are not inside
@@ -399,6 +483,122 @@ class CommentTests(AskbotTestCase):
         comment = models.Post.objects.get_comments().get(id = self.comment.id)
         self.assertEquals(comment.score, 0)
 
+class UserVisitTests(AskbotTestCase):
+    def setUp(self):
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('', {})
+        self.create_user()
+        self.now = datetime.datetime.now()
+
+    def tearDown(self):
+        cache.cache = self.old_cache
+
+    def get_profile(self):
+        return models.User.objects.get(id = self.user.id).get_profile()
+
+    def visit(self, timestamp):
+        models.signals.site_visited.send(None, user = self.user, timestamp = timestamp)
+
+    def test_last_seen_is_written_once_per_interval(self):
+        self.visit(self.now)
+        self.assertEqual(self.get_profile().last_seen, self.now)
+
+        self.visit(self.now + datetime.timedelta(seconds = 1))
+        self.assertEqual(self.get_profile().last_seen, self.now)
+
+        later = self.now + datetime.timedelta(seconds = const.LAST_SEEN_UPDATE_INTERVAL)
+        self.visit(later)
+        self.assertEqual(self.get_profile().last_seen, later)
+
+    def test_consecutive_day_visit_is_counted(self):
+        self.visit(self.now)
+        self.visit(self.now + datetime.timedelta(hours = 12))
+        self.visit(self.now + datetime.timedelta(hours = 40))
+        self.assertEqual(self.get_profile().consecutive_days_visit_count, 1)
+
+class QuestionVisitTests(AskbotTestCase):
+    def setUp(self):
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('', {})
+        self.create_user()
+        self.create_user(username = 'other_user')
+        self.question = self.post_question(user = self.other_user)
+        self.now = datetime.datetime.now()
+
+    def tearDown(self):
+        cache.cache = self.old_cache
+
+    def test_question_view_is_recorded(self):
+        profile = self.user.get_profile()
+        profile.visit_question(question = self.question, timestamp = self.now)
+        views = models.QuestionView.objects.filter(who = self.user)
+        self.assertEqual(views.count(), 1)
+        self.assertEqual(views[0].when, self.now)
+
+        later = self.now + datetime.timedelta(minutes = 1)
+        profile.visit_question(question = self.question, timestamp = later)
+        self.assertEqual(views.count(), 1)
+        self.assertEqual(views[0].when, later)
+
+    def test_deferred_question_views_are_written_on_flush(self):
+        settings.ASKBOT_DEFER_VIEW_COUNTS = True
+        try:
+            profile = self.user.get_profile()
+            profile.visit_question(question = self.question, timestamp = self.now)
+            later = self.now + datetime.timedelta(minutes = 1)
+            profile.visit_question(question = self.question, timestamp = later)
+            views = models.QuestionView.objects.filter(who = self.user)
+            self.assertEqual(views.count(), 0)
+
+            self.assertEqual(models.QuestionView.objects.flush_pending_views(), 1)
+            self.assertEqual(views.count(), 1)
+            self.assertEqual(views[0].when, later)
+
+            profile.visit_question(question = self.question, timestamp = self.now)
+            models.QuestionView.objects.flush_pending_views()
+            self.assertEqual(views.count(), 1)
+            self.assertEqual(views[0].when, self.now)
+        finally:
+            del settings.ASKBOT_DEFER_VIEW_COUNTS
+
+    def test_record_views_updates_and_creates(self):
+        other_question = self.post_question(user = self.other_user)
+        later = self.now + datetime.timedelta(minutes = 1)
+        models.QuestionView.objects.record_views({
+            (self.user.id, self.question.id): self.now,
+        })
+        models.QuestionView.objects.record_views({
+            (self.user.id, self.question.id): later,
+            (self.user.id, other_question.id): later,
+            (self.other_user.id, self.question.id): self.now,
+        })
+        views = models.QuestionView.objects.all()
+        self.assertEqual(views.count(), 3)
+        self.assertEqual(
+            set(views.values_list('who', 'question', 'when')),
+            set([
+                (self.user.id, self.question.id, later),
+                (self.user.id, other_question.id, later),
+                (self.other_user.id, self.question.id, self.now),
+            ])
+        )
+
+    def test_visit_clears_new_responses(self):
+        question = self.post_question(user = self.user)
+        self.assertFalse(
+            question.id in models.user.get_unseen_question_ids(self.user.id)
+        )
+
+        self.post_answer(user = self.other_user, question = question)
+        self.assertTrue(
+            question.id in models.user.get_unseen_question_ids(self.user.id)
+        )
+
+        self.user.get_profile().visit_question(question = question)
+        self.assertFalse(
+            question.id in models.user.get_unseen_question_ids(self.user.id)
+        )
+
 class TagAndGroupTests(AskbotTestCase):
     def setUp(self):
         self.u1 = self.create_user('u1')
@@ -106,6 +106,48 @@ class SubjectLineTests(TestCase):
         subj = mail.prefix_the_subject_line('hahah')
         self.assertEquals(subj, 'hahah')
 
+class MessageBatchTests(TestCase):
+    def test_messages_are_sent_together(self):
+        sent_to = list()
+        batch = mail.MessageBatch()
+        for address in ('one@example.com', 'two@example.com'):
+            batch.add(
+                subject_line = 'subject',
+                body_text = '<p>text</p>',
+                recipient_list = [address],
+                headers = {'Reply-To': address},
+                on_sent = functools.partial(sent_to.append, address)
+            )
+        self.assertEqual(len(django.core.mail.outbox), 0)
+        self.assertEqual(batch.send(), 2)
+
+        outbox = django.core.mail.outbox
+        self.assertEqual(len(outbox), 2)
+        self.assertEqual(sent_to, ['one@example.com', 'two@example.com'])
+        self.assertEqual(outbox[0].extra_headers['Reply-To'], 'one@example.com')
+        self.assertEqual(outbox[1].extra_headers['Reply-To'], 'two@example.com')
+        self.assertEqual(batch.failed, [])
+
+    def test_failed_callback_does_not_stop_batch(self):
+        def fail():
+            raise ValueError('callback failed')
+        batch = mail.MessageBatch()
+        first = batch.add(
+                    subject_line = 'subject',
+                    body_text = '<p>text</p>',
+                    recipient_list = ['one@example.com'],
+                    on_sent = fail
+                )
+        batch.add(
+            subject_line = 'subject',
+            body_text = '<p>text</p>',
+            recipient_list = ['two@example.com']
+        )
+        self.assertEqual(batch.send(), 2)
+        self.assertEqual(len(django.core.mail.outbox), 2)
+        self.assertEqual(len(batch.failed), 1)
+        self.assertEqual(batch.failed[0][0], first)
+
 class EmailAlertTests(TestCase):
     """Base class for testing delayed Email notifications 
     that are triggered by the send_email_alerts
@@ -909,6 +951,184 @@ class UnansweredReminderTests(EmailReminderTestCase):
         self.do_post(timestamp)
         self.assert_have_emails(0)
 
+class DailyDigestTests(utils.AskbotTestCase):
+    """digests of several users are built together
+    by the send_email_alerts command"""
+    def setUp(self):
+        self.create_user(
+            username = 'user1',
+            notification_schedule = {'q_all': 'd'}
+        )
+        self.create_user(
+            username = 'user2',
+            notification_schedule = {'q_all': 'd'}
+        )
+        self.create_user(username = 'user3')
+
+    def test_each_user_gets_own_digest_once(self):
+        self.user3.post_question(
+            title = 'some title',
+            body_text = 'some text for the question',
+            tags = 'something'
+        )
+        management.call_command('send_email_alerts')
+        outbox = django.core.mail.outbox
+        self.assertEqual(len(outbox), 2)
+        recipients = set([message.recipients()[0] for message in outbox])
+        self.assertEqual(recipients, set([self.user1.email, self.user2.email]))
+        self.assertTrue('some title' in outbox[0].body)
+
+        management.call_command('send_email_alerts')
+        self.assertEqual(len(django.core.mail.outbox), 2)
+
+    def test_feeds_are_marked_reported_after_sending(self):
+        from askbot.management.commands.send_email_alerts import DigestData
+        self.user3.post_question(
+            title = 'some title',
+            body_text = 'some text for the question',
+            tags = 'something'
+        )
+        profile = self.user1.get_profile()
+        digest_data = DigestData([profile])
+        digests = digest_data.get_digests()
+        self.assertEqual(len(digests), 1)
+
+        feed = models.EmailFeedSetting.objects.get(
+                                        subscriber = self.user1,
+                                        feed_type = 'q_all'
+                                    )
+        self.assertEqual(feed.reported_at, None)
+
+        digest_data.mark_reported(self.user1)
+        feed = models.EmailFeedSetting.objects.get(id = feed.id)
+        self.assertNotEqual(feed.reported_at, None)
+
+    def test_question_cut_by_alert_limit_is_reported_next_time(self):
+        from askbot.management.commands.send_email_alerts import DigestData
+        now = datetime.datetime.now()
+        models.User.objects.filter(id = self.user1.id).update(
+                                    date_joined = now - datetime.timedelta(10)
+                                )
+        old_question = self.post_question(user = self.user3, title = 'old question')
+        new_question = self.post_question(user = self.user3, title = 'new question')
+        #both were active before the previous digest is due
+        for question, days in ((old_question, 5), (new_question, 4)):
+            Thread.objects.filter(id = question.thread_id).update(
+                                last_activity_at = now - datetime.timedelta(days)
+                            )
+
+        old_max_alerts = askbot_settings.MAX_ALERTS_PER_EMAIL
+        askbot_settings.update('MAX_ALERTS_PER_EMAIL', 1)
+        try:
+            profile = models.User.objects.get(id = self.user1.id).get_profile()
+            digest_data = DigestData([profile])
+            (profile, q_list), = digest_data.get_digests()
+            self.assertEqual(q_list.keys(), [new_question])
+            digest_data.mark_reported(self.user1)
+
+            #the user reads the reported question
+            models.QuestionView.objects.create(
+                                    who = self.user1,
+                                    question = new_question,
+                                    when = datetime.datetime.now()
+                                )
+            models.EmailFeedSetting.objects.filter(
+                                    subscriber = self.user1
+                                ).update(
+                                    reported_at = now - datetime.timedelta(2)
+                                )
+
+            profile = models.User.objects.get(id = self.user1.id).get_profile()
+            (profile, q_list), = DigestData([profile]).get_digests()
+            self.assertEqual(q_list.keys(), [old_question])
+            self.assertFalse(q_list[old_question]['skip'])
+        finally:
+            askbot_settings.update('MAX_ALERTS_PER_EMAIL', old_max_alerts)
+
+class InlinePool(object):
+    """stands in for the pool of processes, the forked
+    processes would not see the test database"""
+    def __init__(self, processes):
+        self.processes = processes
+
+    def map(self, func, items, chunksize = None):
+        return map(func, items)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+class DigestInterrupted(Exception):
+    pass
+
+class DigestWorkersTests(utils.AskbotTestCase):
+    """digests are sent by shards of users
+    and the runs continue where the interrupted ones stopped"""
+    def setUp(self):
+        from askbot.management.commands import send_email_alerts
+        self.command_module = send_email_alerts
+        self.old_batch_size = send_email_alerts.QUERY_BATCH_SIZE
+        self.old_pool = send_email_alerts.multiprocessing.Pool
+        self.old_send = mail.MessageBatch.__dict__['send']
+        #one user per batch
+        send_email_alerts.QUERY_BATCH_SIZE = 1
+        send_email_alerts.multiprocessing.Pool = InlinePool
+        for username in ('user1', 'user2', 'user3'):
+            self.create_user(
+                username = username,
+                notification_schedule = {'q_all': 'd'}
+            )
+        self.create_user(username = 'poster')
+        self.poster.post_question(
+            title = 'some title',
+            body_text = 'some text for the question',
+            tags = 'something'
+        )
+
+    def tearDown(self):
+        self.command_module.QUERY_BATCH_SIZE = self.old_batch_size
+        self.command_module.multiprocessing.Pool = self.old_pool
+        mail.MessageBatch.send = self.old_send
+
+    def get_recipients(self):
+        return [message.recipients()[0] for message in django.core.mail.outbox]
+
+    def assert_each_user_got_one_digest(self):
+        recipients = self.get_recipients()
+        self.assertEqual(len(recipients), 3)
+        self.assertEqual(
+            set(recipients),
+            set([self.user1.email, self.user2.email, self.user3.email])
+        )
+
+    def test_workers_send_each_digest_once(self):
+        command = self.command_module.Command()
+        command.send_email_alerts(workers = 2)
+        self.assert_each_user_got_one_digest()
+        command.send_email_alerts(workers = 2)
+        self.assert_each_user_got_one_digest()
+
+    def test_interrupted_run_is_resumed(self):
+        old_send = self.old_send
+        def send_and_stop(batch):
+            sent_count = old_send(batch)
+            if sent_count:
+                raise DigestInterrupted()
+            return sent_count
+        mail.MessageBatch.send = send_and_stop
+
+        command = self.command_module.Command()
+        self.assertRaises(DigestInterrupted, command.send_email_alerts)
+        self.assertEqual(len(self.get_recipients()), 1)
+
+        mail.MessageBatch.send = old_send
+        command.send_email_alerts()
+        self.assert_each_user_got_one_digest()
+        command.send_email_alerts()
+        self.assert_each_user_got_one_digest()
+
 class EmailFeedSettingTests(utils.AskbotTestCase):
     def setUp(self):
         self.user = self.create_user('user')
@@ -622,3 +622,43 @@ class OnScreenUpdateNotificationTests(TestCase):
         )
 
 
+
+
+class AddRecipientsTests(TestCase):
+    """tests for the bulk addition of the activity recipients"""
+    def setUp(self):
+        self.author = create_user(username = 'author')
+        self.users = [
+            create_user(username = 'user%d' % number) for number in range(3)
+        ]
+
+    def add_activity(self, activity_type):
+        activity = models.Activity(
+                            user = self.author,
+                            activity_type = activity_type,
+                            content_object = self.author
+                        )
+        activity.save()
+        activity.add_recipients(self.users)
+        return activity
+
+    def get_new_response_counts(self):
+        return [
+            models.User.objects.get(id = user.id).get_profile().new_response_count
+            for user in self.users
+        ]
+
+    def test_response_counts_are_incremented(self):
+        activity = self.add_activity(const.TYPE_ACTIVITY_ANSWER)
+        self.assertEqual(
+            set(activity.recipients.all()),
+            set(self.users)
+        )
+        self.assertEqual(self.get_new_response_counts(), [1, 1, 1])
+        self.add_activity(const.TYPE_ACTIVITY_COMMENT_ANSWER)
+        self.assertEqual(self.get_new_response_counts(), [2, 2, 2])
+
+    def test_other_activities_are_not_counted(self):
+        activity = self.add_activity(const.TYPE_ACTIVITY_PRIZE)
+        self.assertEqual(activity.recipients.count(), 3)
+        self.assertEqual(self.get_new_response_counts(), [0, 0, 0])
@@ -4,7 +4,9 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.core import management
 from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from django.core import cache
+from django.test.client import Client
 
 import coffin
 import coffin.template
@@ -570,6 +572,162 @@ class QuestionPageRedirectTests(AskbotTestCase):
         resp = self.client.get(url, data={'comment': 100301})
         self.assertRedirects(resp, expected_url = self.q.get_absolute_url())
 
+class AnswerCardCacheTests(AskbotTestCase):
+
+    def setUp(self):
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('', {})
+        self.create_user()
+        self.q = self.post_question()
+        self.a1 = self.post_answer(question=self.q, body_text='first answer')
+        self.a2 = self.post_answer(question=self.q, body_text='second answer')
+
+    def tearDown(self):
+        cache.cache = self.old_cache
+
+    def test_answers_are_rendered_once(self):
+        resp = self.client.get(self.q.get_absolute_url())
+        self.assertEqual(resp.context['answer_cards'], {})
+        self.assertEqual(len(resp.context['answer_card_keys']), 2)
+
+        resp = self.client.get(self.q.get_absolute_url())
+        self.assertEqual(
+            set(resp.context['answer_cards']),
+            set([self.a1.id, self.a2.id])
+        )
+        self.assertTrue('second answer' in resp.content)
+
+        #edit of one answer renders only that answer again
+        self.user.get_profile().edit_answer(answer=self.a1, body_text='edited answer')
+        resp = self.client.get(self.q.get_absolute_url())
+        self.assertEqual(resp.context['answer_cards'].keys(), [self.a2.id])
+        self.assertTrue('edited answer' in resp.content)
+
+    def test_cached_answers_have_absolute_times(self):
+        resp = self.client.get(self.q.get_absolute_url())
+        html = cache.cache.get(resp.context['answer_card_keys'][self.a1.id])
+        added_at = self.reload_object(self.a1).added_at.replace(microsecond=0)
+        #the browser shows the time relative to the current one
+        self.assertTrue('<abbr class="timeago" title="%s' % added_at in html)
+
+
+class QuestionPageCacheTests(AskbotTestCase):
+
+    def setUp(self):
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('', {})
+        settings.ASKBOT_CACHE_QUESTION_PAGES = True
+        self.create_user()
+        self.q = self.post_question()
+        self.a = self.post_answer(question=self.q, body_text='first answer')
+        self.url = self.q.get_absolute_url()
+
+    def tearDown(self):
+        cache.cache = self.old_cache
+        del settings.ASKBOT_CACHE_QUESTION_PAGES
+        if hasattr(settings, 'ASKBOT_QUESTION_PAGE_STALE_WHILE_REVALIDATE'):
+            del settings.ASKBOT_QUESTION_PAGE_STALE_WHILE_REVALIDATE
+
+    def assertServedFromCache(self, response):
+        self.assertEqual(response.status_code, 200)
+        #cached page is served without rendering the templates
+        self.assertEqual(response.context, None)
+
+    def assertRendered(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.context, None)
+
+    def test_second_anonymous_visit_is_served_from_cache(self):
+        first = self.client.get(self.url)
+        self.assertRendered(first)
+        second = self.client.get(self.url)
+        self.assertServedFromCache(second)
+        self.assertEqual(first.content, second.content)
+
+    def test_csrf_token_of_the_visitor_is_in_cached_page(self):
+        from askbot.views.readers import CSRF_TOKEN_PLACEHOLDER
+        self.client.get(self.url)
+        first_token = self.client.cookies[settings.CSRF_COOKIE_NAME].value
+
+        client = Client()
+        response = client.get(self.url)
+        self.assertServedFromCache(response)
+        token = client.cookies[settings.CSRF_COOKIE_NAME].value
+        self.assertNotEqual(token, first_token)
+        self.assertTrue(token in response.content)
+        self.assertFalse(first_token in response.content)
+        self.assertFalse(CSRF_TOKEN_PLACEHOLDER in response.content)
+
+    def test_logged_in_user_skips_cache(self):
+        self.client.get(self.url)
+        self.client.login(method='force', user_id=self.user.id)
+        self.assertRendered(self.client.get(self.url))
+        self.assertRendered(self.client.get(self.url))
+
+    def test_permalink_skips_cache(self):
+        self.client.get(self.url)
+        response = self.client.get(self.url, data={'answer': self.a.id})
+        self.assertRendered(response)
+        self.assertEqual(response.context['show_post'], self.a)
+
+    def test_request_with_messages_skips_cache(self):
+        from django.contrib import messages
+        from django.contrib.auth.models import AnonymousUser
+        from django.contrib.messages.storage import default_storage
+        from django.test.client import RequestFactory
+        from askbot.views.readers import QuestionView
+
+        request = RequestFactory().get(self.url)
+        request.user = AnonymousUser()
+        request.session = dict()
+        request._messages = default_storage(request)
+        view = QuestionView()
+        view.request = request
+        self.assertNotEqual(view.get_page_cache_key(question_id=self.q.id), None)
+
+        messages.info(request, 'hello')
+        self.assertEqual(view.get_page_cache_key(question_id=self.q.id), None)
+
+    def test_stale_page_is_served_while_it_is_rendered(self):
+        from askbot import const
+        settings.ASKBOT_QUESTION_PAGE_STALE_WHILE_REVALIDATE = True
+        models.Thread.objects.filter(id=self.q.thread_id).update(
+                            view_count=const.QUESTION_PAGE_HOT_THREAD_MIN_VIEWS
+                        )
+        self.client.get(self.url)
+        self.user.get_profile().edit_answer(answer=self.a, body_text='edited answer')
+
+        #another request is rendering the fresh page
+        thread_id = self.q.thread_id
+        generation = models.Thread.get_cache_generation(thread_id)
+        cache.cache.add(
+            'question-page-revalidation-%d-%s' % (thread_id, generation), True
+        )
+        response = self.client.get(self.url)
+        self.assertServedFromCache(response)
+        self.assertFalse('edited answer' in response.content)
+
+        #once the lock is gone, the next request renders the page
+        cache.cache.delete(
+            'question-page-revalidation-%d-%s' % (thread_id, generation)
+        )
+        response = self.client.get(self.url)
+        self.assertRendered(response)
+        self.assertTrue('edited answer' in response.content)
+        #and only that one
+        response = self.client.get(self.url)
+        self.assertServedFromCache(response)
+        self.assertTrue('edited answer' in response.content)
+
+    def test_cold_thread_is_not_served_stale(self):
+        settings.ASKBOT_QUESTION_PAGE_STALE_WHILE_REVALIDATE = True
+        self.client.get(self.url)
+        self.user.get_profile().edit_answer(answer=self.a, body_text='edited answer')
+        response = self.client.get(self.url)
+        self.assertRendered(response)
+        self.assertTrue('edited answer' in response.content)
+
+
 class CommandViewTests(AskbotTestCase):
     def test_get_tag_wiki_text_succeeds(self):
         tag1 = self.create_tag('tag1')
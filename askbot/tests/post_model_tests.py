@@ -4,15 +4,19 @@ from operator import attrgetter
 import time
 from askbot.search.state_manager import SearchState
 from askbot.skins.loaders import get_template
+from django.conf import settings as django_settings
 from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
 from django.core import cache, urlresolvers
 from django.core.cache.backends.dummy import DummyCache
 from django.core.cache.backends.locmem import LocMemCache
 
 from django.core.exceptions import ValidationError
 from askbot.tests.utils import AskbotTestCase
-from askbot.models import Post, PostRevision, Thread, Tag
+from askbot.models import Post, PostRevision, Thread, Tag, TagCooccurrence
+from askbot.models.tag import get_user_tag_filter
 from askbot.search.state_manager import DummySearchState
+from askbot.search import tag_postings
 from django.utils import simplejson
 
 
@@ -307,6 +311,461 @@ class ThreadTagModelsTests(AskbotTestCase):
             self.assertEqual(user.id, thread._last_activity_by_cache.id)
             self.assertTrue(thread.last_activity_by is thread._last_activity_by_cache)
 
+    def test_question_post_denormalized_on_thread(self):
+        thread = Thread.objects.get(id=self.q1.thread_id)
+        self.assertEqual(self.q1.id, thread.question_post_id)
+        self.assertFalse(thread.deleted)
+
+        self.user.delete_question(question=self.q1)
+        thread = Thread.objects.get(id=self.q1.thread_id)
+        self.assertTrue(thread.deleted)
+
+        qs, meta_data = Thread.objects.run_advanced_search(
+                                            request_user=self.user,
+                                            language_code='en',
+                                            site=Site.objects.get_current(),
+                                            search_state=SearchState.get_empty()
+                                        )
+        self.assertEqual(3, qs.count())
+        self.assertFalse(self.q1.thread_id in [t.id for t in qs])
+
+        self.user.restore_post(post=self.q1)
+        thread = Thread.objects.get(id=self.q1.thread_id)
+        self.assertFalse(thread.deleted)
+
+    def test_denormalize_question_posts(self):
+        Post.objects.filter(id=self.q1.id).update(deleted=True)
+        Thread.objects.filter(id=self.q1.thread_id).update(question_post=None)
+        Thread.objects.denormalize_question_posts()
+
+        thread = Thread.objects.get(id=self.q1.thread_id)
+        self.assertEqual(self.q1.id, thread.question_post_id)
+        self.assertTrue(thread.deleted)
+        thread = Thread.objects.get(id=self.q2.thread_id)
+        self.assertEqual(self.q2.id, thread.question_post_id)
+        self.assertFalse(thread.deleted)
+
+
+class ThreadListingCountTests(AskbotTestCase):
+    def setUp(self):
+        self.create_user()
+        self.q1 = self.post_question(tags='tag1 tag2')
+        self.q2 = self.post_question(tags='tag2')
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('', {})
+
+    def tearDown(self):
+        cache.cache = self.old_cache
+
+    def _count(self, search_state):
+        site = Site.objects.get_current()
+        qs, meta_data = Thread.objects.run_advanced_search(
+                                            request_user=self.user,
+                                            language_code='en',
+                                            site=site,
+                                            search_state=search_state
+                                        )
+        return Thread.objects.get_listing_count(
+                                qs,
+                                search_state,
+                                meta_data,
+                                language_code='en',
+                                site=site,
+                                request_user=self.user
+                            )
+
+    def test_count_is_cached_until_new_thread(self):
+        ss = SearchState.get_empty().add_tag('tag2')
+        self.assertEqual(2, self._count(ss))
+
+        #same search state is served from cache
+        self.q1.thread.tags.clear()
+        self.assertEqual(2, self._count(ss))
+
+        #new threads invalidate the cached counts
+        self.post_question(tags='tag2')
+        self.post_question(tags='tag2')
+        self.assertEqual(3, self._count(ss))
+
+    def test_sort_and_page_share_the_count(self):
+        ss = SearchState.get_empty()
+        key = Thread.objects.get_listing_count_cache_key(ss, 'en', Site.objects.get_current())
+        same_key = Thread.objects.get_listing_count_cache_key(
+                                        ss.change_sort('votes-asc').change_page(3),
+                                        'en',
+                                        Site.objects.get_current()
+                                    )
+        self.assertEqual(key, same_key)
+
+    def test_retag_invalidates_counts(self):
+        ss = SearchState.get_empty().add_tag('tag1')
+        self.assertEqual(1, self._count(ss))
+        self.q2.thread.retag(
+                    retagged_by=self.user,
+                    retagged_at=datetime.datetime.now(),
+                    tagnames='tag1 tag2'
+                )
+        self.assertEqual(2, self._count(ss))
+
+    def test_answer_invalidates_unanswered_count(self):
+        ss = SearchState.get_empty().change_scope('unanswered')
+        self.assertEqual(2, self._count(ss))
+        self.post_answer(question=self.q1)
+        self.assertEqual(1, self._count(ss))
+
+    def _last_modified(self, search_state):
+        site = Site.objects.get_current()
+        qs, meta_data = Thread.objects.run_advanced_search(
+                                            request_user=None,
+                                            language_code='en',
+                                            site=site,
+                                            search_state=search_state
+                                        )
+        return Thread.objects.get_listing_last_modified(
+                                qs,
+                                search_state,
+                                language_code='en',
+                                site=site
+                            )
+
+    def test_listing_last_modified_follows_activity(self):
+        ss = SearchState.get_empty().add_tag('tag1')
+        thread = Thread.objects.get(id=self.q1.thread_id)
+        self.assertEqual(thread.last_activity_at, self._last_modified(ss))
+
+        #cached until some thread has new activity
+        later = thread.last_activity_at + datetime.timedelta(hours=1)
+        Thread.objects.filter(id=thread.id).update(last_activity_at=later)
+        self.assertEqual(thread.last_activity_at, self._last_modified(ss))
+
+        latest = later + datetime.timedelta(hours=1)
+        thread.set_last_activity(last_activity_at=latest, last_activity_by=self.user)
+        self.assertEqual(latest, self._last_modified(ss))
+
+    def test_large_unfiltered_listing_is_estimated(self):
+        old_get_estimated_count = Thread.objects.get_estimated_count
+        Thread.objects.get_estimated_count = lambda: 20000
+        try:
+            self.assertEqual(20000, self._count(SearchState.get_empty()))
+        finally:
+            Thread.objects.get_estimated_count = old_get_estimated_count
+
+
+class DeferredViewCountTests(AskbotTestCase):
+    def setUp(self):
+        self.create_user()
+        self.q1 = self.post_question()
+        self.q2 = self.post_question()
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('', {})
+        django_settings.ASKBOT_DEFER_VIEW_COUNTS = True
+
+    def tearDown(self):
+        cache.cache = self.old_cache
+        del django_settings.ASKBOT_DEFER_VIEW_COUNTS
+
+    def _view_count(self, question):
+        return Thread.objects.get(id=question.thread_id).view_count
+
+    def test_views_are_written_on_flush(self):
+        self.q1.thread.increase_view_count()
+        self.q1.thread.increase_view_count()
+        self.q2.thread.increase_view_count()
+        self.assertEqual(0, self._view_count(self.q1))
+
+        increments = Thread.objects.flush_pending_views()
+        self.assertEqual({self.q1.thread_id: 2, self.q2.thread_id: 1}, increments)
+        self.assertEqual(2, self._view_count(self.q1))
+        self.assertEqual(1, self._view_count(self.q2))
+
+        self.assertEqual({}, Thread.objects.flush_pending_views())
+
+        self.q2.thread.increase_view_count()
+        Thread.objects.flush_pending_views()
+        self.assertEqual(2, self._view_count(self.q2))
+
+    def test_flush_waits_for_slot_being_written(self):
+        from askbot.models.question import pending_thread_views
+        self.q1.thread.increase_view_count()
+        #another process has taken the next slot, but not written it yet
+        taken_slot = cache.cache.incr(pending_thread_views.count_key)
+        self.q2.thread.increase_view_count()
+
+        self.assertEqual({self.q1.thread_id: 1}, Thread.objects.flush_pending_views())
+        cache.cache.set(pending_thread_views.slot_key_tpl % taken_slot, self.q2.thread_id)
+        self.assertEqual({self.q2.thread_id: 1}, Thread.objects.flush_pending_views())
+
+    def test_flush_skips_abandoned_slot(self):
+        from askbot.models.question import pending_thread_views
+        cache.cache.add(pending_thread_views.count_key, 0)
+        cache.cache.incr(pending_thread_views.count_key)
+        self.q1.thread.increase_view_count()
+        self.assertEqual({}, Thread.objects.flush_pending_views())
+        #the slot is still missing on the next flush
+        self.assertEqual({self.q1.thread_id: 1}, Thread.objects.flush_pending_views())
+
+class CachedPostDataTests(AskbotTestCase):
+    def setUp(self):
+        self.create_user()
+        self.question = self.post_question()
+        self.answers = [self.post_answer(question=self.question) for i in range(12)]
+        self.post_comment(parent_post=self.answers[11])
+        self.thread = Thread.objects.get(id=self.question.thread_id)
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('', {})
+
+    def tearDown(self):
+        cache.cache = self.old_cache
+
+    def assertSamePostData(self, expected, post_data):
+        question, answers, post_to_author = post_data
+        self.assertEqual(expected[0].id, question.id)
+        self.assertEqual(
+            [(answer.id, answer.html) for answer in expected[1]],
+            [(answer.id, answer.html) for answer in answers]
+        )
+        self.assertEqual(expected[2], post_to_author)
+        for expected_answer, answer in zip(expected[1], answers):
+            self.assertEqual(
+                [comment.text for comment in expected_answer.get_cached_comments()],
+                [comment.text for comment in answer.get_cached_comments()]
+            )
+
+    def test_post_data_is_cached(self):
+        post_data = self.thread.get_post_data('latest')
+        self.assertSamePostData(post_data, self.thread.get_cached_post_data('latest'))
+        entry = cache.cache.get(self.thread.get_post_data_cache_key('latest'))
+        self.assertEqual(len(entry['answers']), 12)
+        #served from the cache
+        self.assertSamePostData(post_data, self.thread.get_cached_post_data('latest'))
+
+    def test_cached_posts_cannot_be_saved(self):
+        self.thread.get_cached_post_data('latest')
+        question, answers, post_to_author = self.thread.get_cached_post_data('latest')
+        self.assertEqual(answers[0].text, None)
+        self.assertRaises(ValueError, answers[0].save)
+
+
+class AnswerPageTests(AskbotTestCase):
+    def setUp(self):
+        self.create_user()
+        self.question = self.post_question()
+        self.answers = [self.post_answer(question=self.question) for i in range(12)]
+        self.comment = self.post_comment(parent_post=self.answers[11])
+        self.thread = Thread.objects.get(id=self.question.thread_id)
+
+    def test_answer_pages(self):
+        question, answers, answer_count, post_to_author = \
+                                    self.thread.get_answer_page('oldest', 2)
+        self.assertEqual(answer_count, 12)
+        self.assertEqual(
+            [answer.id for answer in answers],
+            [answer.id for answer in self.answers[10:]]
+        )
+        self.assertEqual(answers[1].get_cached_comments(), [self.comment])
+        self.assertTrue(self.comment.id in post_to_author)
+        self.assertTrue(question.id in post_to_author)
+
+        answers = self.thread.get_answer_page('latest', 1)[1]
+        self.assertEqual(answers[0], self.answers[11])
+        self.assertEqual(len(answers), 10)
+
+    def test_accepted_answer_goes_first(self):
+        self.thread.accepted_answer = self.answers[11]
+        self.thread.save()
+        answers = self.thread.get_answer_page('oldest', 1)[1]
+        self.assertEqual(answers[0], self.answers[11])
+        self.assertEqual(answers[1:], self.answers[:9])
+        answers = self.thread.get_answer_page('oldest', 2)[1]
+        self.assertEqual(answers, self.answers[9:11])
+
+    def test_page_number(self):
+        self.assertEqual(self.answers[9].get_page_number('oldest'), 1)
+        self.assertEqual(self.answers[10].get_page_number('oldest'), 2)
+        self.assertEqual(self.comment.get_page_number('oldest'), 2)
+        self.assertEqual(self.answers[11].get_page_number('latest'), 1)
+
+        self.thread.accepted_answer = self.answers[11]
+        self.thread.save()
+        thread = Thread.objects.get(id=self.thread.id)
+        self.assertEqual(thread.get_answer_position(self.answers[11], 'oldest'), 0)
+        self.assertEqual(thread.get_answer_position(self.answers[9], 'oldest'), 10)
+
+
+class TagPostingsTests(AskbotTestCase):
+    def setUp(self):
+        self.create_user()
+        self.q1 = self.post_question(tags='tag1 tag2')
+        self.q2 = self.post_question(tags='tag2 tag3')
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('', {})
+
+    def tearDown(self):
+        cache.cache = self.old_cache
+
+    def get_tag_id(self, name):
+        return Tag.objects.get(name=name).id
+
+    def test_postings_follow_retag(self):
+        tag1 = self.get_tag_id('tag1')
+        tag2 = self.get_tag_id('tag2')
+        self.assertEqual(
+            tag_postings.get_thread_ids([tag2]),
+            sorted([self.q1.thread_id, self.q2.thread_id])
+        )
+        self.assertEqual(tag_postings.get_thread_ids([tag1, tag2]), [self.q1.thread_id])
+
+        self.q2.thread.retag(
+                    retagged_by=self.user,
+                    retagged_at=datetime.datetime.now(),
+                    tagnames='tag1 tag2'
+                )
+        self.q1.thread.retag(
+                    retagged_by=self.user,
+                    retagged_at=datetime.datetime.now(),
+                    tagnames='tag2'
+                )
+        #cached lists were updated in place
+        self.assertEqual(tag_postings.get_thread_ids([tag1, tag2]), [self.q2.thread_id])
+        self.assertEqual(tag_postings.load_posting(tag1), [self.q2.thread_id])
+
+    def test_postings_follow_direct_relation_changes(self):
+        tag1 = self.get_tag_id('tag1')
+        tag2 = self.get_tag_id('tag2')
+        tag3 = self.get_tag_id('tag3')
+        tag_postings.get_thread_ids([tag1, tag2, tag3])#warm the cache
+
+        self.q1.thread.tags.clear()
+        self.assertEqual(tag_postings.get_thread_ids([tag2]), [self.q2.thread_id])
+        self.assertEqual(tag_postings.get_thread_ids([tag1]), [])
+
+        Tag.objects.get(id=tag3).threads.add(self.q1.thread)
+        self.assertEqual(
+            tag_postings.get_thread_ids([tag3]),
+            sorted([self.q1.thread_id, self.q2.thread_id])
+        )
+
+    def test_listing_filtered_by_postings(self):
+        ss = SearchState.get_empty().add_tag('tag2').add_tag('tag3')
+        qs, meta_data = Thread.objects.run_advanced_search(
+                                            request_user=self.user,
+                                            language_code='en',
+                                            site=Site.objects.get_current(),
+                                            search_state=ss
+                                        )
+        self.assertEqual([t.id for t in qs], [self.q2.thread_id])
+
+    def test_listing_filtered_by_long_postings(self):
+        #more thread ids than the query parameters allowed by SQLite
+        other_ids = range(100000, 101500)
+        for name in ('tag2', 'tag3'):
+            cache.cache.set(
+                tag_postings.get_cache_key(self.get_tag_id(name)),
+                [self.q2.thread_id] + other_ids
+            )
+        ss = SearchState.get_empty().add_tag('tag2').add_tag('tag3')
+        qs, meta_data = Thread.objects.run_advanced_search(
+                                            request_user=self.user,
+                                            language_code='en',
+                                            site=Site.objects.get_current(),
+                                            search_state=ss
+                                        )
+        self.assertEqual([t.id for t in qs], [self.q2.thread_id])
+
+class TagCooccurrenceTests(AskbotTestCase):
+    def setUp(self):
+        self.create_user()
+        self.q1 = self.post_question(tags='tag1 tag2 tag3')
+        self.q2 = self.post_question(tags='tag1 tag2')
+        self.q3 = self.post_question(tags='tag4')
+
+    def get_related(self, *tag_names):
+        tag_ids = Tag.objects.filter(name__in=tag_names).values_list('id', flat=True)
+        tags = Tag.objects.get_related_to_tags(tag_ids=list(tag_ids), ignored_tag_names=[])
+        return [(tag.name, tag.local_used_count) for tag in tags]
+
+    def test_related_tags(self):
+        self.assertEqual(self.get_related('tag1'), [('tag2', 2), ('tag3', 1)])
+        self.assertEqual(self.get_related('tag4'), [])
+
+        self.q3.thread.retag(
+                    retagged_by=self.user,
+                    retagged_at=datetime.datetime.now(),
+                    tagnames='tag4 tag1'
+                )
+        self.assertEqual(self.get_related('tag1'), [('tag2', 2), ('tag3', 1), ('tag4', 1)])
+
+        self.q1.thread.retag(
+                    retagged_by=self.user,
+                    retagged_at=datetime.datetime.now(),
+                    tagnames='tag1'
+                )
+        self.assertEqual(self.get_related('tag1'), [('tag2', 1), ('tag4', 1)])
+
+    def test_related_to_several_tags(self):
+        #tags used with each of the selected tags, the smallest count
+        self.assertEqual(self.get_related('tag1', 'tag3'), [('tag2', 1)])
+        self.assertEqual(self.get_related('tag1', 'tag2'), [('tag3', 1)])
+        self.assertEqual(self.get_related('tag2', 'tag4'), [])
+
+    def test_deleted_question_is_not_counted(self):
+        self.user.delete_question(question=self.q2)
+        self.assertEqual(self.get_related('tag1'), [('tag2', 1), ('tag3', 1)])
+        self.user.restore_post(post=self.q2)
+        self.assertEqual(self.get_related('tag1'), [('tag2', 2), ('tag3', 1)])
+
+    def test_recount(self):
+        self.user.delete_question(question=self.q2)
+        TagCooccurrence.objects.filter(thread_count=1).delete()
+        TagCooccurrence.objects.recount()
+        self.assertEqual(self.get_related('tag1'), [('tag2', 1), ('tag3', 1)])
+        self.assertEqual(self.get_related('tag4'), [])
+
+    def test_concurrently_created_pair_is_incremented(self):
+        tag1, tag4 = Tag.objects.filter(name__in=('tag1', 'tag4')).order_by('name')
+        TagCooccurrence.objects._create_or_increment(tag1.id, tag4.id, 1)
+        TagCooccurrence.objects._create_or_increment(tag1.id, tag4.id, 1)
+        pair = TagCooccurrence.objects.get(tag=tag1, other_tag=tag4)
+        self.assertEqual(pair.thread_count, 2)
+
+class UserTagFilterTests(AskbotTestCase):
+    def setUp(self):
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('', {})
+        self.create_user()
+        self.post_question(tags='day night')
+
+    def tearDown(self):
+        cache.cache = self.old_cache
+
+    def get_tag_ids(self, *tag_names):
+        return set(Tag.objects.filter(name__in=tag_names).values_list('id', flat=True))
+
+    def test_marked_tags_invalidate_filter(self):
+        tag_filter = get_user_tag_filter(self.user)
+        self.assertEqual(tag_filter['interesting_tag_ids'], set())
+
+        self.user.mark_tags(tagnames=('day',), reason='good', action='add')
+        tag_filter = get_user_tag_filter(self.user)
+        self.assertEqual(tag_filter['interesting_tag_ids'], self.get_tag_ids('day'))
+        self.assertEqual(tag_filter['interesting_tag_names'], ['day'])
+
+        self.user.mark_tags(tagnames=('day',), reason='bad', action='add')
+        tag_filter = get_user_tag_filter(self.user)
+        self.assertEqual(tag_filter['interesting_tag_ids'], set())
+        self.assertEqual(tag_filter['ignored_tag_ids'], self.get_tag_ids('day'))
+
+    def test_new_tag_matching_wildcard_invalidates_filter(self):
+        self.user.mark_tags(wildcards=('da*',), reason='good', action='add')
+        tag_filter = get_user_tag_filter(self.user, use_wildcards=True)
+        self.assertEqual(tag_filter['interesting_tag_ids'], self.get_tag_ids('day'))
+
+        self.post_question(tags='dawn')
+        tag_filter = get_user_tag_filter(self.user, use_wildcards=True)
+        self.assertEqual(
+            tag_filter['interesting_tag_ids'],
+            self.get_tag_ids('day', 'dawn')
+        )
 
 class ThreadRenderLowLevelCachingTests(AskbotTestCase):
     def setUp(self):
@@ -371,8 +830,11 @@ class ThreadRenderLowLevelCachingTests(AskbotTestCase):
         cache.cache = LocMemCache('', {})  # Enable local caching
 
         thread = self.q.thread
-        key = Thread.SUMMARY_CACHE_KEY_TPL % thread.id
+        key = thread.get_summary_cache_key()
 
+        # posting the question marks the summary stale, it is rendered when read
+        self.assertFalse(thread.summary_html_cached())
+        thread.get_summary_html(search_state=SearchState.get_empty())
         self.assertTrue(thread.summary_html_cached())
         self.assertIsNotNone(thread.get_cached_summary_html())
 
@@ -427,6 +889,52 @@ class ThreadRenderLowLevelCachingTests(AskbotTestCase):
             thread.get_summary_html(search_state=SearchState.get_empty())
         )
 
+    def test_cache_generation_is_advanced(self):
+        cache.cache = LocMemCache('', {})  # Enable local caching
+
+        thread = self.q.thread
+        generation = Thread.get_cache_generation(thread.id)
+        self.assertEqual(generation, Thread.get_cache_generation(thread.id))
+        data_key = thread.get_post_data_cache_key('votes')
+        summary_key = thread.get_summary_cache_key()
+        self.assertTrue(str(generation) in data_key)
+        self.assertTrue(str(generation) in summary_key)
+
+        self.post_answer(question=self.q)
+        new_generation = Thread.get_cache_generation(thread.id)
+        self.assertNotEqual(generation, new_generation)
+        self.assertNotEqual(data_key, thread.get_post_data_cache_key('votes'))
+        self.assertNotEqual(summary_key, thread.get_summary_cache_key())
+
+        thread.retag(retagged_by=self.user, retagged_at=datetime.datetime.now(), tagnames='tag1')
+        self.assertNotEqual(new_generation, Thread.get_cache_generation(thread.id))
+
+    def test_cache_generations_are_read_at_once(self):
+        cache.cache = LocMemCache('', {})  # Enable local caching
+
+        q2 = self.post_question(tags='tag4')
+        thread_ids = [self.q.thread_id, q2.thread_id]
+        generations = Thread.objects.get_cache_generations(thread_ids)
+        self.assertEqual(set(generations), set(thread_ids))
+        for thread_id in thread_ids:
+            self.assertEqual(generations[thread_id], Thread.get_cache_generation(thread_id))
+
+    def test_precache_summary_html(self):
+        cache.cache = LocMemCache('', {})  # Enable local caching
+
+        q2 = self.post_question(tags='tag4')
+        threads = list(Thread.objects.filter(id__in=[self.q.thread_id, q2.thread_id]))
+        for thread in threads:
+            cache.cache.delete(thread.get_summary_cache_key())
+        cache.cache.set(self.q.thread.get_summary_cache_key(), 'Cached <<<tag1>>>', timeout=100)
+
+        Thread.objects.precache_summary_html(threads=threads)
+
+        summaries = dict((thread.id, thread.get_cached_summary_html()) for thread in threads)
+        self.assertEqual('Cached <<<tag1>>>', summaries[self.q.thread_id])
+        self.assertTrue(q2.thread.summary_html_cached())
+        self.assertEqual(q2.thread.render_summary_html(), summaries[q2.thread_id])
+
 
 
 class ThreadRenderCacheUpdateTests(AskbotTestCase):
@@ -456,6 +964,23 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
         html = get_template('widgets/question_summary.html').render(context)
         return html
 
+    def _assert_summary_is_fresh(self, thread, html):
+        #stale summaries are dropped from the cache and rendered on the next read
+        cached_html = thread.get_cached_summary_html()
+        self.assertTrue(cached_html is None or cached_html == html)
+        Thread.objects.precache_summary_html(threads=[thread])
+        self.assertTrue(thread.summary_html_cached())  # <<< make sure that caching backend is set up properly (i.e. it's not dummy)
+        self.assertEqual(html, thread.get_cached_summary_html())
+
+    def test_vote_marks_summary_stale(self):
+        question = self.post_question()
+        thread = Thread.objects.get(id=question.thread_id)
+        thread.update_summary_html()
+        self.assertTrue(thread.summary_html_cached())
+
+        self.user2.upvote(question)
+        self.assertFalse(thread.summary_html_cached())
+
     def test_post_question(self):
         self.assertEqual(0, Post.objects.count())
         response = self.client.post(urlresolvers.reverse('ask'), data={
@@ -472,9 +997,8 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
         self.assertItemsEqual(['tag1', 'tag2'], list(question.thread.tags.values_list('name', flat=True)))
         self.assertEqual(0, question.thread.answer_count)
 
-        self.assertTrue(question.thread.summary_html_cached())  # <<< make sure that caching backend is set up properly (i.e. it's not dummy)
         html = self._html_for_question(question)
-        self.assertEqual(html, question.thread.get_cached_summary_html())
+        self._assert_summary_is_fresh(question.thread, html)
 
     def test_edit_question(self):
         self.assertEqual(0, Post.objects.count())
@@ -503,9 +1027,8 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
         self.assertEqual(thread.last_activity_at, question.last_edited_at)
         self.assertEqual(thread.last_activity_by, question.author)
 
-        self.assertTrue(question.thread.summary_html_cached())  # <<< make sure that caching backend is set up properly (i.e. it's not dummy)
         html = self._html_for_question(question)
-        self.assertEqual(html, question.thread.get_cached_summary_html())
+        self._assert_summary_is_fresh(question.thread, html)
 
     def test_retag_question(self):
         self.assertEqual(0, Post.objects.count())
@@ -519,9 +1042,8 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
 
         self.assertItemsEqual(['tag1', 'tag2'], list(question.thread.tags.values_list('name', flat=True)))
 
-        self.assertTrue(question.thread.summary_html_cached())  # <<< make sure that caching backend is set up properly (i.e. it's not dummy)
         html = self._html_for_question(question)
-        self.assertEqual(html, question.thread.get_cached_summary_html())
+        self._assert_summary_is_fresh(question.thread, html)
 
     def test_answer_question(self):
         self.assertEqual(0, Post.objects.count())
@@ -554,9 +1076,8 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
         self.assertTrue(question.added_at < answer.added_at)
         self.assertNotEqual(question.author, answer.author)
 
-        self.assertTrue(thread.summary_html_cached())  # <<< make sure that caching backend is set up properly (i.e. it's not dummy)
         html = self._html_for_question(thread._question_post())
-        self.assertEqual(html, thread.get_cached_summary_html())
+        self._assert_summary_is_fresh(thread, html)
 
     def test_edit_answer(self):
         self.assertEqual(0, Post.objects.count())
@@ -587,9 +1108,8 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
         self.assertTrue(thread.last_activity_at > question_thread.last_activity_at)
         self.assertNotEqual(thread.last_activity_by, question_thread.last_activity_by)
 
-        self.assertTrue(thread.summary_html_cached())  # <<< make sure that caching backend is set up properly (i.e. it's not dummy)
         html = self._html_for_question(thread._question_post())
-        self.assertEqual(html, thread.get_cached_summary_html())
+        self._assert_summary_is_fresh(thread, html)
 
     def test_view_count(self):
         question = self.post_question()
@@ -607,9 +1127,8 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
         thread = Thread.objects.all()[0]
         self.assertEqual(1, thread.view_count)
 
-        self.assertTrue(thread.summary_html_cached())  # <<< make sure that caching backend is set up properly (i.e. it's not dummy)
         html = self._html_for_question(thread._question_post())
-        self.assertEqual(html, thread.get_cached_summary_html())
+        self._assert_summary_is_fresh(thread, html)
 
     def test_question_upvote_downvote(self):
         question = self.post_question()
@@ -630,9 +1149,8 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
 
         thread = Thread.objects.get(id=question.thread.id)
 
-        self.assertTrue(thread.summary_html_cached())  # <<< make sure that caching backend is set up properly (i.e. it's not dummy)
         html = self._html_for_question(thread._question_post())
-        self.assertEqual(html, thread.get_cached_summary_html())
+        self._assert_summary_is_fresh(thread, html)
 
         ###
 
@@ -646,9 +1164,8 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
 
         thread = Thread.objects.get(id=question.thread.id)
 
-        self.assertTrue(thread.summary_html_cached())  # <<< make sure that caching backend is set up properly (i.e. it's not dummy)
         html = self._html_for_question(thread._question_post())
-        self.assertEqual(html, thread.get_cached_summary_html())
+        self._assert_summary_is_fresh(thread, html)
 
     def test_question_accept_answer(self):
         question = self.post_question(user=self.user2)
@@ -665,9 +1182,8 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
 
         thread = Thread.objects.get(id=question.thread.id)
 
-        self.assertTrue(thread.summary_html_cached())  # <<< make sure that caching backend is set up properly (i.e. it's not dummy)
         html = self._html_for_question(thread._question_post())
-        self.assertEqual(html, thread.get_cached_summary_html())
+        self._assert_summary_is_fresh(thread, html)
 
 
 # TODO: (in spare time - those cases should pass without changing anything in code but we should have them eventually for completness)
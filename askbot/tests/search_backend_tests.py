@@ -0,0 +1,217 @@
+import shutil
+import sqlite3
+import tempfile
+from django.conf import settings as django_settings
+from django.test import TestCase
+from django.contrib.sites.models import Site
+from askbot import const
+from askbot.models import Thread
+from askbot.search import bm25
+from askbot.search import backends
+from askbot.search.backends import inverted_index
+from askbot.search.backends import sqlite_fts
+from askbot.search.state_manager import SearchState
+from askbot.tests.utils import AskbotTestCase, skipIf
+
+def fts5_is_available():
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute('CREATE VIRTUAL TABLE test USING fts5(text)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+
+class TokenizerTests(TestCase):
+
+    def test_tokenize(self):
+        self.assertEqual(
+            backends.tokenize(u'Django, jinja2 and SQL!'),
+            [u'django', u'jinja2', u'and', u'sql']
+        )
+        self.assertEqual(backends.tokenize(None), [])
+
+
+class BM25Tests(TestCase):
+
+    def test_term_frequencies_are_boosted(self):
+        fields = {'title': u'Marmalade', 'tagnames': u'food', 'text': u'marmalade toast'}
+        frequencies, length = bm25.get_term_frequencies(fields, backends.tokenize)
+        boosts = const.SEARCH_FIELD_BOOSTS
+        self.assertEqual(frequencies[u'marmalade'], boosts['title'] + boosts['text'])
+        self.assertEqual(frequencies[u'food'], boosts['tagnames'])
+        self.assertEqual(length, boosts['title'] + boosts['tagnames'] + 2 * boosts['text'])
+
+    def test_rare_terms_score_higher(self):
+        self.assertTrue(bm25.get_idf(100, 1) > bm25.get_idf(100, 50))
+        self.assertTrue(bm25.get_idf(100, 100) > 0)
+
+    def test_iter_top_ids(self):
+        scores = {1: 0.5, 2: 3.0, 3: 1.0, 4: 0.1}
+        self.assertEqual(list(bm25.iter_top_ids(scores)), [2, 3, 1, 4])
+
+    def test_filter_ranked_ids(self):
+        ranked_ids = range(2000, 0, -1)
+        self.assertEqual(backends.filter_ranked_ids(ranked_ids, 2), [2000, 1999])
+        #the filter sees batches from the top of the ranking
+        batches = list()
+        def filter_ids(ids):
+            batches.append(ids)
+            return [thread_id for thread_id in ids if thread_id % 700 == 0]
+        self.assertEqual(
+            backends.filter_ranked_ids(ranked_ids, 2, filter_ids),
+            [1400, 700]
+        )
+        self.assertTrue(max([len(batch) for batch in batches]) <= const.SEARCH_RANK_BATCH_SIZE)
+        self.assertFalse(1 in batches[-1])
+
+
+class InvertedIndexBackendTests(AskbotTestCase):
+    backend_path = 'askbot.search.backends.inverted_index.InvertedIndexBackend'
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        django_settings.ASKBOT_SEARCH_BACKEND = self.backend_path
+        django_settings.ASKBOT_SEARCH_INDEX_DIR = self.index_dir
+        backends._BACKENDS.clear()
+        self.backend = backends.get_backend()
+        self.create_user()
+
+    def tearDown(self):
+        del django_settings.ASKBOT_SEARCH_BACKEND
+        del django_settings.ASKBOT_SEARCH_INDEX_DIR
+        backends._BACKENDS.clear()
+        shutil.rmtree(self.index_dir)
+
+    def test_question_and_answer_are_indexed(self):
+        question = self.post_question(
+                        title = 'compiling extensions',
+                        body_text = 'gcc fails on windows',
+                        tags = 'python'
+                    )
+        thread_id = question.thread_id
+        self.assertEqual(self.backend.search('Windows gcc'), [thread_id])
+        self.assertEqual(self.backend.search('python'), [thread_id])
+        self.assertEqual(self.backend.search('windows linux'), [])
+
+        self.post_answer(question = question, body_text = 'try mingw on linux')
+        self.assertEqual(self.backend.search('windows linux'), [thread_id])
+
+    def test_search_filters_listing(self):
+        question = self.post_question(body_text = 'unique marmalade')
+        self.post_question(body_text = 'plain text')
+        threads = Thread.objects.get_for_query('marmalade')
+        self.assertEqual([t.id for t in threads], [question.thread_id])
+
+    def test_search_limit(self):
+        q1 = self.post_question(body_text = 'marmalade and toast')
+        q2 = self.post_question(body_text = 'more marmalade')
+        self.assertEqual(len(self.backend.search('marmalade', 1)), 1)
+        self.assertEqual(
+            sorted(self.backend.search('marmalade')),
+            sorted([q1.thread_id, q2.thread_id])
+        )
+
+    def test_common_query_filters_listing(self):
+        q1 = self.post_question(body_text = 'marmalade and toast')
+        q2 = self.post_question(body_text = 'more marmalade')
+        self.post_question(body_text = 'plain text')
+        threads = Thread.objects.get_for_query('marmalade')
+        self.assertEqual(
+            sorted([t.id for t in threads]),
+            sorted([q1.thread_id, q2.thread_id])
+        )
+
+    def test_filter_ids_over_parameter_limit(self):
+        question = self.post_question(body_text = 'marmalade')
+        thread_ids = range(100000, 101500) + [question.thread_id]
+        threads = Thread.objects.filter_ids(Thread.objects.all(), thread_ids)
+        self.assertEqual([t.id for t in threads], [question.thread_id])
+        self.assertEqual(list(Thread.objects.filter_ids(Thread.objects.all(), [])), [])
+
+    def test_deleted_thread_is_removed(self):
+        question = self.post_question(body_text = 'unique marmalade')
+        question.thread.delete()
+        self.assertEqual(self.backend.search('marmalade'), [])
+
+    def test_rank(self):
+        q1 = self.post_question(body_text = 'marmalade and toast')
+        q2 = self.post_question(body_text = 'marmalade marmalade marmalade')
+        q3 = self.post_question(title = 'marmalade recipes', body_text = 'oranges')
+        #title is boosted over the text
+        self.assertEqual(
+            self.backend.rank('marmalade', 3),
+            [q3.thread_id, q2.thread_id, q1.thread_id]
+        )
+        #only the threads passing the filter are ranked
+        candidates = set([q1.thread_id, q2.thread_id])
+        self.assertEqual(
+            self.backend.rank('marmalade', 1, lambda ids: candidates & set(ids)),
+            [q2.thread_id]
+        )
+        #all words are required
+        self.assertEqual(self.backend.rank('marmalade toast', 3), [q1.thread_id])
+
+    def test_listing_ordered_by_relevance(self):
+        q1 = self.post_question(body_text = 'marmalade and toast')
+        q2 = self.post_question(body_text = 'marmalade marmalade marmalade')
+
+        search_state = SearchState(
+                            scope = None,
+                            sort = 'relevance-desc',
+                            query = 'marmalade',
+                            tags = None,
+                            author = None,
+                            page = None,
+                            user_logged_in = None
+                        )
+        self.assertEqual(search_state.sort, 'relevance-desc')
+        qs, meta_data = Thread.objects.run_advanced_search(
+                                            request_user = self.user,
+                                            language_code = 'en',
+                                            site = Site.objects.get_current(),
+                                            search_state = search_state
+                                        )
+        self.assertEqual([t.id for t in qs], [q2.thread_id, q1.thread_id])
+
+
+class SmallBlockInvertedIndexTests(InvertedIndexBackendTests):
+    """runs the tests with every thread in a posting block of its own"""
+
+    def setUp(self):
+        self.old_block_size = inverted_index.POSTING_BLOCK_SIZE
+        inverted_index.POSTING_BLOCK_SIZE = 1
+        super(SmallBlockInvertedIndexTests, self).setUp()
+
+    def tearDown(self):
+        super(SmallBlockInvertedIndexTests, self).tearDown()
+        inverted_index.POSTING_BLOCK_SIZE = self.old_block_size
+
+    def test_thread_is_written_to_its_block(self):
+        q1 = self.post_question(body_text = 'marmalade')
+        q2 = self.post_question(body_text = 'marmalade')
+        with self.backend.open_index() as index:
+            term_record = index[inverted_index.get_term_key(u'marmalade')]
+            self.assertEqual(term_record['count'], 2)
+            self.assertEqual(term_record['blocks'], [q1.thread_id, q2.thread_id])
+            block = index[inverted_index.get_block_key(u'marmalade', q2.thread_id)]
+            self.assertEqual(block.keys(), [q2.thread_id])
+
+        q2.thread.delete()
+        with self.backend.open_index() as index:
+            term_record = index[inverted_index.get_term_key(u'marmalade')]
+            self.assertEqual(term_record['blocks'], [q1.thread_id])
+
+
+@skipIf(not fts5_is_available(), 'SQLite is built without FTS5')
+class SqliteFtsBackendTests(InvertedIndexBackendTests):
+    backend_path = 'askbot.search.backends.sqlite_fts.SqliteFtsBackend'
+
+    def test_match_expression(self):
+        self.assertEqual(
+            sqlite_fts.get_match_expression(u'NOT "gcc" OR'),
+            u'"not" "gcc" "or"'
+        )
+        self.assertEqual(sqlite_fts.get_match_expression(u'!?'), None)
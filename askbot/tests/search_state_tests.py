@@ -1,5 +1,9 @@
+import datetime
+from django.test import TestCase
 from askbot.tests.utils import AskbotTestCase
 from askbot.search.state_manager import SearchState
+from askbot.search import keyset
+from askbot.models import Thread
 import askbot.conf
 from django.core import urlresolvers
 
@@ -291,3 +295,142 @@ class SearchStateTests(AskbotTestCase):
         )
 
 
+
+    def test_cursor_replaces_page(self):
+        ss = SearchState(
+            scope=None,
+            sort='votes-desc',
+            query=None,
+            tags=None,
+            author=None,
+            page='3',
+            user_logged_in=False,
+            cursor='dm90ZXMtZGVzY3xuZXh0fGk1fDEy'
+        )
+        self.assertEqual(
+            'scope:all/sort:votes-desc/cursor:dm90ZXMtZGVzY3xuZXh0fGk1fDEy/',
+            ss.query_string()
+        )
+        self.assertEqual(
+            'scope:all/sort:votes-desc/page:2/',
+            ss.change_page(2).query_string()
+        )
+        self.assertEqual(
+            'scope:all/sort:votes-desc/tags:one/page:1/',
+            ss.add_tag('one').query_string()
+        )
+
+    def test_malformed_cursor_is_dropped(self):
+        ss = SearchState(
+            scope=None,
+            sort=None,
+            query=None,
+            tags=None,
+            author=None,
+            page=None,
+            user_logged_in=False,
+            cursor='not/a cursor'
+        )
+        self.assertEqual(None, ss.cursor)
+
+
+class KeysetCursorTests(TestCase):
+    def test_cursor_roundtrip(self):
+        thread = Thread(
+                    id=12,
+                    score=5,
+                    last_activity_at=datetime.datetime(2012, 5, 17, 10, 15, 30, 42)
+                )
+        cursor = keyset.encode_cursor('votes-desc', 'next', thread)
+        self.assertEqual(('next', 5, 12), keyset.decode_cursor(cursor, 'votes-desc'))
+
+        cursor = keyset.encode_cursor('activity-asc', 'prev', thread)
+        self.assertEqual(
+            ('prev', thread.last_activity_at, 12),
+            keyset.decode_cursor(cursor, 'activity-asc')
+        )
+
+    def test_cursor_of_other_sort_is_ignored(self):
+        thread = Thread(id=12, score=5)
+        cursor = keyset.encode_cursor('votes-desc', 'next', thread)
+        self.assertEqual(None, keyset.decode_cursor(cursor, 'votes-asc'))
+        self.assertEqual(None, keyset.decode_cursor('garbage', 'votes-desc'))
+
+
+class KeysetPageTests(AskbotTestCase):
+    def setUp(self):
+        self.create_user()
+        self.thread_ids = list()
+        #ties of the sort values cross the page boundaries
+        timestamp = datetime.datetime(2012, 5, 17, 10, 15, 30)
+        for score in (3, 1, 3, 2, 3, 2, 3):
+            thread_id = self.post_question().thread_id
+            Thread.objects.filter(id=thread_id).update(
+                                score=score, last_activity_at=timestamp
+                            )
+            self.thread_ids.append(thread_id)
+        self.qs = Thread.objects.filter(id__in=self.thread_ids)
+
+    def get_expected_ids(self, sort_method):
+        field, descending = keyset.SORT_KEYS[sort_method]
+        threads = sorted(
+                    self.qs,
+                    key=lambda thread: (getattr(thread, field), thread.id),
+                    reverse=descending
+                )
+        return [thread.id for thread in threads]
+
+    def walk(self, sort_method, direction, cursor=None):
+        """returns list of pages, as lists of the thread ids,
+        in the order of the walk"""
+        pages = list()
+        page = keyset.get_page(self.qs, sort_method, cursor, page_size=3)
+        pages.append(page)
+        while True:
+            if direction == 'next':
+                cursor = page.next_cursor
+            else:
+                cursor = page.previous_cursor
+            if cursor is None:
+                break
+            page = keyset.get_page(self.qs, sort_method, cursor, page_size=3)
+            pages.append(page)
+        return pages
+
+    def get_ids(self, page):
+        return [thread.id for thread in page.object_list]
+
+    def test_walk_covers_every_thread_once(self):
+        for sort_method in ('votes-desc', 'votes-asc', 'activity-desc'):
+            pages = self.walk(sort_method, 'next')
+            self.assertEqual([3, 3, 1], [len(page.object_list) for page in pages])
+            walked_ids = sum([self.get_ids(page) for page in pages], [])
+            self.assertEqual(walked_ids, self.get_expected_ids(sort_method))
+
+            self.assertFalse(pages[0].has_previous())
+            self.assertTrue(pages[0].has_next())
+            self.assertTrue(pages[1].has_previous())
+            self.assertFalse(pages[-1].has_next())
+            self.assertTrue(pages[-1].has_previous())
+
+    def test_walk_back_returns_same_pages(self):
+        for sort_method in ('votes-desc', 'votes-asc', 'activity-desc'):
+            forward_pages = self.walk(sort_method, 'next')
+            backward_pages = self.walk(
+                                sort_method,
+                                'prev',
+                                cursor=forward_pages[-1].previous_cursor
+                            )
+            self.assertEqual(
+                [self.get_ids(page) for page in backward_pages],
+                [self.get_ids(page) for page in reversed(forward_pages[:-1])]
+            )
+            first_page = backward_pages[-1]
+            self.assertFalse(first_page.has_previous())
+            self.assertEqual(first_page.next_cursor, forward_pages[0].next_cursor)
+
+    def test_page_of_exact_size_has_no_next(self):
+        qs = self.qs.filter(id__in=self.thread_ids[:3])
+        page = keyset.get_page(qs, 'votes-desc', page_size=3)
+        self.assertEqual(len(page.object_list), 3)
+        self.assertFalse(page.has_other_pages())
@@ -1,5 +1,12 @@
+import datetime
 from django.test import TestCase
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.utils.http import http_date
 from askbot.utils.url_utils import urls_equal
+from askbot.utils.http import get_etag, get_not_modified_response
+from askbot.utils.http import get_timestamp, set_validators
+from askbot.utils.lists import gallop_intersect, intersect_sorted
 
 class UrlUtilsTests(TestCase):
     
@@ -15,3 +22,65 @@ class UrlUtilsTests(TestCase):
         self.assertTrue(e('http://cnn.com/path', 'http://cnn.com/path/', True))
         self.assertFalse(e('http://cnn.com/path', 'http://cnn.com/path/'))
         
+
+
+class ListUtilsTests(TestCase):
+
+    def test_gallop_intersect(self):
+        self.assertEqual(gallop_intersect([3, 8, 40, 98], range(0, 100, 2)), [8, 40, 98])
+        self.assertEqual(gallop_intersect([101], range(100)), [])
+        self.assertEqual(gallop_intersect([], range(100)), [])
+
+    def test_intersect_sorted(self):
+        self.assertEqual(
+            intersect_sorted([[1, 3, 5, 7], [3, 4, 7], [2, 3, 7, 9]]),
+            [3, 7]
+        )
+        self.assertEqual(intersect_sorted([[1, 2], []]), [])
+        self.assertEqual(intersect_sorted([]), [])
+
+
+class ConditionalGetTests(TestCase):
+
+    def setUp(self):
+        self.last_modified = datetime.datetime(2012, 5, 1, 10, 30)
+        self.etag = get_etag(self.last_modified, '/questions/')
+
+    def get_response(self, **headers):
+        request = RequestFactory().get('/questions/', **headers)
+        return get_not_modified_response(request, self.etag, self.last_modified)
+
+    def test_etag(self):
+        self.assertEqual(self.etag, get_etag(self.last_modified, '/questions/'))
+        self.assertNotEqual(self.etag, get_etag(self.last_modified, '/questions/?page=2'))
+
+    def test_matching_etag(self):
+        response = self.get_response(HTTP_IF_NONE_MATCH='"%s"' % self.etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], '"%s"' % self.etag)
+
+    def test_changed_etag(self):
+        #outdated etag wins over the date
+        response = self.get_response(
+                        HTTP_IF_NONE_MATCH='"outdated"',
+                        HTTP_IF_MODIFIED_SINCE=http_date(get_timestamp(self.last_modified))
+                    )
+        self.assertEqual(response, None)
+
+    def test_if_modified_since(self):
+        timestamp = get_timestamp(self.last_modified)
+        response = self.get_response(HTTP_IF_MODIFIED_SINCE=http_date(timestamp))
+        self.assertEqual(response.status_code, 304)
+        response = self.get_response(HTTP_IF_MODIFIED_SINCE=http_date(timestamp - 1))
+        self.assertEqual(response, None)
+
+    def test_unconditional_request(self):
+        self.assertEqual(self.get_response(), None)
+
+    def test_set_validators(self):
+        response = set_validators(HttpResponse(), self.etag, self.last_modified)
+        self.assertEqual(response['ETag'], '"%s"' % self.etag)
+        self.assertEqual(
+            response['Last-Modified'],
+            http_date(get_timestamp(self.last_modified))
+        )
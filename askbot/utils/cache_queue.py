@@ -0,0 +1,58 @@
+"""queue of small items in the django cache
+
+Writers take numbered slots with ``cache.incr`` and store
+the items in them, the reader takes the items from the slots
+after the last one it has read. The queue works only with
+a cache shared by the processes, for example memcached,
+with the ``LocMemCache`` each process has a queue of its own.
+
+Items are lost if the cache evicts them before they are read.
+"""
+from django.core import cache
+from askbot import const
+
+class CacheQueue(object):
+
+    def __init__(self, name):
+        self.count_key = name + '-slot-count'
+        self.slot_key_tpl = name + '-slot-%d'
+        self.read_slot_key = name + '-flushed-slot'
+        #first slot found taken but not written at the last read
+        self.stalled_slot_key = name + '-stalled-slot'
+
+    def put(self, item):
+        """takes a new slot and stores the item in it"""
+        try:
+            slot = cache.cache.incr(self.count_key)
+        except ValueError:
+            cache.cache.add(self.count_key, 0, const.LONG_TIME)
+            slot = cache.cache.incr(self.count_key)
+        cache.cache.set(self.slot_key_tpl % slot, item, const.LONG_TIME)
+
+    def take(self):
+        """returns list of the items put since the last call,
+        in the order of their slots"""
+        last_slot = cache.cache.get(self.count_key, 0)
+        read_slot = cache.cache.get(self.read_slot_key, 0)
+        if read_slot > last_slot:
+            #the slot counter was evicted and started over
+            read_slot = 0
+        slot_keys = [
+            self.slot_key_tpl % slot
+            for slot in range(read_slot + 1, last_slot + 1)
+        ]
+        stored = cache.cache.get_many(slot_keys)
+        #slot number is taken before the item is written to it,
+        #the read stops at the first slot that is not written yet,
+        #unless it was already missing at the last read
+        #(then it was evicted or the writer has died)
+        stalled_slot = cache.cache.get(self.stalled_slot_key)
+        for slot, key in enumerate(slot_keys, read_slot + 1):
+            if key not in stored and slot != stalled_slot:
+                cache.cache.set(self.stalled_slot_key, slot, const.LONG_TIME)
+                slot_keys = slot_keys[:slot - read_slot - 1]
+                last_slot = slot - 1
+                break
+        cache.cache.set(self.read_slot_key, last_slot, const.LONG_TIME)
+        cache.cache.delete_many(slot_keys)
+        return [stored[key] for key in slot_keys if key in stored]
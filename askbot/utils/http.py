@@ -1,6 +1,11 @@
 """http-related utilities for askbot
 """
+import calendar
+import time
 from copy import copy
+from django.http import HttpResponseNotModified
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 
 def hide_passwords(data):
     """replaces content of values that may contain passsword
@@ -46,3 +51,60 @@ def get_request_info(request):
     else:
         info += 'user is anonymous\n'
     return info
+
+def get_etag(*parts):
+    """returns entity tag made of the parts,
+    which must be convertible to unicode"""
+    value = u'-'.join([unicode(part) for part in parts])
+    return md5_constructor(value.encode('utf-8')).hexdigest()
+
+def get_timestamp(value):
+    """returns unix time of the naive local datetime value,
+    truncated to the seconds, as used in the http headers"""
+    return calendar.timegm(value.utctimetuple()) if value.tzinfo \
+        else int(time.mktime(value.timetuple()))
+
+def can_use_http_validators(request):
+    """True if the response to the request can carry
+    the ETag and Last-Modified headers - the pages of
+    the logged in users and the ones with the pending messages
+    are personalized and must not be revalidated by the clients
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if request.user.is_authenticated():
+        return False
+    from django.contrib import messages
+    return len(messages.get_messages(request)) == 0
+
+def get_not_modified_response(request, etag = None, last_modified = None):
+    """returns response 304 if the validators sent
+    by the client match the given ones, otherwise None
+
+    ``last_modified`` is a datetime and is used
+    only when the client did not send the entity tags
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and etag:
+        client_etags = parse_etags(if_none_match)
+        if etag in client_etags or '*' in client_etags:
+            return set_validators(HttpResponseNotModified(), etag, last_modified)
+        return None
+
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        if if_modified_since and get_timestamp(last_modified) <= if_modified_since:
+            return set_validators(HttpResponseNotModified(), etag, last_modified)
+    return None
+
+def set_validators(response, etag = None, last_modified = None):
+    """adds ETag and Last-Modified headers to the response"""
+    if etag:
+        response['ETag'] = quote_etag(etag)
+    if last_modified:
+        response['Last-Modified'] = http_date(get_timestamp(last_modified))
+    return response
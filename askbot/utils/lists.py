@@ -1,4 +1,5 @@
 """Utilities for working with lists and sequences."""
+import bisect
 
 class LazyList(list):
     def __init__(self, get_data):
@@ -88,3 +89,52 @@ def batches(items, number):
             # mod now tells you how many lists of 2 you can fit in
             return ([items[i*2:(i*2)+2] for i in xrange(0, mod)] +
                     [[item] for item in items[mod*2:]])
+
+def gallop_intersect(short, long):
+    """
+    Returns sorted list of items present in both sorted lists
+    without duplicates, ``short`` should be the shorter one.
+
+    For each item of the short list the position in the long
+    list is found by doubling the step from the last match,
+    then by the binary search within the last step, so long
+    lists are mostly skipped over.
+
+    >>> gallop_intersect([3, 8, 40], range(0, 100, 2))
+    [8, 40]
+    """
+    result = []
+    length = len(long)
+    position = 0
+    for item in short:
+        step = 1
+        while position + step < length and long[position + step] < item:
+            step *= 2
+        position = bisect.bisect_left(
+                            long, item, position, min(position + step + 1, length)
+                        )
+        if position == length:
+            break
+        if long[position] == item:
+            result.append(item)
+            position += 1
+    return result
+
+def intersect_sorted(lists):
+    """
+    Returns sorted list of items present in all the sorted lists.
+
+    >>> intersect_sorted([[1, 3, 5, 7], [3, 4, 7], [2, 3, 7, 9]])
+    [3, 7]
+    >>> intersect_sorted([])
+    []
+    """
+    if not lists:
+        return []
+    lists = sorted(lists, key = len)
+    result = list(lists[0])
+    for other in lists[1:]:
+        if not result:
+            break
+        result = gallop_intersect(result, other)
+    return result
@@ -18,6 +18,7 @@ from django.utils.html import escape
 from django.utils.translation import ugettext as _
 from django.utils.translation import string_concat
 from askbot import models
+from askbot.models.user import invalidate_unseen_question_ids
 from askbot import forms
 from askbot.conf import should_show_sort_by_relevance
 from askbot.conf import settings as askbot_settings
@@ -64,6 +65,7 @@ def manage_inbox(request):
                         memo_set.delete()
                     elif action_type == 'mark_new':
                         memo_set.update(status = models.ActivityAuditStatus.STATUS_NEW)
+                        invalidate_unseen_question_ids([user.id])
                     elif action_type == 'mark_seen':
                         memo_set.update(status = models.ActivityAuditStatus.STATUS_SEEN)
                     elif action_type == 'remove_flag':
@@ -264,10 +266,6 @@ def vote(request, id):
                 else:
                     request.user.get_profile().accept_best_answer(answer)
 
-                ####################################################################
-                answer.thread.update_summary_html() # regenerate question/thread summary html
-                ####################################################################
-
             else:
                 raise exceptions.PermissionDenied(
                         _('Sorry, but anonymous users cannot accept answers')
@@ -298,11 +296,6 @@ def vote(request, id):
                                         post = post
                                     )
 
-            ####################################################################
-            if vote_type in ('1', '2'): # up/down-vote question
-                post.thread.update_summary_html() # regenerate question/thread summary html
-            ####################################################################
-
         elif vote_type in ['7', '8']:
             #flag question or answer
             if vote_type == '7':
@@ -26,6 +26,8 @@ from django.contrib.humanize.templatetags import humanize
 from django.http import QueryDict
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.core import cache
+from django.middleware.csrf import get_token
 
 from askbot import exceptions
 from askbot.utils.diff import textDiff as htmldiff
@@ -36,7 +38,11 @@ from askbot import const
 from askbot.utils import functions
 from askbot.utils.html import sanitize_html
 from askbot.utils.decorators import anonymous_forbidden, ajax_only, get_only
+from askbot.utils.http import can_use_http_validators, get_etag
+from askbot.utils.http import get_not_modified_response, set_validators
+from django.utils.hashcompat import md5_constructor
 from askbot.search.state_manager import SearchState, DummySearchState
+from askbot.search import keyset
 import askbot.conf
 from askbot.conf import settings as askbot_settings
 from askbot.skins.loaders import render_into_skin, get_template #jinja2 template loading enviroment
@@ -56,6 +62,8 @@ INDEX_TAGS_SIZE = 25
 DEFAULT_PAGE_SIZE = 60
 # used in questions
 # used in answers
+#stands for the csrf token of the visitor in the cached question pages
+CSRF_TOKEN_PLACEHOLDER = '<<<csrf-token>>>'
 
 #refactor? - we have these
 #views that generate a listing of questions in one way or another:
@@ -96,67 +104,147 @@ class QuestionsView(TemplateView):
     def get_ask_url(self):
         return None
     
+    def get(self, request, *args, **kwargs):
+        if not can_use_http_validators(request):
+            return super(QuestionsView, self).get(request, *args, **kwargs)
+
+        search_state, qs, meta_data = self.get_search_results(**kwargs)
+        #cached until the listings change, not aggregated per request
+        last_modified = models.Thread.objects.get_listing_last_modified(
+                                                    qs,
+                                                    search_state,
+                                                    language_code=translation.get_language(),
+                                                    site=Site.objects.get_current(),
+                                                    thread_ids=self.thread_ids,
+                                                    is_specific=self.is_specific
+                                                )
+        etag = get_etag(
+                    last_modified,
+                    models.Thread.objects.get_listing_count_generation(),
+                    request.get_full_path(),
+                    request.is_ajax(),
+                    translation.get_language()
+                )
+        response = get_not_modified_response(request, etag, last_modified)
+        if response is not None:
+            return response
+        response = super(QuestionsView, self).get(request, *args, **kwargs)
+        if response.status_code == 200:
+            set_validators(response, etag, last_modified)
+        return response
+
+    def get_search_results(self, **kwargs):
+        """returns search state, queryset of the matching
+        threads and the search meta data, runs the search
+        only once per request"""
+        if getattr(self, '_search_results', None) is None:
+            language_code = translation.get_language()
+            site = Site.objects.get_current()
+            search_state = SearchState(
+                            user_logged_in=self.request.user.is_authenticated(),
+                            scope=kwargs["scope"],
+                            sort=kwargs["sort"],
+                            query=kwargs["query"],
+                            tags=kwargs["tags"],
+                            author=kwargs["author"],
+                            page=kwargs["page"],
+                            questions_url=self.get_questions_url(),
+                            ask_url=self.get_ask_url(),
+                            cursor=kwargs.get("cursor")
+                        )
+            qs, meta_data = models.Thread.objects.run_advanced_search(
+                                            request_user=self.request.user,
+                                            language_code=language_code,
+                                            site=site,
+                                            search_state=search_state,
+                                            thread_ids=self.thread_ids,
+                                            is_specific=self.is_specific
+                                        )
+            self._search_results = (search_state, qs, meta_data)
+        return self._search_results
+
     def get_context_data(self, **kwargs):
         context = TemplateView.get_context_data(self, **kwargs)
         
         language_code = translation.get_language()
         site = Site.objects.get_current()
-        
-        search_state = SearchState(user_logged_in=self.request.user.is_authenticated(),
-                                   scope=kwargs["scope"], 
-                                   sort=kwargs["sort"], 
-                                   query=kwargs["query"], 
-                                   tags=kwargs["tags"], 
-                                   author=kwargs["author"],
-                                   page=kwargs["page"],
-                                   questions_url=self.get_questions_url(),
-                                   ask_url=self.get_ask_url())
-        
+        search_state, qs, meta_data = self.get_search_results(**kwargs)
         page_size = int(askbot_settings.DEFAULT_QUESTIONS_PAGE_SIZE)
-    
-        qs, meta_data = models.Thread.objects.run_advanced_search(request_user=self.request.user, 
-                                                                  language_code=language_code,
-                                                                  site=site,
-                                                                  search_state=search_state,
-                                                                  thread_ids=self.thread_ids,
-                                                                  is_specific=self.is_specific)
-        
+
         if meta_data['non_existing_tags']:
             search_state = search_state.remove_tags(meta_data['non_existing_tags'])
     
-        paginator = Paginator(qs, page_size)
-        if paginator.num_pages < search_state.page:
-            search_state.page = 1
-        page = paginator.page(search_state.page)
-    
-        page.object_list = list(page.object_list) # evaluate queryset
-    
-        # INFO: Because for the time being we need question posts and thread authors
-        #       down the pipeline, we have to precache them in thread objects
-        
-        #FIXME@atiberghien : reactive or replace it
-        #models.Thread.objects.precache_view_data_hack(threads=page.object_list)
-    
-        related_tags = Tag.objects.get_related_to_search(threads=page.object_list, ignored_tag_names=meta_data.get('ignored_tag_names', []))
+        #cached, possibly approximate number of matching threads
+        questions_count = models.Thread.objects.get_listing_count(
+                                                    qs,
+                                                    search_state,
+                                                    meta_data,
+                                                    language_code=language_code,
+                                                    site=site,
+                                                    request_user=self.request.user,
+                                                    thread_ids=self.thread_ids,
+                                                    is_specific=self.is_specific
+                                                )
+
+        use_cursor_pagination = askbot_settings.QUESTIONS_CURSOR_PAGINATION \
+                                and keyset.supports_sort(search_state.sort)
+
+        if use_cursor_pagination:
+            #no OFFSET scans - the page is located by the cursor
+            page = keyset.get_page(qs,
+                                   search_state.sort,
+                                   cursor=search_state.cursor,
+                                   page_size=page_size)
+        else:
+            paginator = Paginator(qs, page_size)
+            paginator._count = questions_count # spare the paginator its own count query
+            if paginator.num_pages < search_state.page:
+                search_state.page = 1
+            page = paginator.page(search_state.page)
+            page.object_list = list(page.object_list) # evaluate queryset
+    
+        # INFO: summaries of the threads on the page are read from the cache at once,
+        #       only the missing ones are rendered, with the question posts prefetched
+        models.Thread.objects.precache_summary_html(threads=page.object_list)
+    
+        if meta_data.get('selected_tag_ids'):
+            #tags used together with the selected ones in the whole forum
+            related_tags = Tag.objects.get_related_to_tags(tag_ids=meta_data['selected_tag_ids'], ignored_tag_names=meta_data.get('ignored_tag_names', []))
+        else:
+            related_tags = Tag.objects.get_related_to_search(threads=page.object_list, ignored_tag_names=meta_data.get('ignored_tag_names', []))
         tag_list_type = askbot_settings.TAG_LIST_FORMAT
         if tag_list_type == 'cloud': #force cloud to sort by name
             related_tags = sorted(related_tags, key = operator.attrgetter('name'))
     
         contributors = list(models.Thread.objects.get_thread_contributors(thread_list=page.object_list).only('user__id', 'user__username', 'mugshot'))
     
-        paginator_context = {
-            'is_paginated' : (paginator.count > page_size),
-    
-            'pages': paginator.num_pages,
-            'page': search_state.page,
-            'has_previous': page.has_previous(),
-            'has_next': page.has_next(),
-            'previous': page.previous_page_number(),
-            'next': page.next_page_number(),
-    
-            'base_url' : search_state.query_string(),
-            'page_size' : page_size,
-        }
+        if use_cursor_pagination:
+            paginator_context = {
+                'is_paginated' : page.has_other_pages(),
+                'is_cursor_paginated': True,
+
+                'has_previous': page.has_previous(),
+                'has_next': page.has_next(),
+                'previous_cursor': page.previous_cursor,
+                'next_cursor': page.next_cursor,
+
+                'base_url' : search_state.query_string(),
+                'page_size' : page_size,
+            }
+        else:
+            paginator_context = {
+                'is_paginated' : (questions_count > page_size),
+
+                'pages': paginator.num_pages,
+                'page': search_state.page,
+                'has_previous': page.has_previous(),
+                'has_next': page.has_next(),
+                'previous': page.previous_page_number(),
+                'next': page.next_page_number(),
+
+                'base_url' : search_state.query_string(),
+                'page_size' : page_size,
+            }
     
         # We need to pass the rss feed url based
         # on the search state to the template.
@@ -181,15 +269,19 @@ class QuestionsView(TemplateView):
         reset_method_count = len(filter(None, [search_state.query, search_state.tags, meta_data.get('author_name', None)]))
         
         if self.request.is_ajax():
-            q_count = paginator.count
+            q_count = questions_count
     
             question_counter = ungettext('%(q_num)s question', '%(q_num)s questions', q_count)
             question_counter = question_counter % {'q_num': humanize.intcomma(q_count),}
     
             if q_count > page_size:
+                if use_cursor_pagination:
+                    template_paginator_context = paginator_context
+                else:
+                    template_paginator_context = functions.setup_paginator(paginator_context)
                 paginator_tpl = get_template('main_page/paginator.html', self.request)
                 paginator_html = paginator_tpl.render(Context({
-                    'context': functions.setup_paginator(paginator_context),
+                    'context': template_paginator_context,
                     'questions_count': q_count,
                     'page_size' : page_size,
                     'search_state': search_state,
@@ -238,7 +330,7 @@ class QuestionsView(TemplateView):
                     'page_size': page_size,
                     'query': search_state.query,
                     'threads' : page,
-                    'questions_count' : paginator.count,
+                    'questions_count' : questions_count,
                     'reset_method_count': reset_method_count,
                     'scope': search_state.scope,
                     'show_sort_by_relevance': askbot.conf.should_show_sort_by_relevance(),
@@ -366,6 +458,229 @@ class QuestionView(TemplateView):
                                 context, 
                                 self.request) 
 
+    def get(self, request, *args, **kwargs):
+        etag, last_modified = None, None
+        if can_use_http_validators(request):
+            #question post id is denormalized onto the thread,
+            #the lookup does not join the posts
+            thread_data = models.Thread.objects.filter(
+                                    question_post = kwargs['question_id'],
+                                    language_code = translation.get_language(),
+                                    site = Site.objects.get_current()
+                                ).values_list(
+                                    'id', 'last_activity_at', 'last_activity_by'
+                                )
+            if len(thread_data) == 1:
+                thread_id, last_modified, last_activity_by_id = thread_data[0]
+                etag = get_etag(
+                            models.Thread.get_cache_generation(thread_id),
+                            last_modified,
+                            request.get_full_path(),
+                            translation.get_language()
+                        )
+                response = get_not_modified_response(request, etag, last_modified)
+                if response is not None:
+                    self.record_visit(
+                            kwargs['question_id'],
+                            last_modified,
+                            last_activity_by_id
+                        )
+                    return response
+
+        response = self.get_page(request, *args, **kwargs)
+        if etag and response.status_code == 200:
+            set_validators(response, etag, last_modified)
+        return response
+
+    def get_page(self, request, *args, **kwargs):
+        """returns the page from the cache, if possible,
+        or renders it"""
+        cache_key = self.get_page_cache_key(**kwargs)
+        if cache_key is None:
+            return super(QuestionView, self).get(request, *args, **kwargs)
+
+        entry = cache.cache.get(cache_key)
+        if entry and self.can_serve_cached_page(entry):
+            return self.render_cached_page(entry)
+
+        self.question_post = None
+        response = super(QuestionView, self).get(request, *args, **kwargs)
+        if response.status_code == 200 and self.question_post:
+            self.cache_page(cache_key, response)
+        return response
+
+    def get_page_cache_key(self, **kwargs):
+        """returns key of the cached page for the anonymous
+        visitors, or None if the request must not be served from the cache
+        """
+        if not getattr(settings, 'ASKBOT_CACHE_QUESTION_PAGES', False):
+            return None
+        request = self.request
+        if request.method != 'GET' or request.user.is_authenticated():
+            return None
+        if len(messages.get_messages(request)) > 0:
+            return None
+        if set(request.GET) - set(['page', 'sort']):
+            #permalinks of the answers and comments may redirect
+            return None
+        default_sort_method = request.session.get('questions_sort_method', 'votes')
+        form = ShowQuestionForm(request.GET, default_sort_method)
+        form.full_clean()
+        return 'question-page-%s-%s-%s-%s-%s' % (
+                    kwargs['question_id'],
+                    form.cleaned_data['show_page'],
+                    form.cleaned_data['answer_sort_method'],
+                    translation.get_language(),
+                    settings.SITE_ID
+                )
+
+    def can_serve_cached_page(self, entry):
+        """True if the page was cached after the last change
+        of the thread or, in the stale-while-revalidate mode,
+        if the thread is hot and another request is already
+        rendering the fresh page
+        """
+        generation = models.Thread.get_cache_generation(entry['thread_id'])
+        if entry['generation'] == generation:
+            return True
+        if not getattr(settings, 'ASKBOT_QUESTION_PAGE_STALE_WHILE_REVALIDATE', False):
+            return False
+        if entry['view_count'] < const.QUESTION_PAGE_HOT_THREAD_MIN_VIEWS:
+            return False
+        lock_key = 'question-page-revalidation-%d-%s' % (entry['thread_id'], generation)
+        is_revalidating = not cache.cache.add(
+                                lock_key, True, const.QUESTION_PAGE_REVALIDATE_TIMEOUT
+                            )
+        return is_revalidating
+
+    def cache_page(self, cache_key, response):
+        thread = self.question_post.thread
+        content = response.content.replace(
+                            get_token(self.request), CSRF_TOKEN_PLACEHOLDER
+                        )
+        entry = {
+            'thread_id': thread.id,
+            'generation': models.Thread.get_cache_generation(thread.id),
+            'view_count': thread.view_count,
+            'question_id': self.question_post.id,
+            'last_activity_at': thread.last_activity_at,
+            'last_activity_by_id': thread.last_activity_by_id,
+            'content': content,
+            'content_type': response['Content-Type'],
+        }
+        cache.cache.set(cache_key, entry, const.QUESTION_PAGE_CACHE_TIMEOUT)
+
+    def render_cached_page(self, entry):
+        self.record_visit(
+                entry['question_id'],
+                entry['last_activity_at'],
+                entry['last_activity_by_id']
+            )
+        content = entry['content'].replace(
+                            CSRF_TOKEN_PLACEHOLDER, get_token(self.request)
+                        )
+        return HttpResponse(content, content_type = entry['content_type'])
+
+    def record_visit(self, question_post_id, last_activity_at, last_activity_by_id):
+        """counts visit to the question, which was served
+        without rendering the page"""
+        if not functions.not_a_robot_request(self.request):
+            return
+        update_view_count = self.update_visit_time(
+                                    question_post_id,
+                                    last_activity_at,
+                                    last_activity_by_id
+                                )
+        if update_view_count:
+            from askbot import tasks
+            question_post = models.Post.objects.select_related(
+                                        'thread'
+                                    ).get(id = question_post_id)
+            tasks.record_question_visit.delay(
+                question_post = question_post,
+                user = self.request.user,
+                update_view_count = True
+            )
+
+    def update_visit_time(self, question_post_id, last_activity_at, last_activity_by_id):
+        """remembers the visit in the session and returns
+        True if the view counter of the thread should be increased
+        """
+        #todo: merge view counts per user and per session
+        update_view_count = False
+        if 'question_view_times' not in self.request.session:
+            self.request.session['question_view_times'] = {}
+
+        last_seen = self.request.session['question_view_times'].get(question_post_id, None)
+
+        if last_activity_by_id != self.request.user.id:
+            if last_seen:
+                if last_seen < last_activity_at:
+                    update_view_count = True
+            else:
+                update_view_count = True
+
+        self.request.session['question_view_times'][question_post_id] = \
+                                                    datetime.datetime.now()
+        return update_view_count
+
+    def get_viewer_class(self, answer):
+        """returns class of the permissions of the visitor
+        to the answer: anonymous, regular, moderator or owner"""
+        user = self.request.user
+        if user.is_anonymous():
+            return 'anonymous'
+        if user.get_profile().is_administrator_or_moderator():
+            return 'moderator'
+        if answer.author_id == user.id:
+            return 'owner'
+        return 'regular'
+
+    def get_answer_card_cache_key(self, answer, thread):
+        """returns key of the rendered answer, which changes
+        whenever the answer, its state in the thread or its
+        comments change - so that editing one answer does not
+        require rendering of the other ones"""
+        comments = [
+            (comment.id, comment.score, comment.last_edited_at)
+            for comment in answer.get_cached_comments()
+        ]
+        key_bits = (
+            answer.last_edited_at,
+            answer.comment_count,
+            answer.score,
+            answer.deleted,
+            answer.offensive_flag_count,
+            thread.accepted_answer_id == answer.id,
+            thread.title,#in the permalink
+            comments,
+            self.get_viewer_class(answer),
+            translation.get_language(),
+        )
+        digest = md5_constructor(repr(key_bits)).hexdigest()
+        return 'answer-card-%d-%s' % (answer.id, digest)
+
+    def get_cached_answer_cards(self, answers, thread, show_post = None):
+        """returns dictionary answer id -> rendered answer
+        for the answers found in the cache and the dictionary
+        answer id -> cache key for the ones to be rendered,
+        the permalinked answer is never taken from the cache
+
+        vote state of the visitor is not in the cached html,
+        it is applied in the browser from ``user_votes``
+        """
+        keys = dict()
+        for answer in answers:
+            if answer != show_post:
+                keys[answer.id] = self.get_answer_card_cache_key(answer, thread)
+        cached = cache.cache.get_many(keys.values())
+        answer_cards = dict()
+        for answer_id, key in keys.items():
+            if key in cached:
+                answer_cards[answer_id] = cached[key]
+                del keys[answer_id]
+        return answer_cards, keys
+
     def get_context_data(self, **kwargs):
         
         language_code = translation.get_language()
@@ -490,18 +805,30 @@ class QuestionView(TemplateView):
                 return HttpResponseRedirect(reverse('question', kwargs = {'question_id': kwargs["question_id"]}))
     
         thread = question_post.thread
+        self.question_post = question_post
     
         logging.debug('answer_sort_method=' + unicode(answer_sort_method))
     
-        #load answers and post id's->athor_id mapping
+        #resolve page number and comment number for permalinks
+        show_comment_position = None
+        if show_comment:
+            show_page = show_comment.get_page_number(sort_method = answer_sort_method)
+            show_comment_position = show_comment.get_order_number()
+        elif show_answer:
+            show_page = show_post.get_page_number(sort_method = answer_sort_method)
+
+        #load answers of the page and post id's->athor_id mapping
         #posts are pre-stuffed with the correctly ordered comments
-        updated_question_post, answers, post_to_author = thread.get_cached_post_data(
-                                    sort_method = answer_sort_method,
-                                )
+        updated_question_post, answers, answer_count, post_to_author = \
+                                    thread.get_cached_answer_page(
+                                        sort_method = answer_sort_method,
+                                        page = show_page
+                                    )
         question_post.set_cached_comments(updated_question_post.get_cached_comments())
-    
-    
-        #Post.objects.precache_comments(for_posts=[question_post] + answers, visitor=self.request.user)
+
+        page_count = max((answer_count - 1)/const.ANSWERS_PAGE_SIZE + 1, 1)
+        if show_page > page_count:
+            return HttpResponseRedirect(question_post.get_absolute_url())
     
         user_votes = {}
         user_post_id_list = list()
@@ -518,42 +845,14 @@ class QuestionView(TemplateView):
                 id for id in post_to_author if post_to_author[id] == self.request.user.id
             ]
     
-        #resolve page number and comment number for permalinks
-        show_comment_position = None
-        if show_comment:
-            show_page = show_comment.get_page_number(answer_posts=answers)
-            show_comment_position = show_comment.get_order_number()
-        elif show_answer:
-            show_page = show_post.get_page_number(answer_posts=answers)
-    
-        objects_list = Paginator(answers, const.ANSWERS_PAGE_SIZE)
-        if show_page > objects_list.num_pages:
-            return HttpResponseRedirect(question_post.get_absolute_url())
-        page_objects = objects_list.page(show_page)
-    
         #count visits
-        #import ipdb; ipdb.set_trace()
         if functions.not_a_robot_request(self.request):
-            #todo: split this out into a subroutine
-            #todo: merge view counts per user and per session
-            #1) view count per session
-            update_view_count = False
-            if 'question_view_times' not in self.request.session:
-                self.request.session['question_view_times'] = {}
-    
-            last_seen = self.request.session['question_view_times'].get(question_post.id, None)
-    
-            if thread.last_activity_by_id != self.request.user.id:
-                if last_seen:
-                    if last_seen < thread.last_activity_at:
-                        update_view_count = True
-                else:
-                    update_view_count = True
-    
-            self.request.session['question_view_times'][question_post.id] = \
-                                                        datetime.datetime.now()
-    
-            #2) run the slower jobs in a celery task
+            update_view_count = self.update_visit_time(
+                                        question_post.id,
+                                        thread.last_activity_at,
+                                        thread.last_activity_by_id
+                                    )
+            #run the slower jobs in a celery task
             from askbot import tasks
             tasks.record_question_visit.delay(
                 question_post = question_post,
@@ -562,16 +861,22 @@ class QuestionView(TemplateView):
             )
     
         paginator_data = {
-            'is_paginated' : (objects_list.count > const.ANSWERS_PAGE_SIZE),
-            'pages': objects_list.num_pages,
+            'is_paginated' : (answer_count > const.ANSWERS_PAGE_SIZE),
+            'pages': page_count,
             'page': show_page,
-            'has_previous': page_objects.has_previous(),
-            'has_next': page_objects.has_next(),
-            'previous': page_objects.previous_page_number(),
-            'next': page_objects.next_page_number(),
+            'has_previous': show_page > 1,
+            'has_next': show_page < page_count,
+            'previous': show_page - 1,
+            'next': show_page + 1,
             'base_url' : self.request.path + '?sort=%s&amp;' % answer_sort_method,
         }
         paginator_context = functions.setup_paginator(paginator_data)
+
+        answer_cards, answer_card_keys = self.get_cached_answer_cards(
+                                                answers,
+                                                thread,
+                                                show_post = show_post
+                                            )
     
         #todo: maybe consolidate all activity in the thread
         #for the user into just one query?
@@ -590,11 +895,12 @@ class QuestionView(TemplateView):
         previous_answer = None
         if self.request.user.is_authenticated():
             if askbot_settings.LIMIT_ONE_ANSWER_PER_USER:
-                for answer in answers:
-                    if answer.author == self.request.user:
-                        user_already_gave_answer = True
-                        previous_answer = answer
-                        break
+                previous_answers = thread.get_shown_answers().filter(
+                                                author = self.request.user
+                                            )[:1]
+                if previous_answers:
+                    user_already_gave_answer = True
+                    previous_answer = previous_answers[0]
     
         data = {
             'is_cacheable': False,#is_cacheable, #temporary, until invalidation fix
@@ -605,8 +911,10 @@ class QuestionView(TemplateView):
             'edit_question_url' : reverse('edit_question', args=[question_post.id]),
             'thread': thread,
             'answer' : answer_form,
-            'answers' : page_objects.object_list,
-            'answer_count': len(answers),
+            'answers' : answers,
+            'answer_cards': answer_cards,
+            'answer_card_keys': answer_card_keys,
+            'answer_count': answer_count,
             'form_answer_url' : reverse('answer', args=[question_post.id]) ,
             'user_votes': user_votes,
             'user_post_id_list': user_post_id_list,
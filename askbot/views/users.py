@@ -344,8 +344,7 @@ def user_stats(request, user, context):
     #
     top_answers = user.posts.get_answers().filter(
         deleted=False,
-        thread__posts__deleted=False,
-        thread__posts__post_type='question',
+        thread__deleted=False,
     ).select_related('thread').order_by('-score', '-added_at')[:100]
 
     top_answer_count = len(top_answers)